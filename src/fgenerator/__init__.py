@@ -30,4 +30,6 @@
 #
 # Author R. Ford STFC Daresbury Lab
 #
+''' Fortran code generation and modification library built on fparser '''
 
+from fgenerator.base import trusted, validate
@@ -35,13 +35,116 @@
     provide routines which can be used to generate fortran code. This library
     includes pytest tests. '''
 
+import copy
+import os
+import sys
+import threading
+import weakref
+from contextlib import contextmanager
 from fparser.statements import Comment
 from fparser.readfortran import FortranStringReader
 from fparser.block_statements import Select
 from fparser.statements import Case
+from fparser.base_classes import BeginStatement
+from fparser.block_statements import BeginSource
 
 from fgenerator.fparser_wrapper import OMPDirective
 
+# Directory containing the fgenerator modules. Frames executing code in
+# this directory are skipped when recording where a Gen object was created.
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+_INTERNAL_FILES = {}
+
+
+def creation_site():
+    '''Returns a (filename, line number, function name) tuple describing
+    the first frame on the call stack that lies outside the fgenerator
+    package, i.e. the generator code that is creating an object. Returns
+    None if there is no such frame. '''
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        internal = _INTERNAL_FILES.get(filename)
+        if internal is None:
+            internal = os.path.dirname(os.path.abspath(filename)) == \
+                _PACKAGE_DIR
+            _INTERNAL_FILES[filename] = internal
+        if not internal:
+            return (filename, frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+# Whether per-call validation is performed by this thread. This is
+# switched off within a trusted() block.
+_CHECKS = threading.local()
+
+
+def checks_enabled():
+    ''' Returns True unless this thread is inside a trusted() block '''
+    return getattr(_CHECKS, "enabled", True)
+
+
+@contextmanager
+def trusted():
+    '''Context manager that skips the validation normally performed
+    each time an object is created or added (type, ancestry, position
+    and directive checks) by the current thread. The same checks may be
+    run over a whole tree afterwards by calling validate(). '''
+    previous = checks_enabled()
+    _CHECKS.enabled = False
+    try:
+        yield
+    finally:
+        _CHECKS.enabled = previous
+
+
+def validate(gen):
+    '''Runs the checks that are skipped within a trusted() block over
+    the supplied Gen object and everything it contains. Raises the same
+    exception that the failing check would have raised when the object
+    was created or added. '''
+    todo = [gen]
+    while todo:
+        node = todo.pop()
+        node.check()
+        todo.extend(node.children)
+
+
+def dispose_tree(root):
+    '''Breaks all reference cycles in the fparser tree starting at root
+    (parent and content links, links to Gen objects, analysis data and
+    links to the reader and parser) so that the tree is freed by
+    reference counting. The tree must not be used afterwards.'''
+    todo = [root]
+    while todo:
+        stmt = todo.pop()
+        gen = stmt.__dict__.get("_gen")
+        if isinstance(stmt, BeginStatement):
+            if gen is not None and gen._cow:
+                # Do not dispose of nodes shared with a cloned tree
+                todo.extend(child for child in stmt.content
+                            if id(child) not in gen._cow)
+            else:
+                todo.extend(stmt.content)
+        if gen is not None:
+            gen._parent = None
+        parser = getattr(stmt, "parent", None)
+        if getattr(parser, "block", None) is stmt:
+            # stmt was created by this parser
+            parser.block = None
+        stmt.__dict__.clear()
+
+
+def _invalidate_symbols(node):
+    '''Marks the symbol table of the Gen object of the fparser node (if
+    it is a module or subroutine) as out of date, as a statement has
+    been removed from or replaced in its content'''
+    gen = node.__dict__.get("_gen")
+    if hasattr(gen, "_invalidate_symbols"):
+        gen._invalidate_symbols()
+
+
 def index_of_object(alist, obj):
     '''Effectively implements list.index(obj) but returns the index of
     the first item in the list that *is* the supplied object (rather than
@@ -52,38 +155,168 @@ def index_of_object(alist, obj):
     raise Exception("Object {0} not found in list".format(str(obj)))
 
 
+def _copy_value(value):
+    ''' Returns a copy of value if it is a (possibly nested) list or
+    dictionary and value itself otherwise '''
+    if isinstance(value, list):
+        return [_copy_value(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _copy_value(item)) for key, item in value.items())
+    return value
+
+
+def copy_node(node):
+    '''Returns a shallow copy of the fparser node with its own copies of
+    its list and dictionary attributes (e.g. args, items or
+    entity_decls), so that modifying them does not modify node. The
+    content of a block is copied but the statements in it are not.'''
+    new_node = copy.copy(node)
+    for name, value in vars(node).items():
+        if name == "content" and isinstance(value, list):
+            new_node.content = list(value)
+        elif isinstance(value, (list, dict)):
+            setattr(new_node, name, _copy_value(value))
+    return new_node
+
+
 class BaseGen(object):
     ''' The base class for all classes that are responsible for generating
     distinct code elements (modules, subroutines, do loops etc.) '''
+    # Copy-on-write state used by clone(). _shared is True if our fparser
+    # node is still shared with the tree we were cloned from and _cow
+    # holds the ids of the nodes in our content that are still shared.
+    _shared = False
+    _cow = None
+
     def __init__(self, parent, root):
-        self._parent = parent
+        # Hold a weak reference to our parent so that a tree of Gen
+        # objects does not form reference cycles. The parent is kept
+        # alive by its fparser node.
+        if parent is None:
+            self._parent = None
+        else:
+            self._parent = weakref.ref(parent)
         self._root = root
-        self._children = []
+        # Link the fparser node back to this object. The fparser tree is
+        # the only tree that is stored, the tree of Gen objects is
+        # derived from it.
+        root._gen = self
+        self._origin = creation_site()
 
     @property
     def parent(self):
         ''' Returns the parent of this object '''
-        return self._parent
+        if self._parent is None:
+            return None
+        return self._parent()
 
     @property
     def children(self):
-        ''' Returns the list of children of this object '''
-        return self._children
+        ''' Returns the list of children of this object. This is derived
+        from the content of the associated fparser node. '''
+        if not isinstance(self._root, BeginStatement):
+            return []
+        if not self._shared and not self._cow:
+            return [stmt._gen for stmt in self._root.content
+                    if getattr(stmt, "_gen", None) is not None]
+        # Some of our children are shared with another tree so return
+        # copy-on-write views of them instead
+        children = []
+        for stmt in self._root.content:
+            gen = getattr(stmt, "_gen", None)
+            if gen is None:
+                continue
+            if self._shared or id(stmt) in self._cow:
+                gen = self._shared_child(stmt, gen)
+            children.append(gen)
+        return children
 
     @property
     def root(self):
         ''' Returns the root of the tree containing this object '''
+        if self._shared:
+            self._unshare()
         return self._root
 
+    def clone(self):
+        '''Returns a copy of this object and everything it contains. The
+        copy is made lazily: the copy shares the fparser nodes of our
+        content and a node is only copied when it (or something it
+        contains) is accessed through the Gen API of the copy, e.g. by
+        adding to it or by using its root. Modifying the original after
+        cloning it is not supported. The copy has the same parent as
+        this object but is not added to it.'''
+        node = self._root
+        new_node = self._copy_node(node)
+        gen = self._copy()
+        gen._set_root(node, new_node)
+        return gen
+
+    def _copy(self):
+        '''Returns a shallow copy of this object that does not share any
+        mutable state with it. Sub-classes that hold mutable state should
+        extend this.'''
+        gen = copy.copy(self)
+        gen._shared_children = {}
+        return gen
+
+    @staticmethod
+    def _copy_node(node):
+        ''' Returns a copy of the supplied fparser node that shares the
+        statements in its content (if any) with the original '''
+        return copy_node(node)
+
+    def _set_root(self, old_node, new_node):
+        '''Makes new_node, a copy of old_node, the root of this object and
+        marks all of its content as shared'''
+        for name, value in list(vars(self).items()):
+            # Some sub-classes keep their own reference to the root
+            if value is old_node:
+                setattr(self, name, new_node)
+        new_node._gen = self
+        self._shared = False
+        if isinstance(new_node, BeginStatement):
+            self._cow = set(id(stmt) for stmt in new_node.content)
+        else:
+            self._cow = None
+
+    def _shared_child(self, stmt, gen):
+        '''Returns the (cached) copy-on-write view of the Gen object gen,
+        whose fparser node stmt we share with another tree'''
+        child = self._shared_children.get(id(stmt))
+        if child is None:
+            child = gen._copy()
+            child._parent = weakref.ref(self)
+            child._shared = True
+            child._cow = None
+            self._shared_children[id(stmt)] = child
+        return child
+
+    def _unshare(self):
+        '''Replaces our shared fparser node with a copy of it in the
+        (unshared) content of our parent'''
+        old_node = self._root
+        new_node = self._copy_node(old_node)
+        parent = self.parent
+        parent_node = parent.root
+        index = index_of_object(parent_node.content, old_node)
+        parent_node.content[index] = new_node
+        _invalidate_symbols(parent_node)
+        parent._cow.discard(id(old_node))
+        new_node.parent = parent_node
+        self._set_root(old_node, new_node)
+
+    @property
+    def origin(self):
+        ''' Returns the (filename, line number, function name) of the
+        generator code that created this object, or None if unknown '''
+        return self._origin
+
     def add(self, new_object, position=None):
         '''Adds a new object to the tree. The actual position is determined by
-        the position argument. Note, there are two trees, the first is
-        the f2pygen object tree, the other is the f2py generated code
-        tree. These are similar but different. At the moment we
-        specify where to add things in terms of the f2pygen tree
-        (which is a higher level api) but we also insert into the f2py
-        tree at exactly the same location which needs to be sorted out
-        at some point.
+        the position argument. Only the fparser tree is updated, the
+        children of a Gen object are derived from the content of its
+        fparser node.
 
         '''
 
@@ -95,42 +328,91 @@ class BaseGen(object):
         if position is None:
             position = ["append"]
 
-        if position[0] == "auto":
-            raise Exception("Error: BaseGen:add: auto option must be "
-                            "implemented by the sub class!")
-        options = ["append", "first", "after", "before", "insert",
-                   "before_index", "after_index"]
-        if position[0] not in options:
-            raise Exception("Error: BaseGen:add: supported positions are "
-                            "{0} but found {1}".
-                            format(str(options), position[0]))
+        self.root.content.insert(self._position_index(position),
+                                 new_object.root)
+
+    def _position_index(self, position):
+        '''Returns the index in the content of our fparser node at which
+        new content should be inserted for the supplied position
+        argument (see add())'''
+        if checks_enabled():
+            if position[0] == "auto":
+                raise Exception("Error: BaseGen:add: auto option must be "
+                                "implemented by the sub class!")
+            options = ["append", "first", "after", "before", "insert",
+                       "before_index", "after_index"]
+            if position[0] not in options:
+                raise Exception("Error: BaseGen:add: supported positions "
+                                "are {0} but found {1}".
+                                format(str(options), position[0]))
         if position[0] == "append":
-            self.root.content.append(new_object.root)
+            return len(self.root.content)
         elif position[0] == "first":
-            self.root.content.insert(0, new_object.root)
+            return 0
         elif position[0] == "insert":
-            index = position[1]
-            self.root.content.insert(index, new_object.root)
+            return position[1]
         elif position[0] == "after":
-            idx = index_of_object(self.root.content, position[1])
-            self.root.content.insert(idx+1, new_object.root)
+            return index_of_object(self.root.content, position[1]) + 1
         elif position[0] == "after_index":
-            self.root.content.insert(position[1]+1, new_object.root)
+            return position[1] + 1
         elif position[0] == "before_index":
-            self.root.content.insert(position[1], new_object.root)
+            return position[1]
         elif position[0] == "before":
             try:
-                idx = index_of_object(self.root.content, position[1])
+                return index_of_object(self.root.content, position[1])
             except Exception as err:
                 print str(err)
                 raise RuntimeError(
                     "Failed to find supplied object in existing content - "
                     "is it a child of the parent?")
-            self.root.content.insert(idx, new_object.root)
-        else:
-            raise Exception("Error: BaseGen:add: internal error, should "
-                            "not get to here")
-        self.children.append(new_object)
+        raise Exception("Error: BaseGen:add: internal error, should "
+                        "not get to here")
+
+    def dispose(self):
+        '''Breaks the reference cycles between this object, the objects
+        it contains and the associated fparser nodes so that they are
+        freed by reference counting as soon as they are no longer
+        referenced, rather than by the cyclic garbage collector. This
+        object is removed from the content of its parent (if it is
+        there). Neither this object nor anything it contains may be used
+        after calling this method.'''
+        root = self.root
+        parent_node = getattr(root, "parent", None)
+        if self._parent is None and isinstance(parent_node, BeginSource) \
+           and [stmt for stmt in parent_node.content if stmt is root]:
+            # This object was created from its own fparser parse tree
+            # so release that too. A clone shares the parse tree of the
+            # original, which does not contain the clone's root, so only
+            # the nodes the clone owns are released.
+            dispose_tree(parent_node)
+            return
+        if isinstance(parent_node, BeginStatement):
+            for idx, stmt in enumerate(parent_node.content):
+                if stmt is root:
+                    del parent_node.content[idx]
+                    _invalidate_symbols(parent_node)
+                    break
+        dispose_tree(root)
+
+    def render(self, line_length=None):
+        '''Returns the Fortran for this object and everything it
+        contains, i.e. str(self.root). If line_length is supplied then
+        longer lines are wrapped with free-form continuation.'''
+        from fgenerator.render import render
+        return render(self.root, line_length=line_length)
+
+    def edits(self):
+        '''Returns a new EditJournal (see fgenerator.journal) with which
+        to queue edits to this tree and then apply them together, e.g.
+        "with module.edits() as edits:" '''
+        from fgenerator.journal import EditJournal
+        return EditJournal(self.root.top)
+
+    def check(self):
+        '''Checks that this object is valid. Sub-classes that skip
+        validation within a trusted() block re-apply it here. Used by
+        validate(). '''
+        pass
 
     def previous_loop(self):
         ''' Returns the *last* occurence of a loop in the list of
@@ -155,7 +437,11 @@ class BaseGen(object):
 
     def start_parent_loop(self, debug=False):
         ''' Searches for the outer-most loop containing this object. Returns
-        the index of that line in the content of the parent. '''
+        the index of that line in the content of the parent. If the loop
+        is preceded by an OpenMP begin directive (e.g. "parallel",
+        "parallel do" or "simd") then the directive is returned instead.
+        Standalone directives such as "barrier" are not included.
+        '''
         from fparser.block_statements import Do
         if debug:
             print "Entered before_parent_loop"
@@ -201,13 +487,16 @@ class BaseGen(object):
                     "type is {0}\ndirective is {1}".
                     format(parent.content[index-1].position,
                            str(parent.content[index-1])))
-            if parent.content[index-1].position == "begin":
+            directive = parent.content[index-1]
+            if directive.position == "begin" and \
+               directive.type not in OMPDirective.STANDALONE_TYPES:
                 if debug:
                     print "type of directive is begin so move back one"
                 index -= 1
             else:
                 if debug:
-                    print "directive type is not begin so finish"
+                    print ("directive type is not begin or is a standalone "
+                           "directive so finish")
         else:
             if debug:
                 print "preceding node is not a directive so finish"
@@ -0,0 +1,215 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+'''This module provides a parse front-end for the routines in
+fgenerator.modify that caches fparser trees on disk. Cached trees are
+keyed by a hash of the source text, so an unchanged file is never
+re-parsed (even if it has been moved or touched). The least recently
+used trees are evicted once the cache holds more than a maximum number
+of them.'''
+
+import copy_reg
+import cPickle as pickle
+import hashlib
+import os
+
+from fparser.base_classes import BeginStatement, AttributeHolder
+
+from fgenerator.output import write_if_changed
+
+# Changes whenever the format of the cached trees changes
+_FORMAT = "fgenerator-parse-1"
+
+# Suffix of the files holding cached trees
+_SUFFIX = ".tree"
+
+
+def _attribute_holder(attributes, readonly):
+    ''' Returns an fparser AttributeHolder with the supplied state '''
+    holder = AttributeHolder()
+    holder.__dict__["_attributes"] = attributes
+    holder.__dict__["_readonly"] = readonly
+    return holder
+
+
+def _reduce_attribute_holder(holder):
+    '''Pickles an fparser AttributeHolder, whose __getattr__ otherwise
+    recurses when it is unpickled '''
+    return _attribute_holder, (holder.__dict__["_attributes"],
+                               holder.__dict__["_readonly"])
+
+
+copy_reg.pickle(AttributeHolder, _reduce_attribute_holder)
+
+
+class CachedReader(object):
+    '''Stands in for the fparser reader of a tree that has been cached.
+    It has the attributes of the reader that fparser statements use
+    after parsing and no more lines to read.'''
+    def __init__(self, reader):
+        self.id = reader.id
+        self.name = reader.name
+        self.mode = reader.mode
+        self.isfixed = reader.isfixed
+        self.isfree = reader.isfree
+        self.isstrict = reader.isstrict
+        self.isf77 = reader.isf77
+        self.ispyf = reader.ispyf
+        self.source_lines = []
+
+    def format_message(self, kind, message, startlineno, endlineno,
+                       startcolno=0, endcolno=-1):
+        ''' Returns a message about the supplied lines of the source '''
+        return "While processing {0!r} (mode={1!r})..\n{2}: {3} " \
+            "(lines {4}-{5})".format(self.id, self.mode, kind, message,
+                                     startlineno, endlineno)
+
+    def get_item(self):
+        ''' Returns None as there are no more lines to read '''
+        return None
+
+    def put_item(self, item):
+        ''' Discards item as there are no more lines to read '''
+        pass
+
+
+def _nodes(tree):
+    ''' Returns a list of the statements in tree '''
+    nodes = []
+    todo = [tree]
+    while todo:
+        stmt = todo.pop()
+        nodes.append(stmt)
+        if isinstance(stmt, BeginStatement):
+            todo.extend(stmt.content)
+    return nodes
+
+
+def strip_tree(tree):
+    '''Replaces the reader of every statement (and of the source lines
+    they were parsed from) in tree with a CachedReader and removes the
+    links to the parser so that the tree can be pickled '''
+    reader = CachedReader(tree.reader)
+    tree.parent = None
+    for stmt in _nodes(tree):
+        stmt.reader = reader
+        item = stmt.__dict__.get("item")
+        if hasattr(item, "reader"):
+            item.reader = reader
+        stmt.__dict__.pop("get_item", None)
+        stmt.__dict__.pop("put_item", None)
+    return tree
+
+
+def _restore_tree(tree):
+    '''Reconnects the block statements in a tree loaded from the cache
+    to its reader so that new blocks can be added to it '''
+    reader = tree.reader
+    for stmt in _nodes(tree):
+        if isinstance(stmt, BeginStatement):
+            stmt.get_item = reader.get_item
+            stmt.put_item = reader.put_item
+    return tree
+
+
+def read_source(path):
+    '''Returns the content of the file path and the hex sha1 digest that
+    identifies it in the cache '''
+    with open(path, "rb") as in_file:
+        text = in_file.read()
+    digest = hashlib.sha1(_FORMAT)
+    digest.update(text)
+    return text, digest.hexdigest()
+
+
+class ParseCache(object):
+    '''A cache, in the directory directory, of the fparser trees of
+    source files. At most max_entries trees are kept. '''
+    def __init__(self, directory, max_entries=1000):
+        self._directory = directory
+        self._max_entries = max_entries
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another process (e.g. a worker of apply_to_files()) may
+            # have created it first
+            if not os.path.isdir(directory):
+                raise
+
+    def _path(self, key):
+        ''' Returns the path of the file holding the tree with key '''
+        return os.path.join(self._directory, key + _SUFFIX)
+
+    def parse(self, path):
+        '''Returns the content of the source file path and its fparser
+        tree, from the cache if it has the tree for that content and
+        otherwise by parsing it (and adding the tree to the cache) '''
+        from fgenerator.modify import _parse
+        text, key = read_source(path)
+        cache_path = self._path(key)
+        if os.path.isfile(cache_path):
+            try:
+                with open(cache_path, "rb") as cache_file:
+                    tree = pickle.load(cache_file)
+                # record the use for eviction
+                os.utime(cache_path, None)
+                return text, _restore_tree(tree)
+            except Exception:
+                # the cached tree is unreadable so replace it
+                pass
+        tree = strip_tree(_parse(text, path))
+        write_if_changed(cache_path,
+                         pickle.dumps(tree, pickle.HIGHEST_PROTOCOL))
+        self._evict()
+        return text, _restore_tree(tree)
+
+    def load(self, path):
+        ''' Returns a ModifiedSource for the source file path '''
+        from fgenerator.modify import ModifiedSource
+        text, tree = self.parse(path)
+        return ModifiedSource(text, path, tree=tree)
+
+    def _evict(self):
+        ''' Removes the least recently used trees from the cache until
+        it holds at most max_entries of them '''
+        names = [name for name in os.listdir(self._directory)
+                 if name.endswith(_SUFFIX)]
+        if len(names) <= self._max_entries:
+            return
+        paths = [os.path.join(self._directory, name) for name in names]
+        paths.sort(key=lambda path: os.stat(path).st_mtime)
+        for path in paths[:len(paths) - self._max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by another process
+                pass
@@ -0,0 +1,173 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+'''This module extracts the static call graph from trees of Gen objects
+and from existing fparser trees. Each edge records how many call sites
+there are from the caller to the callee, how many of them are within a
+loop and, where it can be determined, the module that the callee comes
+from (through the only list of a use statement, a use of a module that
+is in the analysed trees or because the callee is contained in an
+enclosing module or subroutine).'''
+
+from fparser.base_classes import BeginStatement
+from fparser.block_statements import Program, Module, Subroutine, \
+    Function, Interface, Use, Do
+from fparser.statements import Call
+
+
+class CallEdge(object):
+    '''The calls made by the program unit caller (within the module
+    caller_module, or None) to callee. module is the module that the
+    callee comes from and remote_name its name in that module (which
+    differs from callee if it has been renamed by a use statement), or
+    None if they could not be determined.'''
+    def __init__(self, caller_module, caller, callee):
+        self.caller_module = caller_module
+        self.caller = caller
+        self.callee = callee
+        self.module = None
+        self.remote_name = callee
+        self.count = 0
+        self.loop_count = 0
+
+    @property
+    def in_loop(self):
+        ''' Returns True if any of the calls is within a loop '''
+        return self.loop_count > 0
+
+
+class _Scope(object):
+    ''' The use statements and contained procedures of a program unit '''
+    def __init__(self, unit, module):
+        self.name = unit.name.lower()
+        self.module = module
+        # local name -> (module, remote name) from only lists
+        self.only = {}
+        # modules used without an only list
+        self.modules = []
+        self.contained = set()
+        for stmt in unit.content:
+            if isinstance(stmt, Use):
+                if stmt.isonly:
+                    for item in stmt.items:
+                        parts = [part.strip().lower() for part in
+                                 item.split("=>")]
+                        self.only[parts[0]] = (stmt.name.lower(), parts[-1])
+                else:
+                    self.modules.append(stmt.name.lower())
+            elif isinstance(stmt, (Subroutine, Function)):
+                self.contained.add(stmt.name.lower())
+
+
+class CallGraph(object):
+    '''The call graph of the supplied roots, each of which is a Gen object
+    or an fparser node (e.g. the tree of a parsed file). '''
+    def __init__(self, roots):
+        self._edges = {}
+        # procedures defined in each module in the trees
+        self._procedures = {}
+        pending = []
+        for root in roots:
+            self._visit(getattr(root, "root", root), [], False, pending)
+        for edge, scopes in pending:
+            self._resolve(edge, scopes)
+
+    def _visit(self, stmt, scopes, in_loop, pending):
+        ''' Records the calls made within stmt '''
+        todo = [(stmt, scopes, in_loop)]
+        while todo:
+            stmt, scopes, in_loop = todo.pop()
+            if isinstance(stmt, Call):
+                self._add_call(stmt, scopes, in_loop, pending)
+                continue
+            if not isinstance(stmt, BeginStatement) or \
+               isinstance(stmt, Interface):
+                continue
+            if isinstance(stmt, (Program, Module, Subroutine, Function)):
+                module = scopes[0].module if scopes else None
+                if isinstance(stmt, Module):
+                    module = stmt.name.lower()
+                scope = _Scope(stmt, module)
+                if isinstance(stmt, Module):
+                    self._procedures[module] = scope.contained
+                scopes = scopes + [scope]
+            in_loop = in_loop or isinstance(stmt, Do)
+            todo.extend((child, scopes, in_loop) for child in
+                        reversed(stmt.content))
+
+    def _add_call(self, call, scopes, in_loop, pending):
+        ''' Records the call statement call '''
+        callee = str(call.designator).strip().lower()
+        caller_module = None
+        caller = None
+        if scopes:
+            caller_module = scopes[0].module
+            caller = scopes[-1].name
+        key = (caller_module, caller, callee)
+        edge = self._edges.get(key)
+        if edge is None:
+            edge = CallEdge(caller_module, caller, callee)
+            self._edges[key] = edge
+            pending.append((edge, scopes))
+        edge.count += 1
+        if in_loop:
+            edge.loop_count += 1
+
+    def _resolve(self, edge, scopes):
+        ''' Works out the module that the callee of edge comes from '''
+        for scope in reversed(scopes):
+            if edge.callee in scope.contained:
+                edge.module = scope.module
+                return
+            if edge.callee in scope.only:
+                edge.module, edge.remote_name = scope.only[edge.callee]
+                return
+            for module in scope.modules:
+                if edge.callee in self._procedures.get(module, ()):
+                    edge.module = module
+                    return
+
+    def edges(self):
+        ''' Returns a list of all of the edges, sorted by caller '''
+        return sorted(self._edges.values(),
+                      key=lambda edge: (edge.caller_module or "",
+                                        edge.caller or "", edge.callee))
+
+    def callees(self, caller):
+        ''' Returns the edges from the program unit named caller '''
+        caller = caller.lower()
+        return [edge for edge in self.edges() if edge.caller == caller]
+
+    def callers(self, callee):
+        ''' Returns the edges to the procedure named callee '''
+        callee = callee.lower()
+        return [edge for edge in self.edges() if edge.callee == callee]
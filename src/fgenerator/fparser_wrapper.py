@@ -42,29 +42,178 @@ from fparser.statements import Case
 
 class OMPDirective(Comment):
     ''' Subclass f2py comment for OpenMP directives so we can
-        reason about them when walking the tree '''
-    def __init__(self, root, line, position, dir_type):
-        self._types = ["parallel do", "parallel", "do", "master"]
+        reason about them when walking the tree. The schedule, collapse,
+        nowait, safelen and aligned clauses are held as data (see
+        set_clauses()), any other clauses as text (clause_text). '''
+    # The directives that apply to the loop (nest) that follows them
+    LOOP_TYPES = ["parallel do", "do", "simd", "parallel do simd",
+                  "do simd", "taskloop"]
+    # The directives that have no end directive
+    STANDALONE_TYPES = ["barrier", "flush"]
+    SCHEDULE_KINDS = ["static", "dynamic", "guided", "auto", "runtime"]
+    # The directive types and position that accept each structured clause
+    _clause_rules = {
+        "schedule": (["parallel do", "do", "parallel do simd", "do simd"],
+                     "begin"),
+        "collapse": (LOOP_TYPES, "begin"),
+        "nowait": (["do", "do simd", "single"], "end"),
+        "safelen": (["simd", "parallel do simd", "do simd"], "begin"),
+        "aligned": (["simd", "parallel do simd", "do simd"], "begin")}
+
+    def __init__(self, root, line, position, dir_type, **clauses):
+        from fgenerator.base import checks_enabled
+        self._types = ["parallel do", "parallel", "do", "master", "simd",
+                       "parallel do simd", "do simd", "taskloop", "single",
+                       "barrier", "atomic", "critical", "flush"]
         self._positions = ["begin", "end"]
-        if dir_type not in self._types:
+        self._my_type = dir_type
+        self._position = position
+        self.clause_text = ""
+        self.schedule = None
+        self.collapse = None
+        self.nowait = False
+        self.safelen = None
+        self.aligned = None
+        self.alignment = None
+        self._set_clauses(**clauses)
+        if checks_enabled():
+            self.check()
+        Comment.__init__(self, root, line)
+
+    def _set_clauses(self, schedule=None, collapse=None, nowait=False,
+                     safelen=None, aligned=None, alignment=None):
+        ''' Sets the structured clauses without checking them '''
+        if schedule is not None and not isinstance(schedule, tuple):
+            schedule = (schedule, None)
+        self.schedule = schedule
+        self.collapse = collapse
+        self.nowait = nowait
+        self.safelen = safelen
+        self.aligned = aligned
+        self.alignment = alignment
+
+    def set_clauses(self, **clauses):
+        '''Sets the structured clauses of this directive and updates its
+        content. schedule is a kind (e.g. 'dynamic') or a (kind, chunk)
+        tuple, collapse and safelen are positive integers, nowait is a
+        bool, aligned is a list of names and alignment (which may only be
+        given with aligned) is a positive integer. Clauses that are not
+        given are removed.'''
+        from fgenerator.base import checks_enabled
+        self._set_clauses(**clauses)
+        if checks_enabled():
+            self.check()
+        self.update()
+
+    def check(self):
+        ''' Checks that the type, position and clauses of this directive
+        are supported '''
+        if self._my_type not in self._types:
             raise RuntimeError("Error, unrecognised directive type '{0}'. "
                                "Should be one of {1}".
-                               format(dir_type, self._types))
-        if position not in self._positions:
+                               format(self._my_type, self._types))
+        if self._position not in self._positions:
             raise RuntimeError("Error, unrecognised position '{0}'. "
                                "Should be one of {1}".
-                               format(position, self._positions))
-        self._my_type = dir_type
-        self._position = position
-        Comment.__init__(self, root, line)
+                               format(self._position, self._positions))
+        if self._my_type in self.STANDALONE_TYPES and \
+           self._position != "begin":
+            raise RuntimeError("Error, the omp '{0}' directive has no "
+                               "'{1}' position".format(self._my_type,
+                                                       self._position))
+        for name, value in self.structured_clauses():
+            types, position = self._clause_rules[name]
+            if self._my_type not in types or self._position != position:
+                raise RuntimeError(
+                    "Error, the '{0}' clause is only supported at the {1} "
+                    "of an omp {2} directive but found the {3} of an omp "
+                    "'{4}' directive".format(name, position, types,
+                                             self._position, self._my_type))
+        if self.schedule is not None:
+            kind, chunk = self.schedule
+            if kind not in self.SCHEDULE_KINDS:
+                raise RuntimeError("Error, unrecognised schedule kind '{0}'. "
+                                   "Should be one of {1}".format(
+                                       kind, self.SCHEDULE_KINDS))
+            if chunk is not None and kind in ["auto", "runtime"]:
+                raise RuntimeError("Error, a chunk size cannot be given for "
+                                   "the '{0}' schedule".format(kind))
+        for name in ["collapse", "safelen", "alignment"]:
+            value = getattr(self, name)
+            # bool is a sub-class of int but True is not a valid value
+            if value is not None and \
+               (isinstance(value, bool) or
+                not isinstance(value, (int, long)) or value < 1):
+                raise RuntimeError("Error, the '{0}' clause requires a "
+                                   "positive integer but found '{1}'".format(
+                                       name, value))
+        if self.aligned is not None and \
+           (not isinstance(self.aligned, list) or not self.aligned or
+            [name for name in self.aligned
+             if not isinstance(name, basestring)]):
+            raise RuntimeError("Error, the 'aligned' clause requires a list "
+                               "of names but found '{0}'".format(
+                                   self.aligned))
+        if self.alignment is not None and self.aligned is None:
+            raise RuntimeError("Error, an alignment can only be given with "
+                               "the 'aligned' clause")
+
+    def structured_clauses(self):
+        ''' Returns the (name, value) of each structured clause that is
+        set, in the order in which they are written '''
+        clauses = []
+        for name in ["schedule", "collapse", "safelen", "aligned",
+                     "nowait"]:
+            value = getattr(self, name)
+            if value is not None and value is not False:
+                clauses.append((name, value))
+        return clauses
+
+    def update(self):
+        ''' Sets the content of this comment from the type, position and
+        clauses of the directive '''
+        clauses = []
+        for name, value in self.structured_clauses():
+            if name == "nowait":
+                clauses.append("nowait")
+            elif name == "schedule":
+                kind, chunk = value
+                if chunk is not None:
+                    kind += ",{0}".format(chunk)
+                clauses.append("schedule({0})".format(kind))
+            elif name == "aligned":
+                names = ",".join(value)
+                if self.alignment is not None:
+                    names += ":{0}".format(self.alignment)
+                clauses.append("aligned({0})".format(names))
+            else:
+                clauses.append("{0}({1})".format(name, value))
+        if self.clause_text:
+            clauses.append(self.clause_text)
+        self.content = "$omp"
+        if self._position == "end":
+            self.content += " end"
+        self.content += " " + self._my_type
+        if clauses:
+            self.content += " " + ", ".join(clauses)
 
     @property
     def type(self):
-        ''' Returns the type of this OMP Directive (one of 'parallel do',
-        'parallel' or 'do') '''
+        ''' Returns the type of this OMP Directive (e.g. 'parallel do',
+        'parallel', 'do' or 'simd') '''
         return self._my_type
 
     @property
     def position(self):
         ''' Returns the position of this OMP Directive ('begin' or 'end') '''
         return self._position
+
+    @property
+    def associated_loops(self):
+        ''' Returns the number of loops in the nest that follows this
+        directive that it applies to (given by its collapse clause), which
+        is zero if it does not apply to loops or is an end directive '''
+        if self._my_type not in self.LOOP_TYPES or \
+           self._position != "begin":
+            return 0
+        return self.collapse or 1
@@ -34,6 +34,8 @@
 relatively high level way. Under the hood it uses fparser to generate
 the code.'''
 
+import re
+
 from fparser.statements import Comment
 from fparser.readfortran import FortranStringReader
 from fparser.block_statements import Select
@@ -43,6 +45,146 @@ from fgenerator.fparser_wrapper import OMPDirective
 
 # Module-wide utility methods
 
+def entity_name(entity_decl):
+    '''Returns the (lower-cased, interned) name of the variable declared
+    by an entity declaration such as 'a(10)' or 'b = 1', or the local
+    name of an item in the only list of a use statement such as
+    'a=>b'. '''
+    return intern(re.match(r"\s*(\w+)", entity_decl).group(1).lower())
+
+
+# The tokens of a Fortran expression that matter when finding its names:
+# character strings, operators such as .and., numbers (including any
+# exponent and kind) and names
+_TOKEN = re.compile(r"'[^']*'|\"[^\"]*\"|\.[a-z]+\.|"
+                    r"(?:\d+\.?\d*|\.\d+)(?:[de][+-]?\d+)?(?:_\w+)?|"
+                    r"[a-z]\w*", re.IGNORECASE)
+
+
+def _tree_names(node, found, variable=True):
+    '''Appends to found, in order, whether each name in the fparser
+    Fortran 2003 expression node is a variable (True) or a component
+    name or argument keyword (False)'''
+    from fparser import Fortran2003
+    if node is None:
+        return
+    if isinstance(node, (list, tuple)):
+        for item in node:
+            _tree_names(item, found, variable)
+    elif isinstance(node, Fortran2003.StringBase):
+        if re.match(r"[a-z]\w*$", node.string, re.IGNORECASE):
+            found.append(variable)
+    elif isinstance(node, Fortran2003.Data_Ref):
+        _tree_names(node.items[0], found)
+        for component in node.items[1:]:
+            if isinstance(component, Fortran2003.CallBase):
+                _tree_names(component.items[0], found, False)
+                _tree_names(component.items[1:], found)
+            else:
+                _tree_names(component, found, False)
+    elif isinstance(node, Fortran2003.Proc_Component_Ref):
+        _tree_names(node.items[0], found)
+        _tree_names(node.items[2], found, False)
+    elif isinstance(node, Fortran2003.KeywordValueBase):
+        _tree_names(node.items[0], found, False)
+        _tree_names(node.items[1], found)
+    elif isinstance(node, Fortran2003.Base):
+        _tree_names([item for item in node.items
+                     if isinstance(item, (Fortran2003.Base, list, tuple))],
+                    found)
+
+
+def _split_top_level(text, separator):
+    '''Returns the (start, end) offsets of the parts of text separated by
+    the character separator outside parentheses and strings '''
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    for index, char in enumerate(text):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == separator and depth == 0:
+            if separator != "=" or (
+                    text[index - 1:index] not in ("=", "/", "<", ">") and
+                    text[index + 1:index + 2] not in ("=", ">")):
+                parts.append((start, index))
+                start = index + 1
+    parts.append((start, len(text)))
+    return parts
+
+
+def _variable_spans(text, start, end):
+    '''Returns the (start, end) offsets of the names in the expression
+    text[start:end] that are variables (or functions) rather than
+    component names or argument keywords. Raises a RuntimeError if the
+    expression cannot be parsed. '''
+    from fparser import Fortran2003
+    tokens = [match for match in _TOKEN.finditer(text, start, end)
+              if match.group(0)[0].isalpha()]
+    if not tokens:
+        return []
+    found = []
+    try:
+        _tree_names(Fortran2003.Expr(text[start:end].strip()), found)
+    except Fortran2003.NoMatchError:
+        found = None
+    if found is None or len(found) != len(tokens):
+        raise RuntimeError(
+            "Cannot find the variables in the Fortran expression "
+            "'{0}'".format(text[start:end].strip()))
+    return [match.span() for match, variable in zip(tokens, found)
+            if variable]
+
+
+def _mark_names(text, names, assignment=False):
+    '''Returns text, the value of an attribute of an fparser statement
+    (an expression or a list of expressions, some of which may be
+    keyword arguments), with each of the (lower-cased) names that it uses as a
+    variable enclosed in NUL characters, ready for _fill_names(). Names
+    of components (after '%') and argument keywords are left alone. If
+    assignment is True then text is the control of a do loop or an
+    entity declaration, so that 'name = ...' assigns to name rather
+    than naming a keyword.'''
+    if not any(match.group(0).lower() in names
+               for match in _TOKEN.finditer(text)):
+        return text
+    spans = []
+    if assignment and text.strip().lower().startswith("while"):
+        spans = _variable_spans(text, text.lower().index("while") + 5,
+                                len(text))
+    else:
+        for start, end in _split_top_level(text, ","):
+            parts = _split_top_level(text[start:end], "=")
+            if len(parts) == 1:
+                spans.extend(_variable_spans(text, start, end))
+                continue
+            if assignment:
+                spans.extend(_variable_spans(text, start,
+                                             start + parts[0][1]))
+            spans.extend(_variable_spans(text, start + parts[1][0], end))
+    for start, end in reversed(spans):
+        if text[start:end].lower() in names:
+            text = text[:start] + "\0" + text[start:end].lower() + "\0" + \
+                text[end:]
+    return text
+
+
+def _fill_names(text, values):
+    ''' Returns text, as returned by _mark_names(), with each marked
+    name replaced by its value in the dictionary values '''
+    parts = text.split("\0")
+    parts[1::2] = [values[name] for name in parts[1::2]]
+    return "".join(parts)
+
+
 def bubble_up_type(obj):
     ''' Returns True if the supplied object is of a type which must be
     bubbled-up (from within e.g. DO loops) '''
@@ -50,14 +192,179 @@ def bubble_up_type(obj):
             isinstance(obj, DeclGen) or
             isinstance(obj, TypeDeclGen))
 
-from fgenerator.base import BaseGen
+from fgenerator.base import BaseGen, checks_enabled
+
+class Symbol(object):
+    ''' An entry in the symbol table of a program unit. Records the Gen
+    object that declares the symbol, its datatype (e.g. 'integer' or
+    'type(field_type)' or None for a symbol made available by a use
+    statement) and its attributes (e.g. 'intent(in)' or 'pointer'). '''
+    def __init__(self, name, node, datatype, attributes):
+        self.name = name
+        self.node = node
+        self.datatype = datatype
+        self.attributes = attributes
+
 
 class ProgUnitGen(BaseGen):
     ''' Functionality relevant to program units (currently modules,
     subroutines)'''
     def __init__(self, parent, sub):
+        # The symbol table of this scope, keyed by lower-cased name, and
+        # whether it must be rebuilt before it is next used
+        self._symbols = {}
+        self._symbols_stale = False
+        # The use statements in this scope, keyed by lower-cased module
+        # name
+        self._uses = {}
+        # The next suffix to try for each prefix passed to new_name() and
+        # the names that it has returned
+        self._name_counters = {}
+        self._new_names = set()
         BaseGen.__init__(self, parent, sub)
 
+    def _copy(self):
+        ''' Returns a shallow copy of this object with its own copy of
+        the symbol table '''
+        gen = BaseGen._copy(self)
+        gen._symbols = dict(self._symbols)
+        gen._uses = dict((name, list(uses)) for name, uses in
+                         self._uses.items())
+        gen._name_counters = dict(self._name_counters)
+        gen._new_names = set(self._new_names)
+        return gen
+
+    @property
+    def symbols(self):
+        '''Returns the symbol table of this scope, a dictionary of Symbol
+        objects keyed by lower-cased name. This should not be modified
+        directly. '''
+        if self._symbols_stale:
+            self._rebuild_symbols()
+        return self._symbols
+
+    def _invalidate_symbols(self):
+        '''Marks the symbol table of this scope as out of date, so that it
+        is rebuilt from the content when it is next used. Called when a
+        statement is removed from (or replaced in) the content other
+        than by an EditJournal, which updates the table itself.'''
+        self._symbols_stale = True
+
+    def _rebuild_symbols(self):
+        '''Rebuilds the symbol table of this scope from its content '''
+        self._symbols = {}
+        self._uses = {}
+        self._symbols_stale = False
+        for stmt in self._root.content:
+            gen = getattr(stmt, "_gen", None)
+            if gen is not None:
+                self._register(gen)
+
+    def _symbol(self, key):
+        ''' Returns the Symbol for the lower-cased name key in this scope,
+        or None if it is not declared here '''
+        if self._symbols_stale:
+            self._rebuild_symbols()
+        return self._symbols.get(key)
+
+    def _module_uses(self, module):
+        ''' Returns the use statements of the (lower-cased) module in this
+        scope '''
+        if self._symbols_stale:
+            self._rebuild_symbols()
+        return self._uses.get(module, [])
+
+    def lookup(self, name):
+        '''Returns the Symbol for the supplied name from the symbol table
+        of this scope or, if it is not declared here, of the nearest
+        enclosing scope that declares it. Returns None if the name is
+        not declared. '''
+        key = name.lower()
+        scope = self
+        while scope is not None:
+            symbol = scope._symbol(key)
+            if symbol is not None:
+                return symbol
+            scope = scope.parent
+            while scope is not None and not isinstance(scope, ProgUnitGen):
+                scope = scope.parent
+        return None
+
+    def _reserved_names(self):
+        '''Returns the (lower-cased) names, other than those in the
+        symbol tables, that a new name must not clash with: the name of
+        this unit and every name used in its statements (which include
+        names that are not declared, such as implicitly typed variables
+        and external procedures)'''
+        names = set([self._root.name.lower()])
+        names.update(match.group(0).lower() for match in
+                     _TOKEN.finditer(str(self._root))
+                     if match.group(0)[0].isalpha())
+        return names
+
+    def new_name(self, prefix, datatype=None, **kwargs):
+        '''Returns a name of the form <prefix>_<n> that is not declared in
+        this scope or any enclosing scope, is not otherwise used in this
+        scope and has not been returned before. Each prefix has its own
+        counter so the cost does not grow with the number of names
+        allocated. If datatype is supplied then the name is also
+        declared in this scope by adding a DeclGen with that datatype,
+        to which any other keyword arguments are passed. '''
+        key = prefix.lower()
+        count = self._name_counters.get(key, 1)
+        reserved = self._reserved_names()
+        while True:
+            name = "{0}_{1}".format(prefix, count)
+            lower_name = name.lower()
+            count += 1
+            if lower_name not in self._new_names and \
+               lower_name not in reserved and \
+               self.lookup(lower_name) is None:
+                break
+        self._name_counters[key] = count
+        self._new_names.add(lower_name)
+        if datatype is not None:
+            self.add(DeclGen(self, datatype=datatype, entity_decls=[name],
+                             **kwargs))
+        return name
+
+    @staticmethod
+    def _datatype(content):
+        ''' Returns the datatype of the variables declared by the
+        supplied DeclGen or TypeDeclGen '''
+        from fparser.typedecl_statements import Type
+        if isinstance(content.root, Type):
+            return "type({0})".format(content.root.selector[1].lower())
+        return content.root.name
+
+    def _register(self, content):
+        ''' Adds the symbols declared by content, which has just been
+        added to this scope, to the symbol table '''
+        if isinstance(content, DeclGen) or isinstance(content, TypeDeclGen):
+            datatype = self._datatype(content)
+            for entity_decl in content.root.entity_decls:
+                name = entity_name(entity_decl)
+                if name not in self._symbols:
+                    self._symbols[name] = Symbol(
+                        name, content, datatype, content.root.attrspec)
+        elif isinstance(content, UseGen):
+            self._uses.setdefault(content.root.name.lower(), []).append(
+                content.root)
+            for item in content.root.items:
+                name = entity_name(item)
+                if name not in self._symbols:
+                    self._symbols[name] = Symbol(name, content, None, [])
+
+    def _unregister(self, content):
+        ''' Removes the symbols declared by content, which has just been
+        removed from this scope, from the symbol table '''
+        for name, symbol in list(self._symbols.items()):
+            if symbol.node is content:
+                del self._symbols[name]
+        if isinstance(content, UseGen):
+            uses = self._uses.get(content.root.name.lower(), [])
+            uses[:] = [use for use in uses if use is not content.root]
+
     def add(self, content, position=None, bubble_up=False):
         '''Specialise the add method to provide module and subroutine
            specific intelligent adding of use statements, implicit
@@ -72,32 +379,8 @@ class ProgUnitGen(BaseGen):
         if position is None:
             position = ["auto"]
 
-        # For an object to be added to another we require that they
-        # share a common ancestor. This means that the added object must
-        # have the current object or one of its ancestors as an ancestor.
-        # Loop over the ancestors of this object (starting with itself)
-        self_ancestor = self.root
-        while self_ancestor:
-            # Loop over the ancestors of the object being added
-            obj_parent = content.root.parent
-            while (obj_parent != self_ancestor and
-                   getattr(obj_parent, 'parent', None)):
-                obj_parent = obj_parent.parent
-            if obj_parent == self_ancestor:
-                break
-            # Object being added is not an ancestor of the current
-            # self_ancestor so move one level back up the tree and
-            # try again
-            if getattr(self_ancestor, 'parent', None):
-                self_ancestor = self_ancestor.parent
-            else:
-                break
-
-        if obj_parent != self_ancestor:
-            raise RuntimeError(
-                "Cannot add '{0}' to '{1}' because it is not a descendant "
-                "of it or of any of its ancestors.".
-                format(str(content), str(self)))
+        if checks_enabled():
+            self._check_ancestry(content)
 
         if bubble_up:
             # If content has been passed on (is being bubbled up) then change
@@ -108,50 +391,24 @@ class ProgUnitGen(BaseGen):
         if position[0] != "auto":
             # position[0] is not 'auto' so the baseclass can deal with it
             BaseGen.add(self, content, position)
+            self._register(content)
         else:
             # position[0] == "auto" so insert in a context sensitive way
             if isinstance(content, DeclGen) or \
                isinstance(content, TypeDeclGen):
 
-                if isinstance(content, DeclGen):
-                    # have I already been declared?
-                    for child in self._children:
-                        if isinstance(child, DeclGen):
-                            # is this declaration the same type as me?
-                            if child.root.name == content.root.name:
-                                # we are modifying the list so we need
-                                # to iterate over a copy
-                                for var_name in content.root.entity_decls[:]:
-                                    for child_name in child.root.entity_decls:
-                                        if var_name.lower() == \
-                                           child_name.lower():
-                                            content.root.entity_decls.\
-                                                remove(var_name)
-                                            if not content.root.entity_decls:
-                                                # return as all variables in
-                                                # this declaration already
-                                                # exist
-                                                return
-                if isinstance(content, TypeDeclGen):
-                    # have I already been declared?
-                    for child in self._children:
-                        if isinstance(child, TypeDeclGen):
-                            # is this declaration the same type as me?
-                            if child.root.selector[1] == \
-                               content.root.selector[1]:
-                                # we are modifying the list so we need
-                                # to iterate over a copy
-                                for var_name in content.root.entity_decls[:]:
-                                    for child_name in child.root.entity_decls:
-                                        if var_name.lower() == \
-                                           child_name.lower():
-                                            content.root.entity_decls.\
-                                                remove(var_name)
-                                            if not content.root.entity_decls:
-                                                # return as all variables in
-                                                # this declaration already
-                                                # exist
-                                                return
+                # have I already been declared with the same type? We
+                # are modifying the list so we need to iterate over a
+                # copy
+                datatype = self._datatype(content)
+                for var_name in content.root.entity_decls[:]:
+                    symbol = self._symbol(entity_name(var_name))
+                    if symbol is not None and symbol.datatype == datatype:
+                        content.root.entity_decls.remove(var_name)
+                        if not content.root.entity_decls:
+                            # return as all variables in this
+                            # declaration already exist
+                            return
 
                 index = 0
                 # skip over any use statements
@@ -171,40 +428,36 @@ class ProgUnitGen(BaseGen):
                 except AttributeError:
                     pass
             elif isinstance(content.root, fparser.statements.Use):
-                # have I already been declared?
-                for child in self._children:
-                    if isinstance(child, UseGen):
-                        if child.root.name == content.root.name:
-                            # found an existing use with the same name
-                            if not child.root.isonly and not \
-                               content.root.isonly:
-                                # both are generic use statements so
-                                # skip this declaration
-                                return
-                            if child.root.isonly and not content.root.isonly:
-                                # new use is generic and existing use
-                                # is specific so we can safely add
-                                pass
-                            if not child.root.isonly and content.root.isonly:
-                                # existing use is generic and new use
-                                # is specific so we can skip this
-                                # declaration
-                                return
-                            if child.root.isonly and content.root.isonly:
-                                # we are modifying the list so we need
-                                # to iterate over a copy
-                                for new_name in content.root.items[:]:
-                                    for existing_name in child.root.items:
-                                        if existing_name.lower() == \
-                                           new_name.lower():
-                                            content.root.items.remove(new_name)
-                                            if not content.root.items:
-                                                return
+                # have I already been declared? Look at the existing use
+                # statements of the same module
+                for stmt in self._module_uses(content.root.name.lower()):
+                    if not stmt.isonly and not content.root.isonly:
+                        # both are generic use statements so skip this
+                        # declaration
+                        return
+                    if stmt.isonly and not content.root.isonly:
+                        # new use is generic and existing use is specific
+                        # so we can safely add
+                        pass
+                    if not stmt.isonly and content.root.isonly:
+                        # existing use is generic and new use is specific
+                        # so we can skip this declaration
+                        return
+                    if stmt.isonly and content.root.isonly:
+                        existing_names = set(name.lower() for name in
+                                             stmt.items)
+                        # we are modifying the list so we need to
+                        # iterate over a copy
+                        for new_name in content.root.items[:]:
+                            if new_name.lower() in existing_names:
+                                content.root.items.remove(new_name)
+                                if not content.root.items:
+                                    return
                 index = 0
             elif isinstance(content, ImplicitNoneGen):
                 # does implicit none already exist?
-                for child in self._children:
-                    if isinstance(child, ImplicitNoneGen):
+                for stmt in self.root.content:
+                    if isinstance(stmt, fparser.typedecl_statements.Implicit):
                         return
                 # skip over any use statements
                 index = 0
@@ -212,7 +465,42 @@ class ProgUnitGen(BaseGen):
             else:
                 index = len(self.root.content) - 1
             self.root.content.insert(index, content.root)
-            self._children.append(content)
+            self._register(content)
+
+    def _check_ancestry(self, content):
+        '''For an object to be added to another we require that they
+        share a common ancestor. This means that the added object must
+        have the current object or one of its ancestors as an
+        ancestor. Raises a RuntimeError if this is not the case.'''
+        # Loop over the ancestors of this object (starting with itself)
+        self_ancestor = self.root
+        while self_ancestor:
+            # Loop over the ancestors of the object being added
+            obj_parent = content.root.parent
+            while (obj_parent != self_ancestor and
+                   getattr(obj_parent, 'parent', None)):
+                obj_parent = obj_parent.parent
+            if obj_parent == self_ancestor:
+                break
+            # Object being added is not an ancestor of the current
+            # self_ancestor so move one level back up the tree and
+            # try again
+            if getattr(self_ancestor, 'parent', None):
+                self_ancestor = self_ancestor.parent
+            else:
+                break
+
+        if obj_parent != self_ancestor:
+            raise RuntimeError(
+                "Cannot add '{0}' to '{1}' because it is not a descendant "
+                "of it or of any of its ancestors.".
+                format(str(content), str(self)))
+
+    def check(self):
+        ''' Checks that all of our children share a common ancestor
+        with us '''
+        for child in self.children:
+            self._check_ancestry(child)
 
     def _skip_use_and_comments(self, index):
         ''' skip over any use statements and comments in the ast '''
@@ -270,6 +558,22 @@ end module vanilla
         if implicitnone:
             self.add(ImplicitNoneGen(self))
 
+    def render(self, line_length=None, jobs=None):
+        '''Returns the Fortran for this module (see BaseGen.render()). If
+        jobs is greater than one then the subroutines that the module
+        contains are rendered in that many worker processes.'''
+        from fgenerator.render import render_parallel
+        return render_parallel(self.root, jobs, line_length=line_length)
+
+    def write_to(self, path, line_length=None, jobs=None):
+        '''Writes the Fortran for this module (see render()) to the file
+        path unless that file already contains the same code, in which
+        case it is not touched so that its timestamp does not change.
+        Returns True if the file was written and False otherwise.'''
+        from fgenerator.output import write_if_changed
+        return write_if_changed(
+            path, self.render(line_length=line_length, jobs=jobs) + "\n")
+
     def add_raw_subroutine(self, content):
         ''' adds a subroutine to the module that is a raw f2py parse object.
             This is used for inlining kernel subroutines into a module.
@@ -300,12 +604,16 @@ class CommentGen(BaseGen):
 
 class DirectiveGen(BaseGen):
     ''' Base class for creating a Fortran directive. This is then sub-classed
-    to support different types of directive, e.g. OpenMP or OpenACC. '''
-    def __init__(self, parent, language, position, directive_type, content):
+    to support different types of directive, e.g. OpenMP or OpenACC. Any
+    keyword arguments set the structured clauses of an OpenMP directive
+    (see OMPDirective.set_clauses()). '''
+    def __init__(self, parent, language, position, directive_type, content,
+                 **clauses):
 
         self._supported_languages = ["omp"]
         self._language = language
         self._directive_type = directive_type
+        self._position = position
 
         reader = FortranStringReader("! content\n")
         reader.set_mode(True, True)  # free form, strict
@@ -313,13 +621,9 @@ class DirectiveGen(BaseGen):
 
         if language == "omp":
             my_comment = OMPDirective(parent.root, subline, position,
-                                      directive_type)
-            my_comment.content = "$omp"
-            if position == "end":
-                my_comment.content += " end"
-            my_comment.content += " " + directive_type
-            if content != "":
-                my_comment.content += " " + content
+                                      directive_type, **clauses)
+            my_comment.clause_text = content
+            my_comment.update()
         else:
             raise RuntimeError(
                 "Error, unsupported directive language. Expecting one of "
@@ -328,16 +632,86 @@ class DirectiveGen(BaseGen):
 
         BaseGen.__init__(self, parent, my_comment)
 
+    def check(self):
+        ''' Checks the type and position of the directive '''
+        if self._language == "omp":
+            self.root.check()
+
+    def infer_clauses(self):
+        '''Analyses the loop that follows this (begin) loop directive,
+        e.g. "parallel do" or "simd", and adds private, reduction and
+        (for "parallel do", "parallel do simd" and "taskloop") shared
+        clauses for the variables that it references to the clauses that
+        the directive was created with (which should not themselves list
+        any of them). Private scalars whose values may be used after the
+        loop are made lastprivate. For "parallel do", reductions into
+        loop-invariant array elements, which cannot be given in a
+        reduction clause, are made into reductions into per-thread
+        partial results that are combined after the loop (see
+        fgenerator.openmp.add_partial_reductions). Returns a list of
+        descriptions of the statements in the loop that may cause races
+        between threads.'''
+        from fparser.block_statements import Do
+        from fgenerator.base import index_of_object
+        from fgenerator.openmp import analyse_loop, add_partial_reductions
+        if self._language != "omp" or not self.root.associated_loops:
+            raise RuntimeError(
+                "Clauses can only be inferred for the beginning of an omp "
+                "loop directive but found '{0}'".format(
+                    str(self.root).strip()))
+        content = self.parent.root.content
+        loop = None
+        for stmt in content[index_of_object(content, self.root) + 1:]:
+            if not isinstance(stmt, Comment):
+                loop = stmt
+                break
+        if not isinstance(loop, Do):
+            raise RuntimeError(
+                "Expected '{0}' to be followed by a do loop but found "
+                "'{1}'".format(str(self.root).strip(), str(loop).strip()))
+        scope = self.parent
+        while scope is not None and not isinstance(scope, ProgUnitGen):
+            scope = scope.parent
+        sharing = analyse_loop(loop, scope)
+        private = sharing.private
+        shared = sharing.shared
+        if sharing.partials and self._directive_type == "parallel do":
+            new_private, new_shared = add_partial_reductions(
+                self, loop, scope, sharing.partials)
+            private = sorted(private + new_private)
+            shared = sorted(shared + new_shared)
+        else:
+            for partial in sharing.partials:
+                sharing.races.append(
+                    "'{0}' is a reduction into an element of '{1}', which "
+                    "is only supported for a 'parallel do'".format(
+                        str(partial.stmt).strip(), partial.name))
+        clauses = [self.root.clause_text] if self.root.clause_text else []
+        if private:
+            clauses.append("private({0})".format(",".join(private)))
+        if sharing.lastprivate:
+            clauses.append("lastprivate({0})".format(
+                ",".join(sharing.lastprivate)))
+        ops = {}
+        for name, op in sorted(sharing.reductions.items()):
+            ops.setdefault(op, []).append(name)
+        for op, names in sorted(ops.items()):
+            clauses.append("reduction({0}:{1})".format(op, ",".join(names)))
+        if shared and self._directive_type in ["parallel do",
+                                               "parallel do simd",
+                                               "taskloop"]:
+            clauses.append("shared({0})".format(",".join(shared)))
+        self.root.clause_text = ", ".join(clauses)
+        self.root.update()
+        return sharing.races
+
 
 class ImplicitNoneGen(BaseGen):
     ''' Generate a Fortran 'implicit none' statement '''
     def __init__(self, parent):
 
-        if not isinstance(parent, ModuleGen) and not isinstance(parent,
-                                                                SubroutineGen):
-            raise Exception(
-                "The parent of ImplicitNoneGen must be a module or a "
-                "subroutine, but found {0}".format(type(parent)))
+        if checks_enabled():
+            self._check_parent(parent)
         reader = FortranStringReader("IMPLICIT NONE\n")
         reader.set_mode(True, True)  # free form, strict
         subline = reader.next()
@@ -347,6 +721,19 @@ class ImplicitNoneGen(BaseGen):
 
         BaseGen.__init__(self, parent, my_imp_none)
 
+    @staticmethod
+    def _check_parent(parent):
+        ''' Checks that the parent is a module or a subroutine '''
+        if not isinstance(parent, ModuleGen) and not isinstance(parent,
+                                                                SubroutineGen):
+            raise Exception(
+                "The parent of ImplicitNoneGen must be a module or a "
+                "subroutine, but found {0}".format(type(parent)))
+
+    def check(self):
+        ''' Checks that our parent is a module or a subroutine '''
+        self._check_parent(self.parent)
+
 
 class SubroutineGen(ProgUnitGen):
     ''' Generate a Fortran subroutine '''
@@ -369,15 +756,22 @@ class SubroutineGen(ProgUnitGen):
         if implicitnone:
             self.add(ImplicitNoneGen(self))
 
+    def _reserved_names(self):
+        ''' Returns the (lower-cased) names of this subroutine and its
+        arguments, which a new name must not clash with '''
+        names = ProgUnitGen._reserved_names(self)
+        names.update(arg.lower() for arg in self._root.args)
+        return names
+
     @property
     def args(self):
         ''' Returns the list of arguments of this subroutine '''
-        return self._sub.args
+        return self.root.args
 
     @args.setter
     def args(self, namelist):
         ''' sets the subroutine arguments to the values in the list provide.'''
-        self._sub.args = namelist
+        self.root.args = namelist
 
 
 class CallGen(BaseGen):
@@ -533,11 +927,6 @@ class TypeDeclGen(BaseGen):
         ''' Returns the names of the variables being declared '''
         return self._names
 
-    @property
-    def root(self):
-        ''' Returns the associated Type object '''
-        return self._typedecl
-
 
 class TypeSelect(Select):
     ''' Generate a Fortran SELECT TYPE statement '''
@@ -564,6 +953,88 @@ class TypeCase(Case):
         return tab + type_str
 
 
+def _adjacent_case(entry, value, content):
+    '''Returns True if value is the integer following the last value of
+    the single range in entry and content generates the same code as
+    entry's content '''
+    items, entry_content = entry
+    if len(items) != 1 or len(content) != len(entry_content):
+        return False
+    try:
+        if int(value) != int(items[0][-1]) + 1:
+            return False
+    except ValueError:
+        return False
+    return all(str(stmt.root) == str(entry_stmt.root) for stmt, entry_stmt
+               in zip(content, entry_content))
+
+
+def _add_dispatch_table(module, select, table, keys, args, interface):
+    '''Declares a table of procedure pointers, indexed by keys, in the
+    specification part of module and replaces the select block select
+    with code that initialises the table on first use (within an OpenMP
+    critical section so that it is safe within a parallel region) and
+    then calls the procedure selected by the select expression, if there
+    is one. The only memory fences are within the initialisation, so
+    the dispatch itself has none. '''
+    from fparser import api
+    from fparser.statements import Contains
+    from fgenerator.base import index_of_object
+    entry_type = module.new_name("dispatch_entry")
+    name = module.new_name("dispatch_table")
+    init = module.new_name("dispatch_init")
+    code = (
+        "module vanilla\n"
+        "type :: {0}\n"
+        "procedure({1}), pointer, nopass :: proc => null()\n"
+        "end type {0}\n"
+        "type({0}), save :: {2}({3}:{4})\n"
+        "logical, save :: {5} = .false.\n"
+        "end module vanilla\n".format(entry_type, interface, name,
+                                       keys[0], keys[-1], init))
+    tree = api.parse(code, ignore_comments=False, analyze=False)
+    decls = tree.content[0].content[:-1]
+    for decl in decls:
+        decl.parent = module.root
+        decl.top = module.root.top
+    index = len(module.root.content) - 1
+    for idx, stmt in enumerate(module.root.content):
+        if isinstance(stmt, Contains):
+            index = idx
+            break
+    module.root.content[index:index] = decls
+
+    parent = select.parent
+    expr = select.root.expr
+    # Check the flag again within the critical section in case another
+    # thread has initialised the table since it was first checked
+    ifthen = IfThenGen(parent, ".NOT. " + init)
+    ifthen.add(DirectiveGen(ifthen, "omp", "begin", "critical",
+                            "(" + name + ")"))
+    fill = IfThenGen(ifthen, ".NOT. " + init)
+    ifthen.add(fill)
+    for key in keys:
+        fill.add(AssignGen(fill, lhs="{0}({1})%proc".format(name, key),
+                           rhs=table[key], pointer=True))
+    # Make the table visible to other threads before the flag is set.
+    # The end of the critical section flushes again so the threads that
+    # initialise, or wait to initialise, the table see it complete.
+    fill.add(DirectiveGen(fill, "omp", "begin", "flush", ""))
+    fill.add(AssignGen(fill, lhs=init, rhs=".TRUE."))
+    ifthen.add(DirectiveGen(ifthen, "omp", "end", "critical",
+                            "(" + name + ")"))
+    # Fortran does not short-circuit logical operators so the bounds must
+    # be checked before the pointer is examined
+    in_range = IfThenGen(parent, "{0} >= {1} .AND. {0} <= {2}".format(
+        expr, keys[0], keys[-1]))
+    entry = "{0}({1})%proc".format(name, expr)
+    associated = IfThenGen(in_range, "ASSOCIATED({0})".format(entry))
+    in_range.add(associated)
+    associated.add(CallGen(associated, name=entry, args=args))
+    index = index_of_object(parent.root.content, select.root)
+    parent.root.content[index:index + 1] = [ifthen.root, in_range.root]
+
+
 class SelectionGen(BaseGen):
     ''' Generate a Fortran SELECT block '''
     # TODO can this whole class be deleted?
@@ -590,18 +1061,86 @@ class SelectionGen(BaseGen):
 
     def addcase(self, casenames, content=None):
         ''' Add a case to this select block '''
-        if content is None:
-            content = []
-        if self._typeselect:
-            case = TypeCase(self.root, self._case_line)
-        else:
-            case = Case(self.root, self._case_line)
-        case.items = [casenames]
-        self.root.content.insert(0, case)
-        idx = 0
-        for stmt in content:
-            idx += 1
-            self.root.content.insert(idx, stmt.root)
+        self.addcases([(casenames, content)])
+
+    def addcases(self, table, merge_ranges=False):
+        '''Add a case for each (casenames, content) pair in table, in
+        order, before any default case. casenames may be a single value
+        or a list of values and content a list of the statements to
+        place in the case. All cases are added to this select block in
+        a single splice. If merge_ranges is True then consecutive
+        entries with single, adjacent integer values and identical
+        content are merged into one CASE ( lo : hi ). '''
+        entries = []
+        for casenames, content in table:
+            if content is None:
+                content = []
+            if not isinstance(casenames, (list, tuple)):
+                casenames = [casenames]
+            items = [[str(name)] for name in casenames]
+            if merge_ranges and entries and len(items) == 1:
+                previous = entries[-1]
+                if _adjacent_case(previous, items[0][0], content):
+                    previous[0][0][1:] = [items[0][0]]
+                    continue
+            entries.append((items, content))
+        stmts = []
+        for items, content in entries:
+            if self._typeselect:
+                case = TypeCase(self.root, self._case_line)
+            else:
+                case = Case(self.root, self._case_line)
+            case.items = items
+            stmts.append(case)
+            stmts.extend(stmt.root for stmt in content)
+        index = len(self.root.content) - 1
+        for idx, stmt in enumerate(self.root.content):
+            if isinstance(stmt, Case) and not stmt.items:
+                index = idx
+                break
+        self.root.content[index:index] = stmts
+
+    def adddispatch(self, table, args=None, interface=None,
+                    min_density=0.5):
+        '''Add a call for each (integer) key in the dictionary table to
+        the subroutine named by the corresponding value, passing the
+        arguments args. If the keys are dense enough (the number of keys
+        divided by the size of the range they span is at least
+        min_density) then this select block is replaced, within its
+        parent, by an indexed call through a module-level table of
+        procedure pointers that is initialised on first use, otherwise
+        a case is added for each key. As with the select block, nothing
+        is called if the select expression does not take one of the
+        values in table. The table is only used if this select block
+        has no cases already. interface names the procedure that defines
+        the interface of the table's pointers and defaults to the first
+        procedure in table. Returns True if the table is used and False
+        otherwise.'''
+        if args is None:
+            args = []
+        keys = sorted(table, key=int)
+        if not keys:
+            return False
+        low = int(keys[0])
+        high = int(keys[-1])
+        has_cases = [stmt for stmt in self.root.content
+                     if isinstance(stmt, Case)]
+        if self._typeselect or has_cases or \
+           float(len(keys)) / (high - low + 1) < min_density:
+            self.addcases([(key, [CallGen(self, name=table[key], args=args)])
+                           for key in keys])
+            return False
+        module = self.parent
+        while module is not None and not isinstance(module, ModuleGen):
+            module = module.parent
+        if module is None:
+            raise RuntimeError(
+                "SelectionGen.adddispatch() requires the select block to "
+                "be within a ModuleGen")
+        if interface is None:
+            interface = table[keys[0]]
+        _add_dispatch_table(module, self, table, keys, args, interface)
+        return True
 
     def adddefault(self):
         ''' Add the default case to this select block '''
@@ -711,3 +1250,133 @@ class AssignGen(BaseGen):
         self._assign.expr = rhs
         self._assign.variable = lhs
         BaseGen.__init__(self, parent, self._assign)
+
+
+class TemplateGen(object):
+    '''A block of Fortran containing placeholder names. The code is
+    parsed once, when the template is created, and may then be
+    instantiated many times, each time replacing the placeholders with
+    different names or expressions, without re-parsing it. The code
+    should consist of executable statements. Placeholders are replaced
+    (case insensitively) wherever they are used as variables, which are
+    found with fparser's Fortran 2003 expression parser, but not where
+    they name a component of a derived type or an argument keyword.
+    Expressions are substituted as supplied, so should be enclosed in
+    parentheses if required.'''
+
+    # Attributes of fparser nodes that do not contain Fortran code
+    _skip_attributes = set(["parent", "item", "reader", "top", "a",
+                            "content", "programblock", "get_item",
+                            "put_item", "blocktype", "isvalid", "ignore",
+                            "_gen"])
+
+    def __init__(self, code, placeholders=None):
+        from fparser import api
+        if placeholders is None:
+            placeholders = []
+        self._placeholders = set(name.lower() for name in placeholders)
+        tree = api.parse("subroutine template\n" + code.strip("\n") +
+                         "\nend subroutine template\n",
+                         ignore_comments=False, analyze=False)
+        # skip the final 'end subroutine'
+        self._plan = [self._compile(stmt) for stmt in
+                      tree.content[0].content[:-1]]
+
+    @property
+    def placeholders(self):
+        ''' Returns the (lower-cased) names of the placeholders '''
+        return sorted(self._placeholders)
+
+    def _compile(self, stmt):
+        '''Returns a tuple containing the supplied fparser node, a list of
+        the names and marked values (see _mark_names()) of its attributes
+        that contain placeholders and the compiled form of its content
+        (or None if it has no content)'''
+        from fparser.base_classes import BeginStatement
+        attributes = []
+        if self._placeholders:
+            for name, value in vars(stmt).items():
+                if name not in self._skip_attributes:
+                    marked = self._mark(value, name == "loopcontrol")
+                    if marked != value:
+                        attributes.append((name, marked))
+        content = None
+        if isinstance(stmt, BeginStatement):
+            content = [self._compile(child) for child in stmt.content]
+        return stmt, attributes, content
+
+    def _mark(self, value, assignment):
+        ''' Returns the supplied attribute value (a string or a possibly
+        nested list or tuple of strings) with the placeholders that it
+        uses as variables marked '''
+        if isinstance(value, basestring):
+            return _mark_names(value, self._placeholders, assignment)
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._mark(item, assignment)
+                               for item in value)
+        return value
+
+    def _substitute(self, value, values):
+        ''' Returns a copy of the supplied marked attribute value with the
+        placeholders replaced by their values '''
+        if isinstance(value, basestring):
+            return _fill_names(value, values)
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._substitute(item, values)
+                               for item in value)
+        return value
+
+    def _check_values(self, values):
+        ''' Returns the supplied values keyed by lower-cased placeholder
+        name, checking that there is one for every placeholder '''
+        lower_values = dict((name.lower(), str(value)) for name, value
+                            in values.items())
+        missing = self._placeholders - set(lower_values)
+        unknown = set(lower_values) - self._placeholders
+        if missing or unknown:
+            raise RuntimeError(
+                "TemplateGen requires values for the placeholders {0} but "
+                "was not given {1} and was given unknown names {2}".format(
+                    self.placeholders, sorted(missing), sorted(unknown)))
+        return lower_values
+
+    def instantiate(self, parent, values=None):
+        '''Returns a list of new fparser nodes for the code in this
+        template with the placeholders replaced by the supplied values (a
+        dictionary keyed by placeholder name). The nodes have the root of
+        the Gen object parent as their parent but are not added to it.'''
+        from fgenerator.base import copy_node
+        if values is None:
+            values = {}
+        lower_values = self._check_values(values)
+
+        def build(plan, parent_node):
+            ''' Returns a copy of the fparser node in plan '''
+            stmt, attributes, content = plan
+            new_stmt = copy_node(stmt)
+            for name, marked in attributes:
+                setattr(new_stmt, name,
+                        self._substitute(marked, lower_values))
+            new_stmt.parent = parent_node
+            new_stmt.top = getattr(parent_node, "top", None)
+            if content is not None:
+                new_stmt.content = [build(child, new_stmt)
+                                    for child in content]
+            return new_stmt
+
+        parent_node = parent.root
+        return [build(plan, parent_node) for plan in self._plan]
+
+    def add_to(self, parent, values=None, position=None):
+        '''Instantiates this template (see instantiate()) and inserts the
+        resulting code into the Gen object parent in a single operation.
+        By default the code is added to the end of the body of parent
+        (before its end statement), otherwise position is interpreted as
+        in BaseGen.add(). Returns the list of new fparser nodes.'''
+        stmts = self.instantiate(parent, values)
+        if position is None:
+            index = len(parent.root.content) - 1
+        else:
+            index = parent._position_index(position)
+        parent.root.content[index:index] = stmts
+        return stmts
@@ -0,0 +1,202 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+'''This module supports incremental regeneration of a set of generated
+modules. A manifest, stored in the output directory, records a
+fingerprint of the inputs that each output file was generated from:
+the input (e.g. specification) files, the source files of the python
+callable that generates it and of the modules in its package that it
+(transitively) imports, and the parameters passed to that callable.
+On the next run only the modules whose fingerprint has changed (or
+whose output file is missing) are regenerated.'''
+
+import ast
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import sys
+
+from fgenerator.output import write_if_changed
+
+# The name of the manifest file within the output directory
+MANIFEST_NAME = ".fgenerator_manifest.json"
+
+
+class Regenerator(object):
+    '''Regenerates the modules in output_dir whose inputs have changed
+    since the previous run. Each module is registered with add() and
+    run() then regenerates those that are out of date.'''
+
+    def __init__(self, output_dir):
+        self._output_dir = output_dir
+        self._targets = []
+        self._imports = {}
+        self._manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        self._manifest = {"version": 1, "files": {}, "outputs": {}}
+        if os.path.isfile(self._manifest_path):
+            with open(self._manifest_path) as manifest_file:
+                try:
+                    manifest = json.load(manifest_file)
+                except ValueError:
+                    manifest = None
+            if manifest and manifest.get("version") == 1:
+                self._manifest = manifest
+
+    def add(self, filename, generator, inputs=None, params=None):
+        '''Registers the output file filename (relative to the output
+        directory). The ModuleGen for it is created by calling
+        generator(**params) and depends on the files in the list inputs
+        as well as on the source files of generator and of the modules in
+        its package that it imports. params must be JSON-serialisable
+        (as it is recorded in the manifest).'''
+        if inputs is None:
+            inputs = []
+        if params is None:
+            params = {}
+        try:
+            json.dumps(params, sort_keys=True)
+        except (TypeError, ValueError) as err:
+            raise RuntimeError(
+                "The params for '{0}' must be JSON-serialisable (strings, "
+                "numbers, booleans, None, lists and dicts with string "
+                "keys) but {1}".format(filename, err))
+        self._targets.append((filename, generator, list(inputs), params))
+
+    def _file_digest(self, path, files):
+        '''Returns the sha1 digest (as hex) of the file path, reusing the
+        digest recorded in the previous manifest if the file's size and
+        modification time have not changed. Records the digest in the
+        dictionary files.'''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = [stat.st_mtime, stat.st_size]
+        previous = self._manifest["files"].get(path)
+        if previous is not None and previous[:2] == key:
+            digest = previous[2]
+        else:
+            sha = hashlib.sha1()
+            with open(path, "rb") as in_file:
+                sha.update(in_file.read())
+            digest = sha.hexdigest()
+        files[path] = key + [digest]
+        return digest
+
+    def _imported(self, name, package):
+        '''Returns the names of the modules in package that are imported
+        (anywhere, including within functions) by the module name.'''
+        if name in self._imports:
+            return self._imports[name]
+        self._imports[name] = []
+        source = inspect.getsourcefile(sys.modules[name])
+        with open(source) as source_file:
+            tree = ast.parse(source_file.read(), source)
+        is_package = os.path.splitext(
+            os.path.basename(source))[0] == "__init__"
+        candidates = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                candidates.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                base = node.module or ""
+                if node.level:
+                    parent = name.split(".")
+                    if not is_package:
+                        parent = parent[:-1]
+                    parent = parent[:len(parent) - node.level + 1]
+                    base = ".".join(parent + ([base] if base else []))
+                candidates.append(base)
+                candidates.extend(base + "." + alias.name
+                                  for alias in node.names)
+        imported = []
+        for candidate in candidates:
+            if candidate.split(".")[0] != package or \
+               candidate in imported:
+                continue
+            try:
+                importlib.import_module(candidate)
+            except ImportError:
+                # e.g. "from package.module import function"
+                continue
+            imported.append(candidate)
+        self._imports[name] = imported
+        return imported
+
+    def _sources(self, generator):
+        '''Returns the source file of generator followed by the source
+        files of the modules in its package (the top-level package
+        containing generator's module) that its module imports, directly
+        or indirectly.'''
+        package = generator.__module__.split(".")[0]
+        names = [generator.__module__]
+        for name in names:
+            names.extend(imported for imported in
+                         self._imported(name, package)
+                         if imported not in names)
+        source = inspect.getsourcefile(generator)
+        sources = set(inspect.getsourcefile(sys.modules[name])
+                      for name in names[1:])
+        return [source] + sorted(sources - set([source, None]))
+
+    def _fingerprint(self, generator, inputs, params, files):
+        ''' Returns the fingerprint of an output file '''
+        sha = hashlib.sha1()
+        sha.update("{0}.{1}\n".format(generator.__module__,
+                                      generator.__name__))
+        for path in self._sources(generator) + sorted(inputs):
+            sha.update(path + "\n" + self._file_digest(path, files) + "\n")
+        sha.update(json.dumps(params, sort_keys=True))
+        return sha.hexdigest()
+
+    def run(self, line_length=None, jobs=None):
+        '''Regenerates, and writes, each registered module whose
+        fingerprint differs from that in the manifest or whose output
+        file does not exist and then updates the manifest. Returns the
+        list of the names of the output files that were regenerated.'''
+        files = {}
+        outputs = {}
+        regenerated = []
+        for filename, generator, inputs, params in self._targets:
+            fingerprint = self._fingerprint(generator, inputs, params, files)
+            path = os.path.join(self._output_dir, filename)
+            if self._manifest["outputs"].get(filename) != fingerprint or \
+               not os.path.isfile(path):
+                module = generator(**params)
+                module.write_to(path, line_length=line_length, jobs=jobs)
+                regenerated.append(filename)
+            outputs[filename] = fingerprint
+        self._manifest = {"version": 1, "files": files, "outputs": outputs}
+        write_if_changed(self._manifest_path,
+                         json.dumps(self._manifest, indent=1,
+                                    sort_keys=True) + "\n")
+        return regenerated
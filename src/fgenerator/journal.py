@@ -0,0 +1,253 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+'''This module provides a journal of edits (insertions, removals and
+replacements of statements) to a tree of Gen objects or to an existing
+fparser tree. The edits are queued and then applied together, in a
+single pass over the content of each block that they affect, so that
+the cost does not depend on the number of edits made to a block and
+indices given for one edit are not shifted by another. Once applied the
+edits can be rolled back, e.g. if the resulting tree fails validation.
+
+    with module.edits() as edits:
+        edits.insert_before(loop, CommentGen(sub, " start"))
+        edits.remove(old_call)
+    if not acceptable(module):
+        edits.rollback()
+'''
+
+from fparser.base_classes import BeginStatement, EndStatement
+
+
+def _node(obj):
+    ''' Returns the fparser node of obj, which may be a Gen object '''
+    return getattr(obj, "root", obj)
+
+
+def _nodes(objs):
+    ''' Returns the fparser nodes of obj, a Gen object or fparser node
+    or a list of them '''
+    if not isinstance(objs, (list, tuple)):
+        objs = [objs]
+    return [_node(obj) for obj in objs]
+
+
+class EditJournal(object):
+    '''A queue of edits to be applied together by commit(), which is
+    called automatically at the end of a with block (unless it raises
+    an exception, in which case the edits are discarded). Containers,
+    anchors and statements may be given as Gen objects or as fparser
+    nodes. Indices and anchors refer to the content of a block as it
+    was before any of the queued edits. If tree (the root of an fparser
+    tree) is supplied then only blocks within that tree may be edited.'''
+
+    def __init__(self, tree=None):
+        self._tree = tree
+        # the queued edits of each container, keyed by id
+        self._containers = {}
+        self._edits = {}
+        self._indices = {}
+        self._order = []
+        self._applied = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+        return False
+
+    def _container(self, container):
+        ''' Returns the queued edits for the fparser block container '''
+        key = id(container)
+        if key not in self._edits:
+            if not isinstance(container, BeginStatement):
+                raise RuntimeError(
+                    "Edits can only be made to the content of a block "
+                    "statement but found '{0}'".format(
+                        type(container).__name__))
+            if self._tree is not None and \
+               getattr(container, "top", container) is not self._tree:
+                raise RuntimeError(
+                    "Edits can only be made to the tree that the journal "
+                    "was created for but '{0}' is in a different "
+                    "tree".format(type(container).__name__))
+            self._containers[key] = container
+            self._edits[key] = ({}, set())
+            self._order.append(key)
+        return self._edits[key]
+
+    def _index(self, anchor):
+        ''' Returns the block containing the fparser node anchor and the
+        index of anchor in its content '''
+        container = anchor.parent
+        self._container(container)
+        key = id(container)
+        if key not in self._indices:
+            self._indices[key] = dict(
+                (id(stmt), idx) for idx, stmt in
+                enumerate(container.content))
+        try:
+            return container, self._indices[key][id(anchor)]
+        except KeyError:
+            raise RuntimeError(
+                "'{0}' is not in the content of its parent".format(
+                    type(anchor).__name__))
+
+    def insert(self, container, index, objs):
+        '''Queues the insertion of objs (one or a list of statements) at
+        index in the content of container '''
+        container = _node(container)
+        inserts, _ = self._container(container)
+        if index < 0 or index > len(container.content):
+            raise RuntimeError(
+                "Index {0} is out of range for a block with {1} "
+                "statements".format(index, len(container.content)))
+        inserts.setdefault(index, []).extend(_nodes(objs))
+
+    def append(self, container, objs):
+        '''Queues the insertion of objs at the end of the content of
+        container (before its end statement, if it has one) '''
+        container = _node(container)
+        index = len(container.content)
+        if index and isinstance(container.content[-1], EndStatement):
+            index -= 1
+        self.insert(container, index, objs)
+
+    def insert_before(self, anchor, objs):
+        ''' Queues the insertion of objs before the statement anchor '''
+        container, index = self._index(_node(anchor))
+        self.insert(container, index, objs)
+
+    def insert_after(self, anchor, objs):
+        ''' Queues the insertion of objs after the statement anchor '''
+        container, index = self._index(_node(anchor))
+        self.insert(container, index + 1, objs)
+
+    def remove(self, obj):
+        ''' Queues the removal of the statement obj '''
+        container, index = self._index(_node(obj))
+        self._container(container)[1].add(index)
+
+    def replace(self, obj, objs):
+        ''' Queues the replacement of the statement obj by objs '''
+        container, index = self._index(_node(obj))
+        self._container(container)[1].add(index)
+        self.insert(container, index, objs)
+
+    def discard(self):
+        ''' Discards the queued edits '''
+        self._containers = {}
+        self._edits = {}
+        self._indices = {}
+        self._order = []
+
+    def commit(self):
+        '''Applies the queued edits, replacing the content list of each
+        affected block by a new list built in a single pass over the old
+        one. Symbol tables of affected modules and subroutines and any
+        ModifiedSource that the tree belongs to are updated.'''
+        applied = []
+        for key in self._order:
+            container = self._containers[key]
+            inserts, removals = self._edits[key]
+            old_content = container.content
+            content = []
+            inserted = []
+            for index in range(len(old_content) + 1):
+                for stmt in inserts.get(index, []):
+                    stmt.parent = container
+                    content.append(stmt)
+                    inserted.append(stmt)
+                if index < len(old_content) and index not in removals:
+                    content.append(old_content[index])
+            removed = [old_content[index] for index in sorted(removals)]
+            gen = container.__dict__.get("_gen")
+            state = _symbol_state(gen)
+            container.content = content
+            applied.append((container, old_content, inserted, removed,
+                            state))
+            _notify(container, gen, inserted, removed)
+        self.discard()
+        self._applied = applied
+
+    def rollback(self):
+        '''Undoes the edits applied by the last commit(), restoring the
+        original content lists and symbol tables '''
+        if not self._applied:
+            return
+        for container, old_content, inserted, removed, state in \
+                reversed(self._applied):
+            container.content = old_content
+            for stmt in removed:
+                stmt.parent = container
+            gen = container.__dict__.get("_gen")
+            if state is not None:
+                gen._symbols, gen._uses = state
+            recorder = getattr(getattr(container, "top", None), "_edits",
+                               None)
+            if recorder is not None:
+                for stmt in inserted:
+                    recorder.removed(stmt)
+                for stmt in removed:
+                    recorder.restored(stmt)
+        self._applied = None
+
+
+def _symbol_state(gen):
+    ''' Returns a copy of the symbol table of gen if it has one '''
+    if not hasattr(gen, "_symbols"):
+        return None
+    return (dict(gen._symbols),
+            dict((name, list(uses)) for name, uses in gen._uses.items()))
+
+
+def _notify(container, gen, inserted, removed):
+    '''Updates the symbol table of gen (the Gen object of container, if
+    it has one) and the ModifiedSource of the tree (if there is one) for
+    the statements inserted into and removed from container '''
+    if hasattr(gen, "_symbols"):
+        for stmt in removed:
+            if "_gen" in stmt.__dict__:
+                gen._unregister(stmt._gen)
+        for stmt in inserted:
+            if "_gen" in stmt.__dict__:
+                gen._register(stmt._gen)
+    recorder = getattr(getattr(container, "top", None), "_edits", None)
+    if recorder is not None:
+        for stmt in removed:
+            recorder.removed(stmt)
+        for stmt in inserted:
+            recorder.inserted(stmt)
@@ -31,34 +31,599 @@
 # Author R. Ford STFC Daresbury Lab
 #
 '''This module provides routines to modify an existing fparser
-tree. We are currently limited to adding a use statement as that is
-all that has been required so far.'''
+tree. We are currently limited to adding use statements as that is
+all that has been required so far. Edits made to the tree of a
+ModifiedSource are recorded so that they can be applied to the
+original source text (or output as a unified diff) without
+re-rendering, and so reformatting, the rest of the file.'''
+
+import sys
 
 from fparser.readfortran import FortranStringReader
 from fparser.block_statements import Use
+from fparser.statements import Comment
 import fparser
 
-def adduse(name, parent, only=False, funcnames=None):
-    '''Adds a use statement with the specified name to the supplied
-    object.  This routine is required when modifying an existing
-    fparser AST. '''
 
+def _record_insert(node):
+    ''' Records that node has been inserted into a tree if that tree
+    belongs to a ModifiedSource '''
+    recorder = getattr(getattr(node, "top", None), "_edits", None)
+    if recorder is not None:
+        recorder.inserted(node)
+
+
+def _program_unit(parent):
+    ''' Returns the program, module, subroutine or function that is, or
+    that encloses, the fparser statement parent '''
+    stmt = parent
+    while not _is_unit(stmt):
+        if isinstance(stmt, fparser.block_statements.BeginSource) or \
+           not hasattr(stmt, "parent"):
+            raise RuntimeError(
+                "The fparser '{0}' statement is not within a program, "
+                "module, subroutine or function".format(
+                    type(parent).__name__))
+        stmt = stmt.parent
+    return stmt
+
+
+def _new_use(parent, name, funcnames, only):
+    '''Returns a new use statement, within parent, of the module name
+    with the list of items funcnames, which is an only list if only is
+    True and a rename list otherwise '''
     reader = FortranStringReader("use kern,only : func1_kern=>func1")
     reader.set_mode(True, True)  # free form, strict
     myline = reader.next()
-
-    # find an appropriate place to add in our use statement
-    while not (isinstance(parent, fparser.block_statements.Program) or
-               isinstance(parent, fparser.block_statements.Module) or
-               isinstance(parent, fparser.block_statements.Subroutine)):
-        parent = parent.parent
     use = Use(parent, myline)
     use.name = name
     use.isonly = only
+    use.items = list(funcnames)
+    return use
+
+
+def adduse(name, parent, only=False, funcnames=None):
+    '''Adds a use statement with the specified name to the supplied
+    object.  This routine is required when modifying an existing
+    fparser AST. '''
+
+    # find an appropriate place to add in our use statement
+    parent = _program_unit(parent)
     if funcnames is None:
         funcnames = []
-        use.isonly = False
-    use.items = funcnames
+    use = _new_use(parent, name, funcnames, only)
 
     parent.content.insert(0, use)
+    _record_insert(use)
     return use
+
+
+def _item_names(item):
+    ''' Returns the (lower-cased) local name and module name of an item
+    in the only list of a use statement '''
+    local, _, used = item.partition("=>")
+    local = local.strip().lower()
+    return local, used.strip().lower() or local
+
+
+def _missing_items(name, items, funcnames):
+    '''Returns the items in funcnames that are not in the list items of
+    the only list of a use of module name (or earlier in funcnames).
+    Raises a RuntimeError if an item gives a local name to a different
+    entity of the module than an existing item does. '''
+    available = dict(_item_names(item) for item in items)
+    missing = []
+    for funcname in funcnames:
+        local, used = _item_names(funcname)
+        if local not in available:
+            available[local] = used
+            missing.append(funcname)
+        elif available[local] != used:
+            raise RuntimeError(
+                "Cannot use '{0}' from module '{1}' as the local name "
+                "'{2}' is already used for '{3}'".format(
+                    funcname, name, local, available[local]))
+    return missing
+
+
+def adduse_many(parent, uses):
+    '''Adds use statements to the program unit that is, or encloses,
+    the fparser statement parent. uses is a dictionary mapping module
+    names to the list of names required from each module (or to None
+    or an empty list if the whole module is required). A module that is
+    already used by the program unit is not used again: any names that
+    are missing from the only list of an existing use statement are
+    added to it (an item, such as "x=>y", is missing unless the same
+    local name already refers to the same entity and a RuntimeError is
+    raised if it refers to a different one). The new use statements are
+    added, in order of module name, in a single operation. Returns the
+    list of new use statements.'''
+    import copy
+    unit = _program_unit(parent)
+    recorder = getattr(getattr(unit, "top", None), "_edits", None)
+    # index the existing use statements, which must come first
+    existing = {}
+    for stmt in unit.content:
+        if isinstance(stmt, Use):
+            existing.setdefault(stmt.name.lower(), []).append(stmt)
+        elif not isinstance(stmt, Comment):
+            break
+    new_uses = []
+    template = None
+    for name, funcnames in sorted(uses.items()):
+        statements = existing.get(name.lower(), [])
+        if any(not stmt.isonly for stmt in statements):
+            # the whole module is already used
+            continue
+        if funcnames and statements:
+            missing = _missing_items(name, [item for stmt in statements
+                                            for item in stmt.items],
+                                     funcnames)
+            if missing:
+                statements[0].items.extend(missing)
+                if recorder is not None:
+                    recorder.changed(statements[0])
+            continue
+        if template is None:
+            template = _new_use(unit, name, [], False)
+        use = copy.copy(template)
+        use.name = name
+        use.isonly = bool(funcnames)
+        use.items = _missing_items(name, [], funcnames or [])
+        existing[name.lower()] = [use]
+        new_uses.append(use)
+    unit.content[0:0] = new_uses
+    for use in new_uses:
+        _record_insert(use)
+    return new_uses
+
+
+def _parse(text, name="<string>"):
+    '''Returns a new fparser tree for the Fortran source text. Unlike
+    fparser.api.parse() this never returns a tree from fparser's cache
+    (which is keyed by the id of the text and so may return the tree of
+    a different string that has since been freed) and does not add the
+    tree to that cache. Raises a RuntimeError naming the source (name)
+    if it cannot be parsed. '''
+    from fparser.parsefortran import FortranParser
+    reader = FortranStringReader(text)
+    reader.set_mode(reader.isfree, reader.isstrict)
+    FortranParser.cache.pop(reader.id, None)
+    parser = FortranParser(reader, ignore_comments=False)
+    try:
+        parser.parse()
+    except Exception as err:
+        raise RuntimeError, RuntimeError(
+            "Failed to parse '{0}': {1}".format(name, err)), \
+            sys.exc_info()[2]
+    finally:
+        FortranParser.cache.pop(reader.id, None)
+    if parser.block is None:
+        # fparser reports some errors by logging them and not creating
+        # a tree
+        raise RuntimeError(
+            "Failed to parse '{0}': fparser did not recognise the "
+            "source".format(name))
+    return parser.block
+
+
+def _last_line(node):
+    ''' Returns the (one-based) number of the last line of the original
+    source occupied by node and its content '''
+    from fparser.base_classes import BeginStatement
+    last = node.item.span[1]
+    if isinstance(node, BeginStatement) and node.content:
+        last = max(last, _last_line(node.content[-1]))
+    return last
+
+
+def _indentation(line):
+    ''' Returns the leading white space of line '''
+    return line[:len(line) - len(line.lstrip())]
+
+
+def _is_unit(stmt):
+    ''' Returns True if stmt is a program, module, subroutine or
+    function '''
+    from fparser.block_statements import Program, Module, Subroutine, \
+        Function
+    return isinstance(stmt, (Program, Module, Subroutine, Function))
+
+
+class UnitIndex(object):
+    '''An index, built in one traversal of an fparser tree, from the
+    names of the program units (programs, modules, subroutines and
+    functions, including those contained in other units) in the tree to
+    their nodes and the units that enclose them. Procedures declared in
+    interface blocks are not included. The index is kept up to date by
+    a ModifiedSource as statements are inserted and removed.'''
+
+    def __init__(self, tree):
+        self._units = {}
+        self._scopes = {}
+        self._add(tree, ())
+
+    def _add(self, root, scope):
+        ''' Adds the units in the tree starting at root, which is within
+        the units in scope, to the index '''
+        from fparser.base_classes import BeginStatement
+        from fparser.block_statements import Interface
+        todo = [(root, scope)]
+        while todo:
+            stmt, scope = todo.pop()
+            if _is_unit(stmt):
+                self._units.setdefault(stmt.name.lower(), []).append(stmt)
+                self._scopes[id(stmt)] = scope
+                scope = scope + (stmt,)
+            if isinstance(stmt, BeginStatement) and \
+               not isinstance(stmt, Interface):
+                todo.extend((child, scope) for child in
+                            reversed(stmt.content))
+
+    def inserted(self, node):
+        ''' Adds any units in the newly inserted statement node '''
+        from fparser.block_statements import Interface
+        scope = []
+        parent = getattr(node, "parent", None)
+        while parent is not None and hasattr(parent, "content"):
+            if isinstance(parent, Interface):
+                return
+            if _is_unit(parent):
+                scope.insert(0, parent)
+            parent = getattr(parent, "parent", None)
+        self._add(node, tuple(scope))
+
+    def removed(self, node):
+        ''' Removes any units in the removed statement node '''
+        for unit in UnitIndex(node).units():
+            units = self._units.get(unit.name.lower(), [])
+            units[:] = [stmt for stmt in units if stmt is not unit]
+            if not units:
+                self._units.pop(unit.name.lower(), None)
+            self._scopes.pop(id(unit), None)
+
+    def units(self):
+        ''' Returns a list of all of the units in the index '''
+        return [unit for units in self._units.values() for unit in units]
+
+    def find(self, name):
+        ''' Returns the list of units with the supplied name '''
+        return list(self._units.get(name.lower(), []))
+
+    def get(self, name, scope=None):
+        '''Returns the unit with the supplied name, which must be unique
+        among the units directly within the unit named scope if that is
+        supplied and among all units otherwise.'''
+        units = self.find(name)
+        if scope is not None:
+            units = [unit for unit in units if self._scopes[id(unit)] and
+                     self._scopes[id(unit)][-1].name.lower() ==
+                     scope.lower()]
+        if len(units) != 1:
+            raise RuntimeError(
+                "Expected one program unit called '{0}'{1} but found "
+                "{2}".format(name, "" if scope is None else
+                             " in '{0}'".format(scope), len(units)))
+        return units[0]
+
+    def scope(self, unit):
+        ''' Returns the units that enclose unit, outermost first '''
+        return self._scopes[id(unit)]
+
+
+class ModifiedSource(object):
+    '''The fparser tree of some Fortran source (available as tree, and
+    parsed from text unless it is supplied) together with a record of
+    the statements that have been inserted into, changed in or removed
+    from it. Statements inserted by the routines in this module are
+    recorded automatically; changes and removals made directly to the
+    tree must be reported with changed() and removed(). splice() then
+    returns the original text with just those statements replaced and
+    diff() a unified diff of the edits. '''
+
+    def __init__(self, text, name="<string>", tree=None):
+        self._name = name
+        self._lines = text.splitlines(True)
+        if tree is None:
+            tree = _parse(text, name)
+        self._tree = tree
+        self._tree._edits = self
+        self._inserted = []
+        self._changed = []
+        self._removed = []
+        self._units = None
+
+    @staticmethod
+    def fromfile(path, cache=None):
+        '''Returns a ModifiedSource for the Fortran in the file path. If
+        a ParseCache (see fgenerator.cache) is supplied then the tree is
+        taken from (or added to) it. '''
+        if cache is not None:
+            return cache.load(path)
+        with open(path) as in_file:
+            return ModifiedSource(in_file.read(), path)
+
+    @property
+    def tree(self):
+        ''' Returns the fparser tree of the source '''
+        return self._tree
+
+    @property
+    def name(self):
+        ''' Returns the name (path) of the source '''
+        return self._name
+
+    @property
+    def units(self):
+        ''' Returns the UnitIndex of the tree, which is built when it is
+        first needed '''
+        if self._units is None:
+            self._units = UnitIndex(self._tree)
+        return self._units
+
+    def _is_original(self, node):
+        ''' Returns True if node was parsed from the original source '''
+        item = getattr(node, "item", None)
+        return getattr(item, "reader", None) is self._tree.reader
+
+    def inserted(self, node):
+        ''' Records that node (and its content) has been inserted '''
+        self._inserted.append(node)
+        if self._units is not None:
+            self._units.inserted(node)
+
+    def changed(self, node):
+        '''Records that node (but not its content) has been changed in
+        place '''
+        if self._is_original(node):
+            self._changed.append(node)
+
+    def removed(self, node):
+        ''' Records that node (and its content) has been removed '''
+        if self._units is not None:
+            self._units.removed(node)
+        if self._is_original(node):
+            self._removed.append((node.item.span[0], _last_line(node)))
+        else:
+            self._inserted = [stmt for stmt in self._inserted
+                              if stmt is not node]
+
+    def restored(self, node):
+        ''' Records that node, which was recorded as removed, has been
+        put back '''
+        if self._units is not None:
+            self._units.inserted(node)
+        if self._is_original(node):
+            span = (node.item.span[0], _last_line(node))
+            if span in self._removed:
+                self._removed.remove(span)
+
+    def edits(self):
+        '''Returns a new EditJournal (see fgenerator.journal) with which
+        to queue edits to the tree and then apply them together. The
+        edits are recorded in this object when they are applied.'''
+        from fgenerator.journal import EditJournal
+        return EditJournal(self.tree)
+
+    def _render(self, node, reference, extra="", header=False):
+        '''Returns the lines of Fortran for node (just the statement
+        itself if header is True), re-indented so that the first line
+        has the same indentation as the (zero-based) line reference of
+        the original source, if there is one, followed by extra.'''
+        from fgenerator.render import render, render_statement
+        if header:
+            text = render_statement(node)
+        else:
+            text = render(node)
+        lines = text.split("\n")
+        if reference is None or reference >= len(self._lines):
+            return [line + "\n" for line in lines]
+        old = _indentation(lines[0])
+        new = _indentation(self._lines[reference]) + extra
+        result = []
+        for line in lines:
+            if line.startswith(old):
+                line = new + line[len(old):]
+            result.append(line + "\n")
+        return result
+
+    def _insertion(self, node):
+        '''Returns the (zero-based) line of the original source before
+        which node is to be inserted, the line whose indentation it
+        should have (and any indentation to add to it) and its index in
+        the content of its parent, or None if node is no longer in the
+        tree or is within another inserted statement '''
+        from fparser.base_classes import EndStatement
+        parent = node.parent
+        ancestor = parent
+        while ancestor is not None and ancestor is not self._tree:
+            if not self._is_original(ancestor):
+                return None
+            ancestor = getattr(ancestor, "parent", None)
+        content = parent.content
+        index = None
+        for idx, stmt in enumerate(content):
+            if stmt is node:
+                index = idx
+                break
+        if index is None:
+            return None
+        reference = None
+        for stmt in content[index + 1:]:
+            if self._is_original(stmt) and \
+               not isinstance(stmt, EndStatement):
+                reference = stmt.item.span[0] - 1
+                break
+        for stmt in reversed(content[:index]):
+            if self._is_original(stmt):
+                if reference is None:
+                    reference = stmt.item.span[0] - 1
+                return _last_line(stmt), (reference, ""), index
+        if parent is self._tree:
+            return 0, (reference, ""), index
+        if reference is None:
+            # indent by one level more than the enclosing statement
+            return (parent.item.span[1], (parent.item.span[0] - 1, "  "),
+                    index)
+        return parent.item.span[1], (reference, ""), index
+
+    def _edits(self):
+        '''Returns the list of edits to the original source as (start,
+        end, lines) tuples, sorted by position, where the (zero-based)
+        lines start to end (exclusive) are replaced by lines '''
+        edits = []
+        for start, end in self._removed:
+            edits.append((start - 1, end, -1, []))
+        for node in self._changed:
+            start, end = node.item.span
+            edits.append((start - 1, end, -1,
+                          self._render(node, start - 1, header=True)))
+        for node in self._inserted:
+            insertion = self._insertion(node)
+            if insertion is not None:
+                line, (reference, extra), index = insertion
+                edits.append((line, line, index,
+                              self._render(node, reference, extra)))
+        edits.sort(key=lambda edit: edit[:3])
+        result = []
+        end = 0
+        for start, stop, _, lines in edits:
+            if start < end:
+                # within a statement that has been removed or changed
+                continue
+            result.append((start, stop, lines))
+            end = stop
+        return result
+
+    def splice(self):
+        ''' Returns the original source text with the recorded edits
+        applied '''
+        output = []
+        position = 0
+        for start, end, lines in self._edits():
+            output.extend(self._lines[position:start])
+            output.extend(lines)
+            position = max(position, end)
+        output.extend(self._lines[position:])
+        return "".join(output)
+
+    def diff(self, context=3):
+        '''Returns the recorded edits as a unified diff of the original
+        source, with context lines of context around each change '''
+        edits = self._edits()
+        if not edits:
+            return ""
+        # group edits that are close enough to share context
+        hunks = []
+        for edit in edits:
+            if hunks and edit[0] - hunks[-1][-1][1] <= 2 * context:
+                hunks[-1].append(edit)
+            else:
+                hunks.append([edit])
+        output = ["--- {0}\n".format(self._name),
+                  "+++ {0}\n".format(self._name)]
+        offset = 0
+        for hunk in hunks:
+            old_start = max(0, hunk[0][0] - context)
+            old_end = min(len(self._lines), hunk[-1][1] + context)
+            body = []
+            position = old_start
+            new_length = 0
+            for start, end, lines in hunk:
+                body.extend(" " + line for line in
+                            self._lines[position:start])
+                body.extend("-" + line for line in self._lines[start:end])
+                body.extend("+" + line for line in lines)
+                new_length += (start - position) + len(lines)
+                position = end
+            body.extend(" " + line for line in self._lines[position:old_end])
+            new_length += old_end - position
+            old_length = old_end - old_start
+            new_start = old_start + offset
+            offset += new_length - old_length
+            output.append("@@ -{0} +{1} @@\n".format(
+                _hunk_range(old_start, old_length),
+                _hunk_range(new_start, new_length)))
+            output.extend(line if line.endswith("\n") else
+                          line + "\n\\ No newline at end of file\n"
+                          for line in body)
+        return "".join(output)
+
+    def write(self, path=None):
+        '''Writes the original source with the recorded edits applied to
+        path (by default the file it was read from) if that changes the
+        file. Returns True if the file was written. '''
+        from fgenerator.output import write_if_changed
+        if path is None:
+            path = self._name
+        return write_if_changed(path, self.splice())
+
+
+def _hunk_range(start, length):
+    ''' Returns the unified diff range for the zero-based line start '''
+    if length == 0:
+        return "{0},0".format(start)
+    if length == 1:
+        return "{0}".format(start + 1)
+    return "{0},{1}".format(start + 1, length)
+
+
+class FileResult(object):
+    '''The result of applying edits to a source file: whether the file
+    was changed and, if the edits failed, the error (a traceback)'''
+    def __init__(self, path, changed=False, error=None):
+        self.path = path
+        self.changed = changed
+        self.error = error
+
+
+# The edits and parse cache directory used by the worker processes of
+# apply_to_files(). Workers are forked and so inherit them.
+_BATCH = None
+
+
+def _apply_edits(path):
+    '''Applies the edits in _BATCH to the source file path. Runs in a
+    worker process (or serially). Returns a FileResult.'''
+    import traceback
+    edits, cache_dir = _BATCH
+    cache = None
+    if cache_dir is not None:
+        from fgenerator.cache import ParseCache
+        cache = ParseCache(cache_dir)
+    try:
+        source = ModifiedSource.fromfile(path, cache=cache)
+        for edit in edits:
+            edit(source)
+        return FileResult(path, changed=source.write())
+    except Exception:
+        return FileResult(path, error=traceback.format_exc())
+
+
+def apply_to_files(paths, edits, jobs=None, cache_dir=None):
+    '''Applies the list of edits to each of the source files in paths
+    and writes back those that change. Each edit is a callable that is
+    passed the ModifiedSource of the file (e.g. one that calls adduse()
+    on a statement of its tree). The files are processed in jobs worker
+    processes, which are forked and so need not pickle the edits, or
+    serially if jobs is less than two. If cache_dir is supplied then the
+    trees are taken from a ParseCache in that directory. Returns a list
+    with a FileResult for each file, in the order of paths; an error in
+    one file does not stop the others being processed.'''
+    import os
+    global _BATCH
+    _BATCH = (list(edits), cache_dir)
+    try:
+        if jobs is None or jobs < 2 or len(paths) < 2 or \
+           not hasattr(os, "fork"):
+            return [_apply_edits(path) for path in paths]
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try:
+            chunk_size = max(1, len(paths) // (jobs * 4))
+            return pool.map(_apply_edits, paths, chunk_size)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _BATCH = None
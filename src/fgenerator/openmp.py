@@ -0,0 +1,718 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+'''This module analyses the body of a loop that is to be parallelised
+with OpenMP to work out which variables must be private to each thread
+and which may be shared between them, to recognise reductions and to
+find statements that may cause a race between threads (including
+accesses to array elements that may be assigned in other iterations and
+private variables whose values may be used after the loop). The
+analysis is textual and only understands assignments, do loops,
+conditionals and calls (the actual arguments of which are assumed to
+be read but not written), so its results should be checked for loops
+containing anything else.'''
+
+import re
+
+from fparser.base_classes import BeginStatement, EndStatement
+from fparser.block_statements import Do
+from fparser.statements import Assignment, Call, Comment
+
+# A name in an expression, excluding the components of derived types,
+# the exponents of real literals and operators such as .and.
+_NAME = re.compile(r"(?<![\w.%])[A-Za-z_]\w*")
+_STRING = re.compile(r"'[^']*'|\"[^\"]*\"")
+_OPERATOR = re.compile(r"\.[A-Za-z]+\.")
+# The sign of the exponent of a real literal, which is not an operator
+_EXPONENT = re.compile(r"(?<![A-Za-z_])(\d+\.?\d*|\.\d+)[eEdD][+-]")
+
+# The precedence of the binary operators that may be used in a reduction
+# (and of those of lower precedence) and the intrinsic functions that
+# may be
+_PRECEDENCE = {"*": 3, "/": 3, "+": 2, "-": 2, "//": 1, "==": 0, "/=": 0,
+               "<": 0, "<=": 0, ">": 0, ">=": 0, ".eq.": 0, ".ne.": 0,
+               ".lt.": 0, ".le.": 0, ".gt.": 0, ".ge.": 0, ".and.": -1,
+               ".or.": -2, ".eqv.": -3, ".neqv.": -3}
+_REDUCTION_OPERATORS = ["+", "-", "*", ".and.", ".or.", ".eqv.", ".neqv."]
+_REDUCTION_INTRINSICS = ["max", "min", "iand", "ior", "ieor"]
+# The value with which each kind of reduction starts, given the variable
+_IDENTITY = {"+": "0", "*": "1", ".and.": ".true.", ".or.": ".false.",
+             ".eqv.": ".true.", ".neqv.": ".false.", "max": "-huge({0})",
+             "min": "huge({0})", "iand": "not(0)", "ior": "0", "ieor": "0"}
+# The number of elements in each row of a per-thread partial result
+# array. Only the first element is used, the rest pad the row to (at
+# least) a 64-byte cache line so that threads do not share cache lines.
+PARTIAL_PAD = 16
+
+
+def names(expr):
+    ''' Returns the (lower-cased) names referenced in the expression
+    expr, in the order in which they first appear '''
+    expr = _OPERATOR.sub(" ", _STRING.sub(" ", expr))
+    found = []
+    for match in _NAME.finditer(expr):
+        name = match.group(0).lower()
+        if name not in found:
+            found.append(name)
+    return found
+
+
+def _references(expr):
+    '''Returns a (lower-cased) name and its subscripts (the text within
+    the parentheses that follow it, or None if there are none) for each
+    name referenced in the expression expr'''
+    expr = _OPERATOR.sub(" ", _STRING.sub(" ", expr))
+    found = []
+    for match in _NAME.finditer(expr):
+        found.append((match.group(0).lower(),
+                      _subscripts(expr[match.end():])))
+    return found
+
+
+def _subscripts(text):
+    '''Returns the text within the parentheses at the start of text
+    (ignoring leading whitespace) or None if it does not start with
+    one'''
+    text = text.lstrip()
+    if not text.startswith("("):
+        return None
+    depth = 0
+    for index, char in enumerate(text):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return text[1:index]
+    return text[1:]
+
+
+def _element(subscripts, rank, positions):
+    '''Returns the (lower-cased, blank-free) subscripts, in the list of
+    dimensions positions, of an access with subscripts (the text within
+    its parentheses) to an array of rank dimensions, or None if the
+    access is not to a single element'''
+    if subscripts is None:
+        return None
+    parts = [part.replace(" ", "").lower() for part in
+             _split_args(subscripts)]
+    if len(parts) != rank:
+        return None
+    return tuple(parts[index] for index in positions)
+
+
+def _split_lhs(lhs):
+    '''Returns the (lower-cased) name of the variable assigned to by the
+    left-hand side lhs and the rest of the left-hand side (its
+    subscripts and components)'''
+    match = re.match(r"\s*(\w+)(.*)$", lhs)
+    return match.group(1).lower(), match.group(2).strip()
+
+
+def loop_variable(loop):
+    ''' Returns the (lower-cased) variable of the fparser Do loop '''
+    return loop.loopcontrol.split("=")[0].strip().lower()
+
+
+def _top_level(expr):
+    '''Returns expr (lower-cased) with strings, the contents of
+    parentheses and the signs of exponents blanked out so that only
+    its top-level operators remain'''
+    expr = _EXPONENT.sub(lambda match: match.group(0)[:-1] + " ",
+                         _STRING.sub(lambda match: " " * len(match.group(0)),
+                                     expr.lower()))
+    chars = []
+    depth = 0
+    for char in expr:
+        if char == ")":
+            depth -= 1
+        chars.append(char if depth == 0 else " ")
+        if char == "(":
+            depth += 1
+    return "".join(chars)
+
+
+def _lowest_precedence(expr):
+    '''Returns the lowest precedence of the binary operators at the top
+    level of expr, or None if there are none (a leading sign is
+    ignored)'''
+    top = _top_level(expr).strip()
+    top = top[1:] if top[:1] in "+-" else top
+    found = re.findall(r"\.[a-z]+\.|//|==|/=|<=|>=|[*/+<>-]", top)
+    precedences = [_PRECEDENCE[op] for op in found if op in _PRECEDENCE]
+    if not precedences:
+        return None
+    return min(precedences)
+
+
+def _strip_prefix(text, prefix):
+    '''Returns what follows prefix at the start of text, ignoring
+    whitespace and case, or None if text does not start with prefix'''
+    prefix = re.sub(r"\s+", "", prefix.lower())
+    index = 0
+    for char in prefix:
+        while index < len(text) and text[index].isspace():
+            index += 1
+        if index == len(text) or text[index].lower() != char:
+            return None
+        index += 1
+    return text[index:]
+
+
+def _balanced(expr):
+    ''' Returns True if the parentheses in expr are balanced '''
+    depth = 0
+    for char in _STRING.sub(" ", expr):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+
+def _split_args(args):
+    ''' Returns the top-level, comma-separated arguments in args '''
+    top = _top_level(args)
+    parts = []
+    start = 0
+    for index, char in enumerate(top):
+        if char == ",":
+            parts.append(args[start:index].strip())
+            start = index + 1
+    parts.append(args[start:].strip())
+    return parts
+
+
+def reduction(lhs, rhs):
+    '''Returns the reduction operator (e.g. '+' or 'max') and the value
+    being reduced if the assignment of rhs to lhs is a reduction (of the
+    form "s = s + expr", "s = expr * s", "s = max(s, expr)" etc.) and
+    None otherwise. A subtraction is returned as a '+' reduction of the
+    negated value.'''
+    name = _split_lhs(lhs)[0]
+    match = re.match(r"\s*(\w+)\s*\((.*)\)\s*$", rhs)
+    if match and match.group(1).lower() in _REDUCTION_INTRINSICS and \
+       _balanced(match.group(2)):
+        args = _split_args(match.group(2))
+        target = [arg for arg in args if
+                  _strip_prefix(arg, lhs) == ""]
+        values = [arg for arg in args if _strip_prefix(arg, lhs) != ""]
+        if len(target) != 1 or not values or \
+           [value for value in values if name in names(value)]:
+            return None
+        return match.group(1).lower(), ", ".join(values)
+    forms = []
+    rest = _strip_prefix(rhs, lhs)
+    if rest is not None:
+        for op in _REDUCTION_OPERATORS:
+            value = _strip_prefix(rest, op)
+            if value is not None:
+                forms.append((op, value.strip()))
+    reversed_rhs = _strip_prefix(rhs[::-1], lhs[::-1])
+    if reversed_rhs is not None:
+        for op in _REDUCTION_OPERATORS:
+            if op != "-":
+                value = _strip_prefix(reversed_rhs, op[::-1])
+                if value is not None:
+                    forms.append((op, value[::-1].strip()))
+    for op, value in forms:
+        if not value or value[0] in "*/=" or value[-1] in "*/=+-" or \
+           name in names(value):
+            continue
+        lowest = _lowest_precedence(value)
+        if lowest is None or lowest > _PRECEDENCE[op] or \
+           (lowest == _PRECEDENCE[op] and op in ["+", "*", ".and.",
+                                                 ".or."]):
+            if op == "-":
+                return "+", "-({0})".format(value)
+            return op, value
+    return None
+
+
+def combine(op, target, value):
+    ''' Returns the expression that combines value into target using the
+    reduction operator op '''
+    if op in _REDUCTION_INTRINSICS:
+        return "{0}({1}, {2})".format(op, target, value)
+    return "{0} {1} {2}".format(target, op, value)
+
+
+class PartialReduction(object):
+    '''A reduction, by the assignment stmt, into the loop-invariant
+    array element lhs (of the array name) that cannot be expressed by
+    a reduction clause, using the operator op to combine value.'''
+    def __init__(self, stmt, name, op, value):
+        self.stmt = stmt
+        self.name = name
+        self.lhs = stmt.variable
+        self.op = op
+        self.value = value
+
+
+class LoopSharing(object):
+    '''The results of analysing a loop: the names of the variables that
+    must be private to each thread (private), the names of the variables
+    that may be shared (shared), the operator of each variable that is
+    the subject of a reduction (reductions), the reductions into array
+    elements (partials, a list of PartialReduction), the names of the
+    private variables whose values from the last iteration are used
+    after the loop (lastprivate, which are not also in private) and
+    descriptions of the statements that may cause races (races). Names
+    are lower-cased and sorted.'''
+    def __init__(self, private, shared, races, reductions=None,
+                 partials=None, lastprivate=None):
+        self.private = sorted(private)
+        self.lastprivate = sorted(lastprivate or [])
+        self.shared = sorted(shared)
+        self.races = races
+        self.reductions = reductions or {}
+        self.partials = partials or []
+
+
+class _LoopAnalysis(object):
+    ''' Walks the body of a loop, recording how variables are used '''
+    def __init__(self, loop, scope):
+        self._scope = scope
+        self._index = loop_variable(loop)
+        self.private = set([self._index])
+        self.referenced = set()
+        # scalars that have definitely been written (in the iteration or,
+        # while walking a block, in the block so far), and those that
+        # have been read before being definitely written
+        self._written = set()
+        self._carried = set()
+        # all names that have been read and assigned (other than by a
+        # reduction)
+        self._read_names = set()
+        self._assigned = set()
+        self._reductions = {}
+        self._partials = []
+        # the statements that assign to elements of arrays, and their
+        # subscripts, and the subscripts with which arrays are read
+        self._array_writes = {}
+        self._array_reads = {}
+        # the statements that conditionally assign to private scalars
+        self._conditional = {}
+        self.races = []
+        self._walk(loop.content, conditional=False)
+        self._check_carried()
+        self.reductions = {}
+        self.partials = []
+        self._check_reductions()
+        self._check_dependences()
+
+    def _symbol(self, name):
+        ''' Returns the Symbol for name or None if it is not known '''
+        if self._scope is None:
+            return None
+        return self._scope.lookup(name)
+
+    def is_array(self, name):
+        ''' Returns True if name is declared to be an array '''
+        symbol = self._symbol(name)
+        if symbol is None:
+            return False
+        for attr in symbol.attributes:
+            if attr.lower().startswith("dimension"):
+                return True
+        for entity in getattr(symbol.node.root, "entity_decls", []):
+            if re.match(r"\s*" + name + r"\s*\(", entity, re.IGNORECASE):
+                return True
+        return False
+
+    def _uses_index(self, text):
+        ''' Returns True if text refers to the loop variable '''
+        return re.search(r"\b" + self._index + r"\b", text,
+                         re.IGNORECASE) is not None
+
+    def _read(self, expr):
+        ''' Records that the names in expr are read '''
+        for name, subscripts in _references(expr):
+            self._array_reads.setdefault(name, []).append(subscripts)
+        for name in names(expr):
+            self.referenced.add(name)
+            self._read_names.add(name)
+            if name not in self._written and name != self._index:
+                self._carried.add(name)
+
+    def _write(self, stmt, lhs, conditional):
+        ''' Records the assignment of lhs by stmt '''
+        name, rest = _split_lhs(lhs)
+        self.referenced.add(name)
+        self._assigned.add(name)
+        self._read(rest)
+        line = str(stmt).strip()
+        if rest.startswith("%"):
+            self.races.append(
+                "'{0}' assigns to a component of '{1}', which is shared "
+                "by all threads".format(line, name))
+        elif rest.startswith("(") or self.is_array(name):
+            if not self._uses_index(rest):
+                self.races.append(
+                    "'{0}' assigns to an element of '{1}' that does not "
+                    "depend on the loop variable '{2}' so threads may "
+                    "write to the same element".format(
+                        line, name, self._index))
+            else:
+                self._array_writes.setdefault(name, []).append(
+                    (line, _subscripts(rest)))
+        elif name in self._carried:
+            self.races.append(
+                "'{0}' assigns to '{1}', which is read before it is "
+                "assigned so its value is carried between iterations".format(
+                    line, name))
+            self.private.discard(name)
+        else:
+            self.private.add(name)
+            self._written.add(name)
+            if conditional:
+                self._conditional.setdefault(name, line)
+
+    def _check_carried(self):
+        '''Records races for the scalars that are only assigned to under
+        a condition but that are also read where they may not have been
+        assigned in the same iteration, so that their values may be
+        carried between iterations, and removes them from private'''
+        for name in sorted(self._carried & self.private):
+            self.races.append(
+                "'{0}' assigns to '{1}' but not in every iteration and "
+                "'{1}' is read where it may not have been assigned so its "
+                "value may be carried between iterations".format(
+                    self._conditional[name], name))
+            self.private.discard(name)
+
+    def conditional(self):
+        '''Returns a dictionary mapping the names of the private scalars
+        that are only assigned conditionally (so may not be assigned in
+        the last iteration) to the first statement that assigns each'''
+        return dict((name, line) for name, line in self._conditional.items()
+                    if name not in self._written)
+
+    def _check_dependences(self):
+        '''Records races for the arrays that are assigned to in an
+        iteration and that are also assigned to or read, within the loop,
+        with subscripts that may refer to elements of other iterations:
+        those that differ in a dimension in which an assigned element
+        depends on the loop variable (or no subscripts at all, e.g. when
+        the whole array is passed to a subroutine)'''
+        for name, writes in sorted(self._array_writes.items()):
+            split = [[part.replace(" ", "").lower() for part in
+                      _split_args(subscripts)] for _, subscripts in writes]
+            dims = set(len(parts) for parts in split)
+            positions = [index for index in range(max(dims)) if
+                         [parts for parts in split if index < len(parts) and
+                          self._uses_index(parts[index])]]
+            element = _element(writes[0][1], max(dims), positions)
+            accesses = [subscripts for _, subscripts in writes] + \
+                self._array_reads.get(name, [])
+            for subscripts in accesses:
+                if len(dims) > 1 or \
+                   _element(subscripts, max(dims), positions) != element:
+                    access = name if subscripts is None else \
+                        "{0}({1})".format(name, subscripts)
+                    self.races.append(
+                        "'{0}' assigns to an element of '{1}' but '{2}' is "
+                        "also used in the loop and may refer to an element "
+                        "assigned in another iteration".format(
+                            writes[0][0], name, access))
+                    break
+
+    def _reduce(self, stmt):
+        '''Records stmt if it is a reduction into a variable, a whole
+        array or a loop-invariant array element and returns True, or
+        returns False if it is not'''
+        found = reduction(stmt.variable, stmt.expr)
+        if found is None:
+            return False
+        name, rest = _split_lhs(stmt.variable)
+        if rest.startswith("%") or name in self.private:
+            # a private variable may be updated in the same way
+            return False
+        op, value = found
+        if rest:
+            if re.search(r"\b" + self._index + r"\b", rest, re.IGNORECASE) \
+               or set(names(rest)) & (self.private | self._assigned):
+                return False
+            self._partials.append(PartialReduction(stmt, name, op, value))
+        else:
+            self._reductions.setdefault(name, []).append((op, stmt))
+        self.referenced.add(name)
+        self._read(value)
+        self._read(rest)
+        return True
+
+    def _check_reductions(self):
+        '''Checks that the variables updated by reductions are not
+        otherwise used in the loop, recording races for those that are'''
+        for name, updates in sorted(self._reductions.items()):
+            ops = set(op for op, _ in updates)
+            if len(ops) == 1 and name not in self._read_names and \
+               name not in self._assigned:
+                self.reductions[name] = ops.pop()
+                continue
+            for _, stmt in updates:
+                self.races.append(
+                    "'{0}' is a reduction into '{1}' but '{1}' is also "
+                    "otherwise used in the loop".format(
+                        str(stmt).strip(), name))
+        for partial in self._partials:
+            symbol = self._symbol(partial.name)
+            if partial.name in self._read_names or \
+               partial.name in self._assigned or \
+               partial.name in self._reductions:
+                reason = "'{0}' is also otherwise used in the loop"
+            elif symbol is None or \
+                    symbol.datatype not in ["integer", "real"]:
+                reason = "the type of '{0}' is not integer or real"
+            else:
+                self.partials.append(partial)
+                continue
+            self.races.append(
+                "'{0}' is a reduction into an element of '{1}' but {2}".format(
+                    str(partial.stmt).strip(), partial.name,
+                    reason.format(partial.name)))
+
+    def _walk(self, content, conditional):
+        ''' Walks the fparser nodes in content '''
+        for stmt in content:
+            if isinstance(stmt, (Comment, EndStatement)):
+                continue
+            if isinstance(stmt, Assignment):
+                if not self._reduce(stmt):
+                    self._read(stmt.expr)
+                    self._write(stmt, stmt.variable, conditional)
+            elif isinstance(stmt, Call):
+                for item in stmt.items:
+                    self._read(item)
+            elif isinstance(stmt, Do):
+                variable, _, bounds = stmt.loopcontrol.partition("=")
+                self._read(bounds)
+                self._write(stmt, variable, conditional)
+                self._walk(stmt.content, conditional)
+            else:
+                expr = getattr(stmt, "expr", None)
+                if isinstance(expr, basestring):
+                    self._read(expr)
+                if isinstance(stmt, BeginStatement):
+                    self._walk_block(stmt.content)
+
+    def _walk_block(self, content):
+        '''Walks the fparser nodes in content, the body of a conditional
+        block. Only the assignments that precede a read in the same
+        branch of the block make it certain that a scalar has been
+        assigned, and none do after the block.'''
+        from fparser.statements import Else, ElseIf, Case
+        outer = set(self._written)
+        for stmt in content:
+            if isinstance(stmt, (Else, ElseIf, Case)):
+                self._written = set(outer)
+            self._walk([stmt], conditional=True)
+        self._written = outer
+
+    def variables(self, names_):
+        '''Returns those of names_ that are variables that can appear in
+        a data-sharing clause'''
+        found = set()
+        for name in names_:
+            symbol = self._symbol(name)
+            if symbol is not None and symbol.datatype is not None and \
+               "parameter" not in [attr.lower() for attr in
+                                   symbol.attributes]:
+                found.add(name)
+        return found
+
+
+def analyse_loop(loop, scope=None):
+    '''Analyses the body of the fparser Do loop, which is to be
+    parallelised, and returns a LoopSharing. scope is the ProgUnitGen
+    whose symbol table is used to find which names are declared
+    variables and which of those are arrays (if it is None then only
+    variables that are assigned to are considered).'''
+    analysis = _LoopAnalysis(loop, scope)
+    private = analysis.private
+    if scope is not None:
+        shared = analysis.variables(
+            analysis.referenced - private - set(analysis.reductions) -
+            set(partial.name for partial in analysis.partials))
+    else:
+        shared = set()
+    # the private scalars whose values may be used after the loop
+    scalars = set(name for name in private if not analysis.is_array(name))
+    live = _live_after(loop, scalars, scope)
+    conditional = analysis.conditional()
+    for name in sorted(live & set(conditional)):
+        analysis.races.append(
+            "'{0}' assigns to '{1}' but not in every iteration and '{1}' "
+            "may be used after the loop, where its value is undefined as "
+            "it is private".format(conditional[name], name))
+    lastprivate = live - set(conditional)
+    return LoopSharing(private - lastprivate, shared, analysis.races,
+                       analysis.reductions, analysis.partials, lastprivate)
+
+
+def _following(loop):
+    '''Returns the fparser statements that may be executed after the Do
+    loop, in order: those that follow it in its block and in each of
+    the blocks enclosing it, up to its program unit, and (as they may
+    be executed in later iterations) the statements of enclosing loops
+    that precede it'''
+    from fparser.block_statements import Program, Module, Subroutine, \
+        Function
+    following = []
+    stmt = loop
+    parent = loop.parent
+    while parent is not None and \
+            not isinstance(parent, (Program, Module, Subroutine, Function)) \
+            and hasattr(parent, "content"):
+        index = [idx for idx, node in enumerate(parent.content)
+                 if node is stmt][0]
+        following.extend(parent.content[index + 1:])
+        if isinstance(parent, Do):
+            following.extend(parent.content[:index])
+        stmt = parent
+        parent = parent.parent
+    if parent is not None and hasattr(parent, "content"):
+        index = [idx for idx, node in enumerate(parent.content)
+                 if node is stmt][0]
+        following.extend(parent.content[index + 1:])
+    return following
+
+
+def _live_after(loop, candidates, scope):
+    '''Returns those of the (lower-cased) names in candidates whose values
+    on leaving the fparser Do loop may be used: those that are read by
+    a statement that may follow the loop before they are certainly
+    assigned to and, unless they are certainly assigned to after the
+    loop, the arguments of scope (the ProgUnitGen containing the loop)
+    and variables declared outside it'''
+    live = set()
+    killed = set()
+
+    def scan(stmts, conditional):
+        ''' Scans the fparser statements stmts in order '''
+        for stmt in stmts:
+            if isinstance(stmt, (Comment, EndStatement)):
+                continue
+            if isinstance(stmt, Assignment):
+                name, rest = _split_lhs(stmt.variable)
+                read = names(stmt.expr) + names(rest)
+                written = name if not rest and not conditional else None
+            elif isinstance(stmt, Do):
+                variable, _, bounds = stmt.loopcontrol.partition("=")
+                read = names(bounds)
+                written = None if conditional else variable.strip().lower()
+            elif isinstance(stmt, BeginStatement):
+                read = names(stmt.tostr())
+                written = None
+            else:
+                read = names(stmt.tofortran())
+                written = None
+            live.update(name for name in read
+                        if name in candidates and name not in killed)
+            if written is not None:
+                killed.add(written)
+            if isinstance(stmt, BeginStatement):
+                scan(stmt.content, conditional=True)
+
+    scan(_following(loop), conditional=False)
+    if scope is not None:
+        args = [arg.lower() for arg in getattr(scope, "args", [])]
+        for name in candidates - killed - live:
+            if name in args or (scope.lookup(name) is not None and
+                                scope._symbol(name) is None):
+                live.add(name)
+    return live
+
+
+def add_partial_reductions(directive, loop, scope, partials):
+    '''Replaces the reductions into array elements in partials (a list
+    of PartialReduction) within the fparser Do loop, which follows the
+    "parallel do" DirectiveGen directive, by reductions into per-thread
+    partial results. These are held in arrays, declared in the
+    ProgUnitGen scope, with one row, padded to PARTIAL_PAD elements,
+    for each thread. The partial results are combined after the loop.
+    Returns the names of the variables that must be private to, and
+    those that may be shared by, the threads.'''
+    from fgenerator.base import index_of_object
+    from fgenerator.gen import AssignGen, AllocateGen, DeallocateGen, \
+        DeclGen, DoGen, UseGen
+    from fgenerator.fparser_wrapper import OMPDirective
+    parent = directive.parent
+    scope.add(UseGen(scope, name="omp_lib", only=True,
+                     funcnames=["omp_get_max_threads",
+                                "omp_get_thread_num"]))
+    nthreads = scope.new_name("nthreads", datatype="integer")
+    thread = scope.new_name("thread", datatype="integer")
+    parent.add(AssignGen(parent, lhs=nthreads, rhs="omp_get_max_threads()"),
+               position=["before", directive.root])
+    set_thread = AssignGen(parent, lhs=thread, rhs="omp_get_thread_num()")
+    set_thread.root.parent = loop
+    loop.content.insert(0, set_thread.root)
+
+    # the combining loop goes after the loop or its end directive
+    content = parent.root.content
+    anchor = loop
+    index = index_of_object(content, loop) + 1
+    if index < len(content) and isinstance(content[index], OMPDirective) \
+       and content[index].position == "end":
+        anchor = content[index]
+    combine_loop = DoGen(parent, thread, "0", nthreads + " - 1")
+    cleanup = []
+    shared = []
+    for partial in partials:
+        array = scope.new_name(partial.name + "_partial")
+        shared.append(array)
+        symbol = scope.lookup(partial.name)
+        decl = DeclGen(scope, datatype=symbol.datatype,
+                       entity_decls=[array], allocatable=True,
+                       dimension=":,:")
+        decl.root.selector = symbol.node.root.selector
+        scope.add(decl)
+        parent.add(AllocateGen(parent, "{0}({1}, 0:{2} - 1)".format(
+            array, PARTIAL_PAD, nthreads)),
+                   position=["before", directive.root])
+        parent.add(AssignGen(parent, lhs=array + "(1, :)",
+                             rhs=_IDENTITY[partial.op].format(partial.lhs)),
+                   position=["before", directive.root])
+        element = "{0}(1, {1})".format(array, thread)
+        partial.stmt.variable = element
+        partial.stmt.expr = combine(partial.op, element, partial.value)
+        combine_loop.add(AssignGen(combine_loop, lhs=partial.lhs,
+                                   rhs=combine(partial.op, partial.lhs,
+                                               element)))
+        cleanup.append(DeallocateGen(parent, array))
+    parent.add(combine_loop, position=["after", anchor])
+    for gen in reversed(cleanup):
+        parent.add(gen, position=["after", combine_loop.root])
+    return [thread], shared
@@ -0,0 +1,92 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+'''This module writes generated code to files without touching files
+whose content has not changed. Build systems decide what to recompile
+from file timestamps (and, for Fortran, every module that uses a
+module whose file changed is recompiled) so rewriting identical code
+can trigger a needless cascade of recompilation.'''
+
+import os
+import tempfile
+
+# The size of the blocks in which existing files are read
+_BLOCK_SIZE = 1 << 16
+
+
+def _file_matches(path, text):
+    ''' Returns True if the content of the supplied file is text. The
+    file is compared a block at a time, stopping at the first block
+    that differs, so the whole of the existing file need not be read
+    (or hashed) when it has changed '''
+    with open(path, "rb") as in_file:
+        for start in range(0, len(text), _BLOCK_SIZE):
+            if in_file.read(_BLOCK_SIZE) != text[start:start + _BLOCK_SIZE]:
+                return False
+        return not in_file.read(1)
+
+
+def _new_file_mode():
+    ''' Returns the permissions given to a newly created file '''
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def write_if_changed(path, text):
+    '''Writes text to the file path unless the file already contains
+    exactly that text. The file is replaced atomically by writing to a
+    temporary file in the same directory and renaming it. Returns True
+    if the file was written and False if it was left untouched.'''
+    if os.path.isfile(path) and os.path.getsize(path) == len(text) and \
+       _file_matches(path, text):
+        return False
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0o7777
+    else:
+        mode = _new_file_mode()
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(
+        prefix="." + os.path.basename(path) + ".", dir=directory)
+    try:
+        with os.fdopen(handle, "wb") as out_file:
+            out_file.write(text)
+        os.chmod(temp_path, mode)
+        if os.name == "nt" and os.path.exists(path):
+            # rename does not replace an existing file on Windows
+            os.remove(path)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return True
@@ -0,0 +1,266 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+'''This module renders a tree of fparser statements (usually the root
+of a Gen object) to Fortran, optionally wrapping lines to a maximum
+length with free-form continuation and optionally rendering the
+subroutines of a module in parallel. It also provides emit(), which
+walks the tree once, carrying the indentation level down from each
+block to its content, and reports where each statement's code starts
+and ends (as used by fgenerator.sourcemap). emit() is not used for
+plain rendering as fparser's own str() is faster for trees of the
+usual (shallow) depth.'''
+
+import os
+
+from fparser.base_classes import Statement, BeginStatement, EndStatement
+from fparser.block_statements import BeginSource
+
+# The maximum length of a line of free-form Fortran
+MAX_LINE_LENGTH = 132
+
+# The block whose content is being rendered by worker processes (see
+# render_parallel()). Workers are forked and so inherit it.
+_PARALLEL_ROOT = None
+
+# The block statement printers that output the statement followed by
+# its content. Statements printed by any other method are rendered as
+# a whole.
+_BLOCK_PRINTERS = (BeginStatement.tofortran.__func__,
+                   BeginSource.tofortran.__func__)
+
+
+def _depth(stmt):
+    ''' Returns the number of statements enclosing stmt '''
+    depth = 0
+    parent = stmt.parent
+    while isinstance(parent, Statement):
+        depth += 1
+        parent = parent.parent
+    return depth
+
+
+def _indent_tab(stmt, depth):
+    '''Returns a replacement for the get_indent_tab method of stmt that
+    gives the same result for a statement at the supplied depth without
+    walking the chain of parents '''
+    end = isinstance(stmt, EndStatement)
+
+    def get_indent_tab(deindent=False, isfix=None):
+        ''' Returns the indentation (and any label) of stmt '''
+        if isfix is None:
+            isfix = stmt.reader.isfixed
+        tab = '  ' * depth
+        if isfix:
+            tab = ' ' * 6 + tab
+        if deindent or end:
+            tab = tab[:-2]
+        label = getattr(stmt.item, 'label', None)
+        if label is None:
+            return tab
+        label = str(label)
+        if isfix:
+            label = ' ' + label
+        tab = tab[len(label):]
+        if not tab:
+            tab = ' '
+        return label + tab
+    return get_indent_tab
+
+
+def _tofortran(stmt, depth, isfix):
+    ''' Returns the Fortran for stmt, which is at the supplied depth '''
+    stmt.get_indent_tab = _indent_tab(stmt, depth)
+    try:
+        return stmt.tofortran(isfix=isfix)
+    finally:
+        del stmt.get_indent_tab
+
+
+def is_block(stmt):
+    '''Returns True if stmt is a block statement that is printed as
+    the statement itself followed by its content '''
+    return isinstance(stmt, BeginStatement) and \
+        type(stmt).tofortran.__func__ in _BLOCK_PRINTERS
+
+
+def render_statement(stmt, depth=None, isfix=None):
+    '''Returns the Fortran for stmt alone, i.e. without its content if
+    it is a block statement (see is_block()). depth is the number of
+    statements enclosing stmt and is computed if it is not supplied.'''
+    if depth is None:
+        depth = _depth(stmt)
+    if not is_block(stmt):
+        return _tofortran(stmt, depth, isfix)
+    content = stmt.content
+    stmt.content = []
+    try:
+        return _tofortran(stmt, depth, isfix)
+    finally:
+        stmt.content = content
+
+
+def emit(stmt, lines, depth=None, isfix=None, visit=None):
+    '''Appends the lines of Fortran for stmt (and any content it has) to
+    the list lines. depth is the number of statements enclosing stmt and
+    is computed if it is not supplied. If visit is supplied then it is
+    called as visit(stmt, start, end) once each statement has been
+    rendered, where start and end are the (inclusive, zero-based)
+    indices in lines of the statement's output.'''
+    if depth is None:
+        depth = _depth(stmt)
+    start = len(lines)
+    lines.extend(render_statement(stmt, depth, isfix).split("\n"))
+    if is_block(stmt):
+        for child in stmt.content:
+            emit(child, lines, depth + 1, isfix, visit)
+    if visit is not None:
+        visit(stmt, start, len(lines) - 1)
+
+
+def wrap(line, line_length=MAX_LINE_LENGTH):
+    '''Returns a list of free-form lines, none of which is longer than
+    line_length, that are equivalent to the supplied line. Each broken
+    line ends with '&' and each continuation line starts (after the
+    indentation) with '&', which allows a line to be broken anywhere,
+    even within a token or a character string. OpenMP directives are
+    only broken at a blank or after a comma, and are continued with
+    '!$omp&', so a directive with no such place to break it is left
+    too long. Comments are never wrapped.'''
+    if len(line) <= line_length:
+        return [line]
+    text = line.lstrip()
+    indent = line[:len(line) - len(text)]
+    directive = text.lower().startswith("!$omp")
+    if directive:
+        prefix = indent + text[:5] + "& "
+    elif text.startswith("!"):
+        return [line]
+    else:
+        prefix = indent + "&"
+    width = line_length - 1
+    if width <= len(prefix):
+        return [line]
+    lines = []
+    while len(line) > line_length:
+        if not directive:
+            lines.append(line[:width] + "&")
+            line = prefix + line[width:]
+            continue
+        # the break is followed by " &" so must leave room for it
+        blank = line.rfind(" ", len(prefix), width)
+        comma = line.rfind(",", len(prefix), width - 1)
+        if comma > blank:
+            lines.append(line[:comma + 1] + " &")
+            line = prefix + line[comma + 1:].lstrip()
+        elif blank > len(prefix):
+            lines.append(line[:blank] + " &")
+            line = prefix + line[blank + 1:].lstrip()
+        else:
+            break
+    lines.append(line)
+    return lines
+
+
+def render(stmt, isfix=None, line_length=None):
+    '''Returns the Fortran for the fparser statement stmt and everything
+    it contains. If line_length is supplied then lines longer than it
+    are wrapped (see wrap()), otherwise the result is str(stmt).'''
+    if isfix is None:
+        isfix = stmt.reader.isfixed
+    code = stmt.tofortran(isfix=isfix)
+    if line_length is None or isfix:
+        return code
+    return "\n".join(_wrap_lines(code.split("\n"), line_length))
+
+
+def _wrap_lines(lines, line_length):
+    ''' Returns lines with each line wrapped to line_length '''
+    wrapped = []
+    for line in lines:
+        wrapped.extend(wrap(line, line_length))
+    return wrapped
+
+
+def _render_content(args):
+    '''Renders the statements in the content of _PARALLEL_ROOT with the
+    supplied indices. Runs in a worker process. Returns a list
+    containing the code for each statement.'''
+    indices, isfix, line_length = args
+    content = _PARALLEL_ROOT.content
+    result = []
+    for index in indices:
+        result.append(render(content[index], isfix, line_length))
+    return result
+
+
+def render_parallel(stmt, jobs, isfix=None, line_length=None):
+    '''Returns the same code as render() but renders each block statement
+    (e.g. subroutine) in the content of stmt in one of jobs worker
+    processes, which are forked so that they share the tree. Falls back
+    to render() if jobs is less than two or processes cannot be
+    forked.'''
+    global _PARALLEL_ROOT
+    if isfix is None:
+        isfix = stmt.reader.isfixed
+    if isfix:
+        line_length = None
+    indices = [index for index, child in enumerate(stmt.content)
+               if isinstance(child, BeginStatement)]
+    if jobs is None or jobs < 2 or len(indices) < 2 or \
+       not hasattr(os, "fork"):
+        return render(stmt, isfix, line_length)
+    import multiprocessing
+    depth = _depth(stmt)
+    lines = render_statement(stmt, depth, isfix).split("\n")
+    if line_length is not None:
+        lines = _wrap_lines(lines, line_length)
+    chunk_size = max(1, len(indices) // (jobs * 4))
+    chunks = [indices[start:start + chunk_size] for start in
+              range(0, len(indices), chunk_size)]
+    _PARALLEL_ROOT = stmt
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.imap(_render_content,
+                            [(chunk, isfix, line_length)
+                             for chunk in chunks])
+        parallel = iter(code for chunk in results for code in chunk)
+        for child in stmt.content:
+            if isinstance(child, BeginStatement):
+                lines.append(next(parallel))
+            else:
+                lines.append(render(child, isfix, line_length))
+    finally:
+        pool.close()
+        pool.join()
+        _PARALLEL_ROOT = None
+    return "\n".join(lines)
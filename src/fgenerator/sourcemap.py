@@ -0,0 +1,144 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+'''This module renders a tree of Gen objects to Fortran while also
+producing a source map. The map records, for every Gen object in the
+tree, the range of output lines it produced and the location in the
+generator (python) code at which the object was created. This allows a
+hot-spot reported by a profiler at a particular line of the generated
+code to be traced back to the code that generated it.'''
+
+import json
+
+from fgenerator.render import emit
+
+# Suffix appended to the name of a rendered file to give the name of
+# its source map
+MAP_SUFFIX = ".map"
+
+
+class SourceMapEntry(object):
+    ''' Maps an (inclusive, one-based) range of output lines to the Gen
+    object that produced them '''
+    def __init__(self, start, end, gen_type, origin):
+        self.start = start
+        self.end = end
+        self.gen_type = gen_type
+        self.origin = origin
+
+    def todict(self):
+        ''' Returns this entry as a dictionary suitable for json '''
+        entry = {"lines": [self.start, self.end], "gen": self.gen_type}
+        if self.origin is not None:
+            entry["file"] = self.origin[0]
+            entry["line"] = self.origin[1]
+            entry["function"] = self.origin[2]
+        return entry
+
+    @staticmethod
+    def fromdict(entry):
+        ''' Creates an entry from a dictionary read from json '''
+        origin = None
+        if "file" in entry:
+            origin = (entry["file"], entry["line"], entry["function"])
+        return SourceMapEntry(entry["lines"][0], entry["lines"][1],
+                              entry["gen"], origin)
+
+
+class SourceMap(object):
+    ''' A list of SourceMapEntry objects ordered by their first line.
+    Entries nest in the same way as the Gen objects that they describe. '''
+    def __init__(self, entries=None):
+        if entries is None:
+            entries = []
+        self._entries = sorted(entries, key=lambda e: (e.start, -e.end))
+
+    @property
+    def entries(self):
+        ''' Returns the list of entries in this source map '''
+        return self._entries
+
+    def lookup(self, line):
+        '''Returns the innermost entry that contains the supplied
+        (one-based) line number or None if no entry contains it'''
+        found = None
+        for entry in self._entries:
+            if entry.start > line:
+                break
+            if entry.end >= line:
+                found = entry
+        return found
+
+    def tojson(self, filename=None):
+        ''' Returns this source map as a json string '''
+        return json.dumps({"version": 1, "file": filename,
+                           "entries": [entry.todict() for entry in
+                                       self._entries]},
+                          indent=1, sort_keys=True)
+
+    @staticmethod
+    def load(path):
+        ''' Reads a source map from the supplied file '''
+        with open(path) as map_file:
+            data = json.load(map_file)
+        return SourceMap([SourceMapEntry.fromdict(entry) for entry in
+                          data["entries"]])
+
+
+def render(gen):
+    '''Renders the supplied Gen object and everything it contains.
+    Returns a tuple containing the generated Fortran (identical to
+    str(gen.root)) and its SourceMap'''
+    lines = []
+    entries = []
+
+    def visit(stmt, start, end):
+        ''' Adds an entry for stmt if it belongs to a Gen object '''
+        gen = getattr(stmt, "_gen", None)
+        if gen is not None:
+            entries.append(SourceMapEntry(start + 1, end + 1,
+                                          type(gen).__name__, gen.origin))
+    emit(gen.root, lines, visit=visit)
+    return "\n".join(lines), SourceMap(entries)
+
+
+def write(gen, path):
+    '''Writes the Fortran for the supplied Gen object to the file
+    'path' and its source map to the sidecar file 'path' + MAP_SUFFIX.
+    Returns the SourceMap. '''
+    code, source_map = render(gen)
+    with open(path, "w") as out_file:
+        out_file.write(code)
+        out_file.write("\n")
+    with open(path + MAP_SUFFIX, "w") as map_file:
+        map_file.write(source_map.tojson(path))
+    return source_map
@@ -0,0 +1,107 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+''' Tests for the on-disk cache of parsed source files '''
+
+import os
+import pytest
+import fgenerator.modify
+from fgenerator.cache import ParseCache
+from fgenerator.modify import ModifiedSource, adduse
+from fgenerator.gen import DoGen
+from modify_test import SOURCE
+
+
+def test_parse_cache(tmpdir, monkeypatch):
+    ''' Check that a file is parsed once and its tree then comes from
+    the cache, even for a new cache object, and that the cached tree can
+    be modified '''
+    path = tmpdir.join("m.f90")
+    path.write(SOURCE)
+    cache_dir = str(tmpdir.join("cache"))
+    source = ModifiedSource.fromfile(str(path), cache=ParseCache(cache_dir))
+    assert str(source.tree.content[1]) == \
+        str(ModifiedSource(SOURCE).tree.content[1])
+    assert len(os.listdir(cache_dir)) == 1
+
+    def fail(text, name):
+        ''' Replaces the parser to check that it is not called '''
+        raise AssertionError("parsed a cached file")
+    monkeypatch.setattr(fgenerator.modify, "_parse", fail)
+    source = ModifiedSource.fromfile(str(path), cache=ParseCache(cache_dir))
+    module = source.tree.content[1]
+    adduse("fred", module)
+    assert source.splice() == SOURCE.replace("  use a\n",
+                                             "  USE fred\n  use a\n")
+    # blocks can be added to a cached tree
+    sub = module.content[5]
+
+    class Parent(object):
+        ''' Stands in for a Gen object '''
+        root = sub
+    loop = DoGen(Parent(), "j", "1", "2")
+    sub.content.insert(1, loop.root)
+    assert "DO j=1,2" in str(source.tree)
+
+
+def test_parse_cache_eviction(tmpdir):
+    ''' Check that the least recently used trees are evicted '''
+    cache_dir = str(tmpdir.join("cache"))
+    cache = ParseCache(cache_dir, max_entries=2)
+    paths = []
+    for idx in range(3):
+        path = tmpdir.join("m{0}.f90".format(idx))
+        path.write("module m{0}\nend module m{0}\n".format(idx))
+        paths.append(str(path))
+    cache.parse(paths[0])
+    cache.parse(paths[1])
+    # make the first tree the most recently used
+    for name in os.listdir(cache_dir):
+        os.utime(os.path.join(cache_dir, name), (1000, 1000))
+    cache.parse(paths[0])
+    cache.parse(paths[2])
+    assert len(os.listdir(cache_dir)) == 2
+    text, tree = cache.parse(paths[0])
+    assert "MODULE m0" in str(tree)
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_parse_cache_error(tmpdir):
+    ''' Check that an error while parsing a file names the file and that
+    nothing is cached '''
+    path = tmpdir.join("bad.f90")
+    path.write("subroutine bad(\n")
+    cache = ParseCache(str(tmpdir.join("cache")))
+    with pytest.raises(RuntimeError) as excinfo:
+        cache.parse(str(path))
+    assert "Failed to parse '{0}'".format(path) in str(excinfo.value)
+    assert os.listdir(str(tmpdir.join("cache"))) == []
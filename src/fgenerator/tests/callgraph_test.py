@@ -0,0 +1,105 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+''' Tests for extracting the call graph of generated and parsed code '''
+
+from fgenerator.gen import ModuleGen, SubroutineGen, DoGen, CallGen, \
+    UseGen
+from fgenerator.modify import ModifiedSource
+from fgenerator.callgraph import CallGraph
+
+PARSED = (
+    "module lib\n"
+    "contains\n"
+    "  subroutine helper()\n"
+    "  end subroutine helper\n"
+    "end module lib\n"
+    "module app\n"
+    "contains\n"
+    "  subroutine driver()\n"
+    "    use other, only: local => remote\n"
+    "    use lib\n"
+    "    call local()\n"
+    "    call helper()\n"
+    "    call inner()\n"
+    "    call unknown()\n"
+    "  contains\n"
+    "    subroutine inner()\n"
+    "      call helper()\n"
+    "    end subroutine inner\n"
+    "  end subroutine driver\n"
+    "end module app\n")
+
+
+def test_callgraph_gen():
+    ''' Check the call graph of a tree of Gen objects '''
+    module = ModuleGen(name="algorithm")
+    sub = SubroutineGen(module, name="invoke")
+    module.add(sub)
+    sub.add(UseGen(sub, name="kern_mod", only=True, funcnames=["kern"]))
+    loop = DoGen(sub, "cell", "1", "ncells")
+    sub.add(loop)
+    loop.add(CallGen(loop, "kern", ["cell"]))
+    loop.add(CallGen(loop, "kern", ["cell + 1"]))
+    sub.add(CallGen(sub, "kern", ["0"]))
+    sub.add(CallGen(sub, "setup"))
+    graph = CallGraph([module])
+    kern, setup = graph.callees("INVOKE")
+    assert (kern.caller_module, kern.caller, kern.callee) == \
+        ("algorithm", "invoke", "kern")
+    assert kern.count == 3
+    assert kern.loop_count == 2
+    assert kern.in_loop
+    assert kern.module == "kern_mod"
+    assert setup.callee == "setup"
+    assert setup.count == 1
+    assert not setup.in_loop
+    assert setup.module is None
+
+
+def test_callgraph_parsed():
+    ''' Check the call graph of a parsed file, including renamed,
+    contained and used procedures '''
+    source = ModifiedSource(PARSED)
+    graph = CallGraph([source.tree])
+    edges = dict(((edge.caller, edge.callee), edge) for edge in
+                 graph.edges())
+    local = edges[("driver", "local")]
+    assert (local.module, local.remote_name) == ("other", "remote")
+    assert edges[("driver", "helper")].module == "lib"
+    assert edges[("driver", "inner")].module == "app"
+    assert edges[("driver", "unknown")].module is None
+    # calls from a contained subroutine use the host's use statements
+    assert edges[("inner", "helper")].module == "lib"
+    assert edges[("inner", "helper")].caller_module == "app"
+    assert [edge.caller for edge in graph.callers("helper")] == \
+        ["driver", "inner"]
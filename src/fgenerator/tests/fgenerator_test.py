@@ -35,8 +35,10 @@
 from fgenerator.gen import ModuleGen, CommentGen, SubroutineGen, DoGen, CallGen,\
     AllocateGen, DeallocateGen, IfThenGen, DeclGen, TypeDeclGen,\
     ImplicitNoneGen, UseGen, DirectiveGen, AssignGen
-from fgenerator.gen import SelectionGen
+from fgenerator.gen import SelectionGen, TemplateGen
 from fgenerator.modify import adduse
+from fgenerator import trusted, validate
+from fgenerator.base import copy_node
 from utils import line_number, count_lines
 import pytest
 
@@ -916,6 +918,17 @@ def test_adduse_default_funcnames():
     assert expected in gen
 
 
+def test_adduse_rename():
+    ''' Test that the adduse module method keeps a list of renames when
+    only is False '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    adduse("fred", sub.root, only=False, funcnames=["a=>b"])
+    assert count_lines(sub.root, "USE fred, a=>b") == 1
+    assert count_lines(sub.root, "ONLY") == 0
+
+
 def test_declgen_wrong_type():
     ''' Check that we raise an appropriate error if we attempt to create
     a DeclGen for an unsupported type '''
@@ -1109,7 +1122,6 @@ def test_selectiongen_addcase():
     assert expected in gen
 
 
-@pytest.mark.xfail(reason="Adding a CASE to a SELECT TYPE does not work")
 def test_typeselectiongen():
     ''' Check that SelectionGen works as expected for a type '''
     module = ModuleGen(name="testmodule")
@@ -1178,3 +1190,757 @@ def test_basegen_previous_loop_no_loop():
     with pytest.raises(RuntimeError) as err:
         sub.previous_loop()
     assert "no loop found - there is no previous loop" in str(err)
+
+
+def test_trusted_skips_ancestry_check():
+    ''' Check that the ancestry check is skipped within a trusted block
+    and that validate() subsequently reports the problem '''
+    module = ModuleGen(name="testmodule")
+    module_wrong = ModuleGen(name="another_module")
+    sub = SubroutineGen(module_wrong, name="testsubroutine")
+    with trusted():
+        module.add(sub)
+    with pytest.raises(RuntimeError) as err:
+        validate(module)
+    assert "because it is not a descendant of it or of any of" in str(err)
+    # checks are enabled again on leaving the trusted block
+    with pytest.raises(RuntimeError) as err:
+        module.add(SubroutineGen(module_wrong, name="testsubroutine2"))
+    assert "because it is not a descendant of it or of any of" in str(err)
+
+
+def test_trusted_is_per_thread():
+    ''' Check that a trusted block only skips the checks made by the
+    thread that entered it '''
+    import threading
+    module = ModuleGen(name="testmodule")
+    module_wrong = ModuleGen(name="another_module")
+    errors = []
+
+    def add_wrong():
+        ''' Adds a subroutine with the wrong ancestry '''
+        try:
+            module.add(SubroutineGen(module_wrong, name="testsubroutine"))
+        except RuntimeError as err:
+            errors.append(str(err))
+
+    with trusted():
+        thread = threading.Thread(target=add_wrong)
+        thread.start()
+        thread.join()
+    assert len(errors) == 1
+    assert "because it is not a descendant of it or of any of" in errors[0]
+
+
+def test_trusted_skips_directive_check():
+    ''' Check that directive types are not checked within a trusted
+    block but are checked by validate() '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    with trusted():
+        sub.add(DirectiveGen(sub, "omp", "begin", "parallel", ""))
+    validate(module)
+    with trusted():
+        sub.add(DirectiveGen(sub, "omp", "begin", "invalid", ""))
+    with pytest.raises(RuntimeError) as err:
+        validate(module)
+    assert "unrecognised directive type 'invalid'" in str(err)
+    with pytest.raises(RuntimeError) as err:
+        DirectiveGen(sub, "omp", "middle", "do", "")
+    assert "unrecognised position 'middle'" in str(err)
+
+
+def test_trusted_skips_implicit_none_check():
+    ''' Check that the parent of an ImplicitNoneGen is not checked
+    within a trusted block but is checked by validate() '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    dogen = DoGen(sub, "i", "1", "10")
+    sub.add(dogen)
+    with trusted():
+        dogen.add(ImplicitNoneGen(dogen))
+    with pytest.raises(Exception) as err:
+        validate(module)
+    assert "The parent of ImplicitNoneGen must be" in str(err)
+
+
+def test_validate_valid_tree():
+    ''' Check that validate() accepts a tree built in a trusted block
+    and that the generated code is unchanged '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine", implicitnone=True)
+    module.add(sub)
+    sub.add(DeclGen(sub, datatype="integer", entity_decls=["i"]))
+    expected = str(module.root)
+    with trusted():
+        tmodule = ModuleGen(name="testmodule")
+        tsub = SubroutineGen(tmodule, name="testsubroutine",
+                             implicitnone=True)
+        tmodule.add(tsub)
+        tsub.add(DeclGen(tsub, datatype="integer", entity_decls=["i"]))
+    validate(tmodule)
+    assert str(tmodule.root) == expected
+
+
+def test_children_derived_from_fparser_tree():
+    ''' Check that the children of a Gen object are derived from the
+    fparser tree so that they are in code order and include objects that
+    have been bubbled-up from a loop '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    assert module.children[-1] is sub
+    dogen = DoGen(sub, "i", "1", "10")
+    sub.add(dogen)
+    assign = AssignGen(dogen, lhs="a(i)", rhs="b(i)")
+    dogen.add(assign)
+    decl = DeclGen(dogen, datatype="integer", entity_decls=["i"])
+    dogen.add(decl)
+    first = CommentGen(sub, "first")
+    sub.add(first, position=["first"])
+    assert sub.children == [first, decl, dogen]
+    assert dogen.children == [assign]
+    # a duplicate declaration is not added to the tree
+    sub.add(DeclGen(sub, datatype="integer", entity_decls=["i"]))
+    assert sub.children == [first, decl, dogen]
+    # removing a statement from the fparser tree removes the child
+    sub.root.content.remove(first.root)
+    assert sub.children == [decl, dogen]
+
+
+def test_dispose_frees_without_gc():
+    ''' Check that a tree which has been disposed of is freed by
+    reference counting alone '''
+    import gc
+    import weakref
+    gc.collect()
+    gc.disable()
+    try:
+        module = ModuleGen(name="testmodule")
+        sub = SubroutineGen(module, name="testsubroutine",
+                            implicitnone=True)
+        module.add(sub)
+        sub.add(DeclGen(sub, datatype="integer", entity_decls=["i"]))
+        loop = DoGen(sub, "i", "1", "10")
+        sub.add(loop)
+        loop.add(AssignGen(loop, lhs="a(i)", rhs="0.0"))
+        # parent links are weak but parents are kept alive by the tree
+        assert loop.parent is sub
+        refs = map(weakref.ref, [module, sub, loop, module.root, sub.root,
+                                 loop.root])
+        del sub, loop
+        module.dispose()
+        del module
+        assert [ref() for ref in refs] == [None] * len(refs)
+    finally:
+        gc.enable()
+
+
+def test_dispose_subtree():
+    ''' Check that disposing of part of a tree removes it from its
+    parent and leaves the rest of the tree intact '''
+    module = ModuleGen(name="testmodule")
+    sub1 = SubroutineGen(module, name="sub1")
+    module.add(sub1)
+    sub2 = SubroutineGen(module, name="sub2")
+    module.add(sub2)
+    sub1.dispose()
+    gen = str(module.root)
+    assert "sub1" not in gen
+    assert "SUBROUTINE sub2" in gen
+    assert module.children[-1] is sub2
+
+
+def test_clone_copy_on_write():
+    ''' Check that a clone shares the fparser nodes of the original until
+    they are modified through the clone '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    outer = DoGen(sub, "j", "1", "n")
+    sub.add(outer)
+    inner = DoGen(outer, "i", "1", "n")
+    outer.add(inner)
+    assign = AssignGen(inner, lhs="a(i,j)", rhs="0.0")
+    inner.add(assign)
+    original = str(sub.root)
+
+    variant = outer.clone()
+    sub.add(variant)
+    # Nothing below the cloned loop has been copied
+    assert variant.root is not outer.root
+    assert variant.root.content[0] is inner.root
+    # Modify the bounds of the inner loop of the copy
+    vinner = variant.children[0]
+    assert isinstance(vinner, DoGen)
+    assert vinner is not inner
+    vinner.root.loopcontrol = "i=2,n-1"
+    vinner.add(AssignGen(vinner, lhs="b(i,j)", rhs="1.0"))
+    # the assignment is still shared but the inner loop is not
+    assert variant.root.content[0] is vinner.root
+    assert vinner.root is not inner.root
+    assert vinner.root.content[0] is assign.root
+    assert vinner.parent is variant
+    # accessing the root of a shared child through the Gen API copies it
+    vassign = vinner.children[0]
+    assert vassign is not assign
+    vassign.root.expr = "2.0"
+    assert vinner.root.content[0] is vassign.root
+    assert assign.root.expr == "0.0"
+    gen = str(sub.root)
+    print gen
+    assert gen.count("DO i=1,n") == 1
+    assert gen.count("DO i=2,n-1") == 1
+    assert gen.count("a(i,j) = 0.0") == 1
+    assert gen.count("a(i,j) = 2.0") == 1
+    assert gen.count("b(i,j) = 1.0") == 1
+    # the original loop nest is unchanged
+    assert str(outer.root) in original
+
+
+def test_clone_subroutine():
+    ''' Check that declarations added to a cloned subroutine do not
+    affect the original and that disposing of the clone leaves the
+    original intact '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine", implicitnone=True)
+    module.add(sub)
+    sub.add(DeclGen(sub, datatype="integer", entity_decls=["i"]))
+    sub.add(AssignGen(sub, lhs="i", rhs="1"))
+    original = str(sub.root)
+    variant = sub.clone()
+    variant.add(DeclGen(variant, datatype="real", entity_decls=["x"]))
+    variant.add(DeclGen(variant, datatype="integer", entity_decls=["i"]))
+    variant_code = str(variant.root)
+    assert "REAL x" in variant_code
+    assert variant_code.count("INTEGER i") == 1
+    assert str(sub.root) == original
+    variant.dispose()
+    assert str(sub.root) == original
+
+
+def test_clone_module_dispose():
+    ''' Check that disposing of a clone of a module, including the parts
+    of it that have been copied, leaves the original intact '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    sub.add(AssignGen(sub, lhs="a", rhs="1"))
+    original = str(module.root)
+    variant = module.clone()
+    vsub = variant.children[-1]
+    vsub.add(AssignGen(vsub, lhs="b", rhs="2"))
+    assert "b = 2" in str(variant.root)
+    variant.dispose()
+    assert str(module.root) == original
+    assert module.children[-1] is sub
+
+
+def test_clone_args():
+    ''' Check that changing the arguments of a copy-on-write view of a
+    subroutine in a cloned module does not change the original '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine", args=["a"])
+    module.add(sub)
+    variant = module.clone()
+    view = variant.children[-1]
+    view.args.append("b")
+    assert sub.args == ["a"]
+    assert view.args == ["a", "b"]
+    variant = module.clone()
+    view = variant.children[-1]
+    view.args = ["c"]
+    assert sub.args == ["a"]
+    assert "SUBROUTINE testsubroutine(c)" in str(variant.root)
+    assert "SUBROUTINE testsubroutine(a)" in str(module.root)
+
+
+def test_clone_list_attributes():
+    ''' Check that modifying the list attributes (other than content)
+    of a clone does not modify the original '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine", args=["a"])
+    module.add(sub)
+    decl = DeclGen(sub, datatype="integer", entity_decls=["a"])
+    sub.add(decl)
+    sub.add(CommentGen(sub, " a comment"))
+    variant = sub.clone()
+    variant.args.append("b")
+    variant.children[0].root.entity_decls.append("b")
+    assert sub.args == ["a"]
+    assert decl.root.entity_decls == ["a"]
+    assert "SUBROUTINE testsubroutine(a, b)" in str(variant.root)
+    assert "INTEGER a, b" in str(variant.root)
+    # the content of a comment is its text, not a list of statements
+    comment = copy_node(sub.children[1].root)
+    assert str(comment) == str(sub.children[1].root)
+
+
+STENCIL = """\
+unew(i) = c * (u(i-1) + u(i+1))
+if (unew(i) > umax) then
+  unew(i) = umax
+end if
+"""
+
+
+def test_templategen_add_to_loop():
+    ''' Check that a template can be instantiated more than once with
+    different values and added to a loop '''
+    template = TemplateGen(STENCIL, placeholders=["unew", "u", "c", "umax"])
+    assert template.placeholders == ["c", "u", "umax", "unew"]
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    loop = DoGen(sub, "i", "2", "n-1")
+    sub.add(loop)
+    loop.add(CommentGen(loop, "last"))
+    stmts = template.add_to(loop, {"unew": "b", "u": "a", "c": "0.5",
+                                   "umax": "amax"},
+                            position=["first"])
+    assert len(stmts) == 2
+    assert stmts[1].content[0].parent is stmts[1]
+    template.add_to(loop, {"UNEW": "y", "u": "x", "c": "(1.0-w)",
+                           "umax": "1.0"})
+    gen = str(sub.root)
+    print gen
+    expected = (
+        "      DO i=2,n-1\n"
+        "        b(i) = 0.5 * (a(i-1) + a(i+1))\n"
+        "        IF (b(i) > amax) THEN\n"
+        "          b(i) = amax\n"
+        "        END IF \n"
+        "        !last\n"
+        "        y(i) = (1.0-w) * (x(i-1) + x(i+1))\n"
+        "        IF (y(i) > 1.0) THEN\n"
+        "          y(i) = 1.0\n"
+        "        END IF \n"
+        "      END DO")
+    assert expected in gen
+
+
+def test_templategen_add_to_subroutine():
+    ''' Check that a template is added to the end of the body of a
+    subroutine and that the statements it creates are independent '''
+    template = TemplateGen("call kern(fld, 1)\nfld = 0", ["fld"])
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    sub.add(DeclGen(sub, datatype="integer", entity_decls=["f1", "f2"]))
+    first = template.add_to(sub, {"fld": "f1"})
+    template.add_to(sub, {"fld": "f2"})
+    first[1].expr = "1"
+    gen = str(sub.root)
+    assert ("      INTEGER f1, f2\n"
+            "      CALL kern(f1, 1)\n"
+            "      f1 = 1\n"
+            "      CALL kern(f2, 1)\n"
+            "      f2 = 0\n"
+            "    END SUBROUTINE testsubroutine") in gen
+
+
+def test_templategen_instances_independent():
+    ''' Check that the list attributes of instances of a template are
+    not shared with each other or with the template '''
+    template = TemplateGen("call kern(x, 1)\nfld = 0", ["fld"])
+    module = ModuleGen(name="testmodule")
+    first = template.instantiate(module, {"fld": "f1"})
+    second = template.instantiate(module, {"fld": "f2"})
+    first[0].items.append("y")
+    assert second[0].items == ["x", "1"]
+    assert template.instantiate(module, {"fld": "f3"})[0].items == \
+        ["x", "1"]
+
+
+def test_templategen_variables_only():
+    ''' Check that placeholders are only replaced where they are used as
+    variables, not as component names, keywords or within strings '''
+    template = TemplateGen(
+        "a%n = n + f(n=n, b='n')\ndo n = 1, a%m(n)%n\nend do\n",
+        ["n", "a"])
+    module = ModuleGen(name="testmodule")
+    stmts = template.instantiate(module, {"n": "k", "a": "fld(1)"})
+    code = "\n".join(line.strip() for stmt in stmts
+                     for line in str(stmt).split("\n"))
+    assert code == ("fld(1)%n = k + f(n=k, b='n')\n"
+                    "DO k = 1, fld(1)%m(k)%n\n"
+                    "END DO")
+    with pytest.raises(RuntimeError) as err:
+        TemplateGen("a = b +* c", ["b"])
+    assert "Cannot find the variables in the Fortran expression 'b +* c'" \
+        in str(err)
+
+
+def test_templategen_wrong_values():
+    ''' Check that we raise an error if the values supplied to a template
+    do not match its placeholders '''
+    template = TemplateGen("a = b", ["a", "b"])
+    module = ModuleGen(name="testmodule")
+    with pytest.raises(RuntimeError) as err:
+        template.instantiate(module, {"a": "x", "c": "y"})
+    assert "was not given ['b'] and was given unknown names ['c']" in \
+        str(err)
+
+
+def test_symbol_table_lookup():
+    ''' Check that declarations and use statements are recorded in the
+    symbol table of their scope and that lookups search enclosing
+    scopes '''
+    module = ModuleGen(name="testmodule")
+    mdecl = DeclGen(module, datatype="real", entity_decls=["Scale"])
+    module.add(mdecl)
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    decl = DeclGen(sub, datatype="integer", entity_decls=["n", "a(n)"],
+                   intent="in")
+    sub.add(decl)
+    tdecl = TypeDeclGen(sub, datatype="field_type", entity_decls=["fld"])
+    sub.add(tdecl)
+    use = UseGen(sub, name="kinds", only=True, funcnames=["r_def",
+                                                         "i=>i_def"])
+    sub.add(use)
+    symbol = sub.lookup("A")
+    assert symbol.name == "a"
+    assert symbol.node is decl
+    assert symbol.datatype == "integer"
+    assert symbol.attributes == ["intent(in)"]
+    assert sub.lookup("fld").datatype == "type(field_type)"
+    assert sub.lookup("i").node is use
+    assert sub.lookup("i").datatype is None
+    assert sub.lookup("i_def") is None
+    # found in the enclosing scope
+    assert sub.lookup("scale").node is mdecl
+    assert "scale" not in sub.symbols
+    assert module.lookup("n") is None
+    # declarations bubbled up from a loop are in the subroutine's table
+    loop = DoGen(sub, "j", "1", "n")
+    sub.add(loop)
+    loop.add(DeclGen(loop, datatype="integer", entity_decls=["j"]))
+    assert sub.lookup("j").datatype == "integer"
+    # declarations added at an explicit position are also recorded
+    sub.add(DeclGen(sub, datatype="real", entity_decls=["x"]),
+            position=["first"])
+    assert sub.lookup("x").datatype == "real"
+
+
+def test_symbol_table_deduplication():
+    ''' Check that a variable is not declared twice with the same type
+    regardless of case '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    sub.add(DeclGen(sub, datatype="integer", entity_decls=["I"]))
+    sub.add(DeclGen(sub, datatype="integer", entity_decls=["i", "j"]))
+    sub.add(TypeDeclGen(sub, datatype="My_Type", entity_decls=["t"]))
+    sub.add(TypeDeclGen(sub, datatype="my_type", entity_decls=["T"]))
+    gen = str(sub.root)
+    assert count_lines(sub.root, "INTEGER") == 2
+    assert "INTEGER j" in gen
+    assert count_lines(sub.root, "TYPE(") == 1
+
+
+def test_symbol_table_removed_declaration():
+    ''' Check that a declaration or use statement that is disposed of or
+    removed by an edit journal is no longer in the symbol table and can
+    be added again '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    decl = DeclGen(sub, datatype="integer", entity_decls=["i"])
+    sub.add(decl)
+    use = UseGen(sub, name="fred")
+    sub.add(use)
+    decl.dispose()
+    assert sub.lookup("i") is None
+    sub.add(DeclGen(sub, datatype="integer", entity_decls=["i"]))
+    assert count_lines(sub.root, "INTEGER i") == 1
+    with sub.edits() as edits:
+        edits.remove(use)
+    sub.add(UseGen(sub, name="fred"))
+    assert count_lines(sub.root, "USE fred") == 1
+    assert sorted(sub.symbols) == ["i"]
+
+
+def test_symbol_table_clone():
+    ''' Check that a cloned scope has its own symbol table '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    sub.add(DeclGen(sub, datatype="integer", entity_decls=["i"]))
+    variant = sub.clone()
+    variant.add(DeclGen(variant, datatype="integer", entity_decls=["j"]))
+    assert variant.lookup("i").datatype == "integer"
+    assert variant.lookup("j").datatype == "integer"
+    assert sub.lookup("j") is None
+
+
+def test_new_name():
+    ''' Check that new_name() returns names that do not clash with any
+    declared name, argument or previously returned name '''
+    module = ModuleGen(name="testmodule")
+    module.add(DeclGen(module, datatype="integer", entity_decls=["tmp_2"]))
+    sub = SubroutineGen(module, name="testsubroutine", args=["TMP_3"])
+    module.add(sub)
+    sub.add(DeclGen(sub, datatype="real", entity_decls=["tmp_1"]))
+    assert sub.new_name("tmp") == "tmp_4"
+    assert sub.new_name("tmp") == "tmp_5"
+    assert sub.new_name("idx") == "idx_1"
+    sub.add(DeclGen(sub, datatype="real", entity_decls=["idx_2"]))
+    assert sub.new_name("idx") == "idx_3"
+    # names are not declared unless a datatype is supplied
+    assert sub.lookup("tmp_4") is None
+    assert sub.new_name("testsubroutine") == "testsubroutine_1"
+    # names that are used but not declared are not returned either
+    sub.add(AssignGen(sub, lhs="work_1", rhs="ext_1(work_2)"))
+    sub.add(CallGen(sub, "Work_3"))
+    assert sub.new_name("work") == "work_4"
+    assert sub.new_name("ext") == "ext_2"
+
+
+def test_new_name_declare():
+    ''' Check that new_name() declares the new name if a datatype is
+    supplied '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    name = sub.new_name("cell", datatype="integer", kind="i_def")
+    assert name == "cell_1"
+    assert sub.lookup(name).datatype == "integer"
+    assert "INTEGER(KIND=i_def) cell_1" in str(sub.root)
+    # the module has its own counters but does not return a name used
+    # by a subroutine it contains
+    assert module.new_name("idx") == "idx_1"
+    assert module.new_name("cell") == "cell_2"
+
+
+def test_selectiongen_addcases():
+    ''' Check that SelectionGen.addcases() adds the cases in order and
+    before the default case '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    sgen = SelectionGen(sub, expr="my_var")
+    sub.add(sgen)
+    sgen.adddefault()
+    sgen.addcases([("10", [AssignGen(sgen, lhs="a", rhs="1")]),
+                   (["20", "30"], [AssignGen(sgen, lhs="a", rhs="2")])])
+    sgen.addcase(40)
+    gen = str(sub.root)
+    print gen
+    expected = ("SELECT CASE ( my_var )\n"
+                "CASE ( 10 )\n"
+                "        a = 1\n"
+                "CASE ( 20, 30 )\n"
+                "        a = 2\n"
+                "CASE ( 40 )\n"
+                "CASE DEFAULT\n"
+                "      END SELECT")
+    assert expected in gen
+
+
+def test_selectiongen_addcases_merge_ranges():
+    ''' Check that SelectionGen.addcases() merges adjacent integer cases
+    with the same content into ranges when asked to '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    sgen = SelectionGen(sub, expr="my_var")
+    sub.add(sgen)
+    table = [(value, [CallGen(sgen, "low")]) for value in range(1, 5)]
+    table.append((5, [CallGen(sgen, "high")]))
+    table.append((7, [CallGen(sgen, "high")]))
+    table.append(("x", [CallGen(sgen, "high")]))
+    sgen.addcases(table, merge_ranges=True)
+    gen = str(sub.root)
+    print gen
+    expected = ("SELECT CASE ( my_var )\n"
+                "CASE ( 1 : 4 )\n"
+                "        CALL low\n"
+                "CASE ( 5 )\n"
+                "        CALL high\n"
+                "CASE ( 7 )\n"
+                "        CALL high\n"
+                "CASE ( x )\n"
+                "        CALL high\n"
+                "      END SELECT")
+    assert expected in gen
+
+
+def test_selectiongen_adddispatch_table():
+    ''' Check that SelectionGen.adddispatch() replaces the select block
+    with a call through a table of procedure pointers when the keys are
+    dense '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine", args=["kid", "a"])
+    module.add(sub)
+    sgen = SelectionGen(sub, expr="kid")
+    sub.add(sgen)
+    assert sgen.adddispatch({1: "kern_a", 2: "kern_b", 4: "kern_c"},
+                            args=["a"])
+    gen = str(module.root)
+    print gen
+    assert "SELECT" not in gen
+    expected_decls = (
+        "    TYPE dispatch_entry_1\n"
+        "      PROCEDURE (kern_a) , POINTER, NOPASS :: proc => null()\n"
+        "    END TYPE dispatch_entry_1\n"
+        "    TYPE(dispatch_entry_1), save :: dispatch_table_1(1:4)\n"
+        "    LOGICAL, save :: dispatch_init_1 = .false.\n"
+        "    CONTAINS\n")
+    assert expected_decls in gen
+    expected_call = (
+        "      IF (.NOT. dispatch_init_1) THEN\n"
+        "        !$omp critical (dispatch_table_1)\n"
+        "        IF (.NOT. dispatch_init_1) THEN\n"
+        "          dispatch_table_1(1)%proc => kern_a\n"
+        "          dispatch_table_1(2)%proc => kern_b\n"
+        "          dispatch_table_1(4)%proc => kern_c\n"
+        "          !$omp flush\n"
+        "          dispatch_init_1 = .TRUE.\n"
+        "        END IF \n"
+        "        !$omp end critical (dispatch_table_1)\n"
+        "      END IF \n"
+        "      IF (kid >= 1 .AND. kid <= 4) THEN\n"
+        "        IF (ASSOCIATED(dispatch_table_1(kid)%proc)) THEN\n"
+        "          CALL dispatch_table_1(kid)%proc(a)\n"
+        "        END IF \n"
+        "      END IF \n")
+    assert expected_call in gen
+    # the only fence is within the one-time initialisation
+    assert gen.count("!$omp flush") == 1
+
+
+def test_selectiongen_adddispatch_existing_cases():
+    ''' Check that SelectionGen.adddispatch() adds cases, rather than
+    replacing the select block, if it already has cases '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine", args=["kid"])
+    module.add(sub)
+    sgen = SelectionGen(sub, expr="kid")
+    sub.add(sgen)
+    sgen.adddefault()
+    assert not sgen.adddispatch({1: "kern_a", 2: "kern_b"})
+    gen = str(module.root)
+    assert "dispatch" not in gen
+    assert ("CASE ( 2 )\n"
+            "        CALL kern_b\n"
+            "CASE DEFAULT\n") in gen
+
+
+def test_selectiongen_adddispatch_sparse():
+    ''' Check that SelectionGen.adddispatch() adds a case for each key
+    when the keys are sparse '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine", args=["kid"])
+    module.add(sub)
+    sgen = SelectionGen(sub, expr="kid")
+    sub.add(sgen)
+    assert not sgen.adddispatch({1: "kern_a", 100: "kern_b"})
+    gen = str(module.root)
+    print gen
+    assert "dispatch" not in gen
+    expected = ("SELECT CASE ( kid )\n"
+                "CASE ( 1 )\n"
+                "        CALL kern_a\n"
+                "CASE ( 100 )\n"
+                "        CALL kern_b\n"
+                "      END SELECT")
+    assert expected in gen
+
+
+def test_directivegen_structured_clauses():
+    ''' Check that the structured clauses of an OpenMP directive are
+    held as data and written in the directive '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    dgen = DirectiveGen(sub, "omp", "begin", "parallel do simd",
+                        "private(i)", schedule=("dynamic", 4), collapse=2,
+                        safelen=8, aligned=["a", "b"], alignment=64)
+    assert dgen.root.schedule == ("dynamic", 4)
+    assert dgen.root.associated_loops == 2
+    assert str(dgen.root).strip() == (
+        "!$omp parallel do simd schedule(dynamic,4), collapse(2), "
+        "safelen(8), aligned(a,b:64), private(i)")
+    dgen.root.set_clauses(schedule="guided")
+    assert str(dgen.root).strip() == \
+        "!$omp parallel do simd schedule(guided), private(i)"
+    assert dgen.root.associated_loops == 1
+    dgen = DirectiveGen(sub, "omp", "end", "do", "", nowait=True)
+    assert str(dgen.root).strip() == "!$omp end do nowait"
+    assert dgen.root.associated_loops == 0
+    dgen = DirectiveGen(sub, "omp", "begin", "barrier", "")
+    assert str(dgen.root).strip() == "!$omp barrier"
+    assert dgen.root.associated_loops == 0
+
+
+def test_directivegen_invalid_clauses():
+    ''' Check that unsupported clauses and directives are rejected '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    with pytest.raises(RuntimeError) as err:
+        DirectiveGen(sub, "omp", "begin", "parallel do", "", nowait=True)
+    assert ("the 'nowait' clause is only supported at the end of an omp "
+            "['do', 'do simd', 'single'] directive but found the begin "
+            "of an omp 'parallel do' directive") in str(err)
+    with pytest.raises(RuntimeError) as err:
+        DirectiveGen(sub, "omp", "begin", "do", "", schedule="fastest")
+    assert "unrecognised schedule kind 'fastest'" in str(err)
+    with pytest.raises(RuntimeError) as err:
+        DirectiveGen(sub, "omp", "begin", "do", "", schedule=("auto", 2))
+    assert "a chunk size cannot be given for the 'auto' schedule" in \
+        str(err)
+    with pytest.raises(RuntimeError) as err:
+        DirectiveGen(sub, "omp", "begin", "simd", "", collapse=0)
+    assert "'collapse' clause requires a positive integer" in str(err)
+    with pytest.raises(RuntimeError) as err:
+        DirectiveGen(sub, "omp", "begin", "simd", "", collapse=True)
+    assert "'collapse' clause requires a positive integer but found " \
+        "'True'" in str(err)
+    for aligned in ["xy", ("x", "y"), (["x", "y"], 64), []]:
+        with pytest.raises(RuntimeError) as err:
+            DirectiveGen(sub, "omp", "begin", "simd", "", aligned=aligned)
+        assert "the 'aligned' clause requires a list of names" in str(err)
+    with pytest.raises(RuntimeError) as err:
+        DirectiveGen(sub, "omp", "begin", "simd", "", alignment=64)
+    assert "an alignment can only be given with the 'aligned' clause" in \
+        str(err)
+    with pytest.raises(RuntimeError) as err:
+        DirectiveGen(sub, "omp", "end", "barrier", "")
+    assert "the omp 'barrier' directive has no 'end' position" in str(err)
+
+
+def test_start_parent_loop_loop_directives():
+    ''' Check that start_parent_loop only includes a preceding directive
+    that applies to the loop '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    barrier = DirectiveGen(sub, "omp", "begin", "barrier", "")
+    sub.add(barrier)
+    loop = DoGen(sub, "it", "1", "10")
+    sub.add(loop)
+    call = CallGen(loop, "testcall")
+    loop.add(call)
+    assert call.start_parent_loop()[1] is loop.root
+    simd = DirectiveGen(sub, "omp", "begin", "simd", "", safelen=4)
+    sub.add(simd, position=["before", loop.root])
+    assert call.start_parent_loop()[1] is simd.root
+
+
+def test_start_parent_loop_parallel():
+    ''' Check that start_parent_loop still returns a preceding parallel
+    directive, which does not itself apply to the loop '''
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsubroutine")
+    module.add(sub)
+    parallel = DirectiveGen(sub, "omp", "begin", "parallel", "")
+    sub.add(parallel)
+    loop = DoGen(sub, "it", "1", "10")
+    sub.add(loop)
+    call = CallGen(loop, "testcall")
+    loop.add(call)
+    assert call.start_parent_loop()[1] is parallel.root
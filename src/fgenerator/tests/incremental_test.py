@@ -0,0 +1,146 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+''' Tests for incremental regeneration of generated modules '''
+
+import os
+import sys
+import pytest
+from fgenerator.gen import ModuleGen, SubroutineGen
+from fgenerator.incremental import Regenerator
+
+CALLS = []
+
+
+def generate(spec, name="testsub"):
+    ''' Generates a module containing the subroutines named in the file
+    spec, recording that it was called '''
+    CALLS.append(spec)
+    module = ModuleGen(name="testmodule")
+    with open(spec) as spec_file:
+        for line in spec_file:
+            module.add(SubroutineGen(module, name=line.strip() + name))
+    return module
+
+
+def _run(output_dir, specs, name="testsub"):
+    ''' Registers a module for each spec file and runs the
+    regeneration. Returns the names of the regenerated files. '''
+    regenerator = Regenerator(output_dir)
+    for spec in specs:
+        regenerator.add(os.path.basename(spec) + ".f90", generate,
+                        inputs=[spec], params={"spec": spec, "name": name})
+    return regenerator.run()
+
+
+def test_regenerator(tmpdir):
+    ''' Check that only the modules whose inputs have changed are
+    regenerated '''
+    output_dir = str(tmpdir.mkdir("out"))
+    spec_a = tmpdir.join("a")
+    spec_a.write("one\n")
+    spec_b = tmpdir.join("b")
+    spec_b.write("two\n")
+    specs = [str(spec_a), str(spec_b)]
+    assert _run(output_dir, specs) == ["a.f90", "b.f90"]
+    assert "SUBROUTINE onetestsub" in \
+        open(os.path.join(output_dir, "a.f90")).read()
+    del CALLS[:]
+    assert _run(output_dir, specs) == []
+    assert CALLS == []
+    # change an input file
+    spec_b.write("three\n")
+    assert _run(output_dir, specs) == ["b.f90"]
+    assert "SUBROUTINE threetestsub" in \
+        open(os.path.join(output_dir, "b.f90")).read()
+    # change a parameter
+    assert _run(output_dir, specs, name="x") == ["a.f90", "b.f90"]
+    # remove an output file
+    os.remove(os.path.join(output_dir, "a.f90"))
+    assert _run(output_dir, specs, name="x") == ["a.f90"]
+
+
+def test_regenerator_imported_sources(tmpdir):
+    ''' Check that a module is regenerated when a module in the package
+    of its generator, which the generator imports indirectly, changes '''
+    package = tmpdir.mkdir("genpkg")
+    package.join("__init__.py").write("")
+    package.join("generate.py").write(
+        "from . import names\n"
+        "def generate():\n"
+        "    from fgenerator.gen import ModuleGen\n"
+        "    return ModuleGen(name=names.module_name())\n")
+    package.join("names.py").write(
+        "def module_name():\n"
+        "    from genpkg.prefix import PREFIX\n"
+        "    return PREFIX + 'module'\n")
+    prefix = package.join("prefix.py")
+    prefix.write("PREFIX = 'one'\n")
+    output_dir = str(tmpdir.mkdir("out"))
+    sys.path.insert(0, str(tmpdir))
+    try:
+        from genpkg.generate import generate as generate_module
+        regenerator = Regenerator(output_dir)
+        regenerator.add("gen.f90", generate_module)
+        assert regenerator.run() == ["gen.f90"]
+        sources = [os.path.basename(path) for path in
+                   regenerator._sources(generate_module)]
+        assert sources == ["generate.py", "__init__.py", "names.py",
+                           "prefix.py"]
+        regenerator = Regenerator(output_dir)
+        regenerator.add("gen.f90", generate_module)
+        assert regenerator.run() == []
+        prefix.write("PREFIX = 'three'\n")
+        # make sure that the change is seen even within the same second
+        mtime = os.stat(str(prefix)).st_mtime + 10
+        os.utime(str(prefix), (mtime, mtime))
+        del sys.modules["genpkg.prefix"]
+        regenerator = Regenerator(output_dir)
+        regenerator.add("gen.f90", generate_module)
+        assert regenerator.run() == ["gen.f90"]
+        assert "MODULE threemodule" in \
+            open(os.path.join(output_dir, "gen.f90")).read()
+    finally:
+        sys.path.remove(str(tmpdir))
+        for name in list(sys.modules):
+            if name.split(".")[0] == "genpkg":
+                del sys.modules[name]
+
+
+def test_regenerator_params():
+    ''' Check that params which cannot be recorded in the manifest are
+    rejected when the module is registered '''
+    regenerator = Regenerator("out")
+    with pytest.raises(RuntimeError) as excinfo:
+        regenerator.add("a.f90", generate, params={"spec": object()})
+    assert "The params for 'a.f90' must be JSON-serialisable" in \
+        str(excinfo.value)
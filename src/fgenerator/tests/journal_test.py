@@ -0,0 +1,148 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+''' Tests for queuing edits and applying them together '''
+
+import pytest
+from fgenerator.gen import DeclGen, CallGen, CommentGen
+from fgenerator.modify import ModifiedSource
+from modify_test import SOURCE
+from utils import create_subroutine
+
+
+def test_journal_gen():
+    ''' Check that queued edits are applied together, relative to the
+    original content, and update the symbol table '''
+    _, sub = create_subroutine(declarations=[("integer", ["i"])])
+    decl = sub.children[0]
+    first = CallGen(sub, "first")
+    sub.add(first)
+    second = CallGen(sub, "second")
+    sub.add(second)
+    original = str(sub.root)
+    with sub.edits() as edits:
+        edits.insert_after(first, CallGen(sub, "after_first"))
+        edits.insert_before(second, CommentGen(sub, " before second"))
+        edits.remove(first)
+        edits.replace(decl, DeclGen(sub, datatype="real",
+                                    entity_decls=["x"]))
+        edits.append(sub, [CallGen(sub, "last")])
+        # edits at the same place are applied in the order queued
+        edits.insert(sub, 0, CommentGen(sub, " start"))
+        # nothing happens until the edits are committed
+        assert str(sub.root) == original
+    code = str(sub.root)
+    print code
+    expected = ("    SUBROUTINE testsub()\n"
+                "      REAL x\n"
+                "      ! start\n"
+                "      CALL after_first\n"
+                "      ! before second\n"
+                "      CALL second\n"
+                "      CALL last\n"
+                "    END SUBROUTINE testsub")
+    assert expected in code
+    assert [type(child).__name__ for child in sub.children] == \
+        ["DeclGen", "CommentGen", "CallGen", "CommentGen", "CallGen",
+         "CallGen"]
+    assert sub.lookup("i") is None
+    assert sub.lookup("x").datatype == "real"
+    edits.rollback()
+    assert str(sub.root) == original
+    assert sub.lookup("i").datatype == "integer"
+    assert sub.lookup("x") is None
+
+
+def test_journal_discard_and_errors():
+    ''' Check that the edits are discarded if the with block raises an
+    exception and that invalid edits are rejected '''
+    _, sub = create_subroutine(declarations=[("integer", ["i"])])
+    first = CallGen(sub, "first")
+    sub.add(first)
+    sub.add(CallGen(sub, "second"))
+    original = str(sub.root)
+    with pytest.raises(ValueError):
+        with sub.edits() as edits:
+            edits.remove(first)
+            raise ValueError("rejected")
+    assert str(sub.root) == original
+    _, other = create_subroutine()
+    other_call = CallGen(other, "other")
+    other.add(other_call)
+    edits = sub.edits()
+    with pytest.raises(RuntimeError) as err:
+        edits.insert(sub, 10, CallGen(sub, "late"))
+    assert "Index 10 is out of range for a block with 4" in str(err)
+    with pytest.raises(RuntimeError) as err:
+        edits.insert(first, 0, CallGen(sub, "inner"))
+    assert "can only be made to the content of a block" in str(err)
+    # a journal only edits the tree it was created for
+    with pytest.raises(RuntimeError) as err:
+        edits.insert_before(other_call, CallGen(other, "before"))
+    assert "Edits can only be made to the tree that the journal was " \
+        "created for but 'Subroutine' is in a different tree" in str(err)
+    with pytest.raises(RuntimeError) as err:
+        edits.append(other, CallGen(other, "last"))
+    assert "is in a different tree" in str(err)
+    edits = other.edits()
+    edits.append(other, CallGen(other, "last"))
+    other.root.content.remove(other_call.root)
+    with pytest.raises(RuntimeError) as err:
+        edits.remove(other_call)
+    assert "'Call' is not in the content of its parent" in str(err)
+
+
+def test_journal_modified_source():
+    ''' Check that edits to a parsed source are recorded for splicing
+    and that rolling them back restores the original text '''
+    source = ModifiedSource(SOURCE)
+    module = source.tree.content[1]
+    sub = source.units.get("s")
+    loop = sub.content[1]
+    call = ModifiedSource("subroutine t()\n  call baz(i)\n"
+                          "end subroutine t\n").tree.content[0].content[0]
+    with source.edits() as edits:
+        edits.remove(module.content[2])
+        edits.replace(loop.content[0], call)
+    assert source.splice() == SOURCE.replace(
+        "  integer :: x, &\n             y\n", "").replace(
+            "       call bar(i)   ! original spacing\n",
+            "       CALL baz(i)\n")
+    edits.rollback()
+    assert source.splice() == SOURCE
+    assert source.units.get("s") is sub
+    # the journal of one source cannot edit the tree of another
+    other = ModifiedSource(SOURCE)
+    with pytest.raises(RuntimeError) as err:
+        edits.remove(other.tree.content[1].content[2])
+    assert "is in a different tree" in str(err)
+    assert other.splice() == SOURCE
@@ -0,0 +1,321 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+''' Tests for recording edits to existing source and applying them to
+the original text '''
+
+import pytest
+from fgenerator.modify import ModifiedSource, adduse, adduse_many, \
+    apply_to_files
+
+SOURCE = (
+    "! header comment\n"
+    "module m\n"
+    "  use a\n"
+    "  implicit none\n"
+    "  integer :: x, &\n"
+    "             y\n"
+    "contains\n"
+    "  subroutine s(x)\n"
+    "    integer, intent(in) :: x\n"
+    "    do i = 1, 2\n"
+    "       call bar(i)   ! original spacing\n"
+    "    end do\n"
+    "  end subroutine s\n"
+    "end module m\n")
+
+
+def test_splice_insert_and_change():
+    ''' Check that inserted and changed statements are spliced into the
+    original text without reformatting anything else '''
+    source = ModifiedSource(SOURCE)
+    module = source.tree.content[1]
+    sub = module.content[4]
+    adduse("fred", sub, only=True, funcnames=["x"])
+    adduse("b", module)
+    call = sub.content[2].content[0]
+    call.designator = "baz"
+    source.changed(call)
+    assert source.splice() == (
+        "! header comment\n"
+        "module m\n"
+        "  USE b\n"
+        "  use a\n"
+        "  implicit none\n"
+        "  integer :: x, &\n"
+        "             y\n"
+        "contains\n"
+        "  subroutine s(x)\n"
+        "    USE fred, ONLY: x\n"
+        "    integer, intent(in) :: x\n"
+        "    do i = 1, 2\n"
+        "       CALL baz(i)\n"
+        "    end do\n"
+        "  end subroutine s\n"
+        "end module m\n")
+
+
+def test_splice_remove():
+    ''' Check that removing a statement removes all of its lines and
+    that edits within it are ignored '''
+    source = ModifiedSource(SOURCE)
+    module = source.tree.content[1]
+    decl = module.content[2]
+    module.content.remove(decl)
+    source.removed(decl)
+    sub = module.content[3]
+    loop = sub.content[1]
+    adduse("fred", sub)
+    source.changed(loop.content[0])
+    sub.content.remove(loop)
+    source.removed(loop)
+    assert source.splice() == (
+        "! header comment\n"
+        "module m\n"
+        "  use a\n"
+        "  implicit none\n"
+        "contains\n"
+        "  subroutine s(x)\n"
+        "    USE fred\n"
+        "    integer, intent(in) :: x\n"
+        "  end subroutine s\n"
+        "end module m\n")
+
+
+def test_diff():
+    ''' Check that the edits are output as a unified diff with separate
+    hunks for edits that are far apart '''
+    lines = ["module m\n"] + \
+        ["  integer :: v{0}\n".format(idx) for idx in range(20)] + \
+        ["contains\n", "  subroutine s()\n", "  end subroutine s\n",
+         "end module m\n"]
+    source = ModifiedSource("".join(lines), "m.f90")
+    assert source.diff() == ""
+    module = source.tree.content[0]
+    adduse("first", module)
+    decl = module.content[11]
+    module.content.remove(decl)
+    source.removed(decl)
+    adduse("second", module.content[-2])
+    assert source.diff() == (
+        "--- m.f90\n"
+        "+++ m.f90\n"
+        "@@ -1,4 +1,5 @@\n"
+        " module m\n"
+        "+  USE first\n"
+        "   integer :: v0\n"
+        "   integer :: v1\n"
+        "   integer :: v2\n"
+        "@@ -9,7 +10,6 @@\n"
+        "   integer :: v7\n"
+        "   integer :: v8\n"
+        "   integer :: v9\n"
+        "-  integer :: v10\n"
+        "   integer :: v11\n"
+        "   integer :: v12\n"
+        "   integer :: v13\n"
+        "@@ -21,5 +21,6 @@\n"
+        "   integer :: v19\n"
+        " contains\n"
+        "   subroutine s()\n"
+        "+    USE second\n"
+        "   end subroutine s\n"
+        " end module m\n")
+
+
+def test_write(tmpdir):
+    ''' Check that write() applies the edits to the source file '''
+    path = tmpdir.join("m.f90")
+    path.write(SOURCE)
+    source = ModifiedSource.fromfile(str(path))
+    assert not source.write()
+    adduse("fred", source.tree.content[1])
+    assert source.write()
+    assert path.read() == SOURCE.replace("  use a\n",
+                                         "  USE fred\n  use a\n")
+
+
+def test_parse_error():
+    ''' Check that source that cannot be parsed raises an error that
+    names it '''
+    with pytest.raises(RuntimeError) as excinfo:
+        ModifiedSource("subroutine s(\n", "bad.f90")
+    assert "Failed to parse 'bad.f90': fparser did not recognise the " \
+        "source" in str(excinfo.value)
+
+
+def _add_use(source):
+    ''' An edit that adds a use statement to the first module '''
+    module = [stmt for stmt in source.tree.content
+              if type(stmt).__name__ == "Module"][0]
+    adduse("fred", module)
+
+
+def _check_name(source):
+    ''' An edit that fails for files whose name contains "bad" '''
+    if "bad" in source.name:
+        raise RuntimeError("bad file")
+
+
+def test_apply_to_files(tmpdir):
+    ''' Check that edits are applied to many files in worker processes
+    and that errors are reported per file '''
+    paths = []
+    for idx in range(6):
+        name = "bad.f90" if idx == 3 else "m{0}.f90".format(idx)
+        path = tmpdir.join(name)
+        path.write(SOURCE)
+        paths.append(str(path))
+    results = apply_to_files(paths, [_check_name, _add_use], jobs=3,
+                             cache_dir=str(tmpdir.join("cache")))
+    assert [result.path for result in results] == paths
+    assert [result.changed for result in results] == \
+        [True, True, True, False, True, True]
+    assert "RuntimeError: bad file" in results[3].error
+    assert results[0].error is None
+    expected = SOURCE.replace("  use a\n", "  USE fred\n  use a\n")
+    assert open(paths[0]).read() == expected
+    assert open(paths[3]).read() == SOURCE
+    # serially
+    results = apply_to_files(paths[:1], [_add_use])
+    assert results[0].changed
+    assert open(paths[0]).read() == \
+        expected.replace("  USE fred\n", "  USE fred\n  USE fred\n")
+
+
+def test_adduse_many():
+    ''' Check that adduse_many() adds new use statements in one go and
+    merges names into existing ones rather than duplicating them '''
+    source = ModifiedSource(
+        "module m\n"
+        "  use a, only: x, y => z\n"
+        "  use b\n"
+        "  implicit none\n"
+        "end module m\n")
+    module = source.tree.content[0]
+    new_uses = adduse_many(module.content[2],
+                           {"a": ["x", "Y=>z", "w", "v => s", "v=>s"],
+                            "b": ["v"], "d": None, "c": ["u", "u"]})
+    assert [use.name for use in new_uses] == ["c", "d"]
+    assert adduse_many(module, {"a": ["w", "y => Z", "v=>s"], "c": ["u"],
+                                "d": ["t"]}) == []
+    with pytest.raises(RuntimeError) as excinfo:
+        adduse_many(module, {"a": ["y"]})
+    assert "Cannot use 'y' from module 'a' as the local name 'y' is " \
+        "already used for 'z'" in str(excinfo.value)
+    assert source.splice() == (
+        "module m\n"
+        "  USE c, ONLY: u\n"
+        "  USE d\n"
+        "  USE a, ONLY: x, y => z, w, v => s\n"
+        "  use b\n"
+        "  implicit none\n"
+        "end module m\n")
+
+
+def test_adduse_many_function():
+    ''' Check that adduse_many() adds use statements to a module
+    function or an external function rather than to its parent '''
+    source = ModifiedSource(
+        "module m\n"
+        "contains\n"
+        "  function f()\n"
+        "    f = 1\n"
+        "  end function f\n"
+        "end module m\n"
+        "function g()\n"
+        "  g = 1\n"
+        "end function g\n")
+    func = source.tree.content[0].content[1]
+    adduse_many(func.content[0], {"a": ["x"]})
+    adduse_many(source.tree.content[1], {"b": None})
+    assert source.splice() == (
+        "module m\n"
+        "contains\n"
+        "  function f()\n"
+        "    USE a, ONLY: x\n"
+        "    f = 1\n"
+        "  end function f\n"
+        "end module m\n"
+        "function g()\n"
+        "  USE b\n"
+        "  g = 1\n"
+        "end function g\n")
+    with pytest.raises(RuntimeError) as excinfo:
+        adduse_many(source.tree, {"c": None})
+    assert "The fparser 'BeginSource' statement is not within a " \
+        "program, module, subroutine or function" in str(excinfo.value)
+
+
+def test_unit_index():
+    ''' Check that the program unit index finds (nested) units and is
+    kept up to date as units are inserted and removed '''
+    source = ModifiedSource(
+        "module m\n"
+        "  interface\n"
+        "    subroutine ext()\n"
+        "    end subroutine ext\n"
+        "  end interface\n"
+        "contains\n"
+        "  subroutine s()\n"
+        "  contains\n"
+        "    function f()\n"
+        "    end function f\n"
+        "  end subroutine s\n"
+        "  subroutine t()\n"
+        "  contains\n"
+        "    function F()\n"
+        "    end function F\n"
+        "  end subroutine t\n"
+        "end module m\n")
+    index = source.units
+    module = index.get("M")
+    sub = index.get("s")
+    assert index.scope(sub) == (module,)
+    assert index.find("ext") == []
+    assert len(index.find("f")) == 2
+    function = index.get("f", scope="s")
+    assert index.scope(function) == (module, sub)
+    with pytest.raises(RuntimeError) as err:
+        index.get("f")
+    assert "Expected one program unit called 'f' but found 2" in str(err)
+    # the index follows edits
+    new_sub = ModifiedSource("subroutine u()\nend subroutine u\n").tree.\
+        content[0]
+    new_sub.parent = module
+    module.content.insert(-1, new_sub)
+    source.inserted(new_sub)
+    assert index.scope(index.get("u")) == (module,)
+    module.content.remove(sub)
+    source.removed(sub)
+    assert index.find("s") == []
+    assert index.get("f") is index.get("f", scope="t")
@@ -0,0 +1,258 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+''' Tests for the analysis of loops that are parallelised with OpenMP '''
+
+import pytest
+from fgenerator.gen import DoGen, CallGen, DeclGen, AssignGen, \
+    DirectiveGen, IfThenGen, TemplateGen
+from fgenerator.openmp import names, reduction
+from utils import create_subroutine
+
+
+DECLARATIONS = [("integer", ["cell", "k", "n", "map(10)"]),
+                ("real", ["tmp", "total", "a(10)", "b(10)"])]
+
+
+def test_names():
+    ''' Check that the names in an expression are found '''
+    assert names("a(i)%b + 1.0e5 * max(c, 'd') .and. e") == \
+        ["a", "i", "max", "c", "e"]
+
+
+def test_infer_clauses():
+    ''' Check that private and shared clauses are inferred for a loop '''
+    _, sub = create_subroutine(declarations=DECLARATIONS)
+    directive = DirectiveGen(sub, "omp", "begin", "parallel do",
+                             "schedule(static)")
+    sub.add(directive)
+    loop = DoGen(sub, "cell", "1", "n")
+    sub.add(loop)
+    inner = DoGen(loop, "k", "1", "map(cell)")
+    loop.add(inner)
+    inner.add(AssignGen(inner, lhs="tmp", rhs="b(cell) * k"))
+    inner.add(AssignGen(inner, lhs="a(cell)", rhs="tmp"))
+    loop.add(CallGen(loop, "kern", ["a(cell)", "n"]))
+    assert directive.infer_clauses() == []
+    assert str(directive.root).strip() == (
+        "!$omp parallel do schedule(static), private(cell,k,tmp), "
+        "shared(a,b,map,n)")
+
+
+def test_infer_clauses_races():
+    ''' Check that possible races are reported and that a worksharing do
+    directive is only given a private clause '''
+    _, sub = create_subroutine(declarations=DECLARATIONS)
+    directive = DirectiveGen(sub, "omp", "begin", "do", "")
+    sub.add(directive)
+    loop = DoGen(sub, "cell", "1", "n")
+    sub.add(loop)
+    loop.add(AssignGen(loop, lhs="total", rhs="total * 2.0 + a(cell)"))
+    loop.add(AssignGen(loop, lhs="b(1)", rhs="a(cell)"))
+    cond = IfThenGen(loop, "a(cell) > 0.0")
+    loop.add(cond)
+    cond.add(AssignGen(cond, lhs="tmp", rhs="a(cell)"))
+    loop.add(AssignGen(loop, lhs="a(cell)", rhs="tmp"))
+    races = directive.infer_clauses()
+    assert len(races) == 3
+    assert "'total = total * 2.0 + a(cell)' assigns to 'total', which is " \
+        "read before it is assigned" in races[0]
+    assert "'b(1) = a(cell)' assigns to an element of 'b' that does not " \
+        "depend on the loop variable 'cell'" in races[1]
+    # tmp keeps its value from an earlier iteration when a(cell) <= 0
+    assert races[2] == (
+        "'tmp = a(cell)' assigns to 'tmp' but not in every iteration and "
+        "'tmp' is read where it may not have been assigned so its value "
+        "may be carried between iterations")
+    assert str(directive.root).strip() == "!$omp do private(cell)"
+    with pytest.raises(RuntimeError) as excinfo:
+        DirectiveGen(sub, "omp", "end", "do", "").infer_clauses()
+    assert "can only be inferred for the beginning" in str(excinfo.value)
+
+
+def test_infer_clauses_conditional():
+    ''' Check that a scalar assigned under a condition is only private
+    where it is read after being assigned in the same branch '''
+    _, sub = create_subroutine(declarations=DECLARATIONS)
+    directive = DirectiveGen(sub, "omp", "begin", "parallel do", "")
+    sub.add(directive)
+    loop = DoGen(sub, "cell", "1", "n")
+    sub.add(loop)
+    TemplateGen("if (a(cell) > 0.0) then\n"
+                "  tmp = a(cell)\n"
+                "  b(cell) = tmp\n"
+                "end if\n").add_to(loop)
+    assert directive.infer_clauses() == []
+    assert str(directive.root).strip() == \
+        "!$omp parallel do private(cell,tmp), shared(a,b)"
+    # tmp is not assigned in the else branch
+    TemplateGen("if (a(cell) > 0.0) then\n"
+                "  tmp = a(cell)\n"
+                "else\n"
+                "  b(cell) = tmp\n"
+                "end if\n").add_to(loop)
+    races = directive.infer_clauses()
+    assert races == [
+        "'tmp = a(cell)' assigns to 'tmp' but not in every iteration and "
+        "'tmp' is read where it may not have been assigned so its value "
+        "may be carried between iterations"]
+
+
+def test_infer_clauses_dependences():
+    ''' Check that reading or writing elements of an array that may be
+    written in another iteration is reported as a race '''
+    _, sub = create_subroutine(declarations=DECLARATIONS + [
+        ("real", ["c(10, 10)"])])
+    directive = DirectiveGen(sub, "omp", "begin", "parallel do", "")
+    sub.add(directive)
+    loop = DoGen(sub, "cell", "2", "n")
+    sub.add(loop)
+    loop.add(AssignGen(loop, lhs="a(cell)", rhs="a(cell - 1) + b(cell)"))
+    loop.add(AssignGen(loop, lhs="b(map(cell))", rhs="0.0"))
+    loop.add(AssignGen(loop, lhs="b(cell)", rhs="1.0"))
+    inner = DoGen(loop, "k", "2", "n")
+    loop.add(inner)
+    # the same column of c is only used by one iteration
+    inner.add(AssignGen(inner, lhs="c(k, cell)", rhs="c(k - 1, cell)"))
+    races = directive.infer_clauses()
+    assert races == [
+        "'a(cell) = a(cell - 1) + b(cell)' assigns to an element of 'a' but "
+        "'a(cell - 1)' is also used in the loop and may refer to an element "
+        "assigned in another iteration",
+        "'b(map(cell)) = 0.0' assigns to an element of 'b' but 'b(cell)' is "
+        "also used in the loop and may refer to an element assigned in "
+        "another iteration"]
+
+
+def test_infer_clauses_lastprivate():
+    ''' Check that a private scalar that is used after the loop is made
+    lastprivate if it is assigned in every iteration and is reported if
+    it is not '''
+    _, sub = create_subroutine(args=["k"], declarations=DECLARATIONS)
+    sub.add(DeclGen(sub, datatype="real", entity_decls=["last", "scale"]))
+    directive = DirectiveGen(sub, "omp", "begin", "parallel do", "")
+    sub.add(directive)
+    loop = DoGen(sub, "cell", "1", "n")
+    sub.add(loop)
+    loop.add(AssignGen(loop, lhs="last", rhs="a(cell)"))
+    loop.add(AssignGen(loop, lhs="k", rhs="map(cell)"))
+    cond = IfThenGen(loop, "a(cell) > 0.0")
+    loop.add(cond)
+    cond.add(AssignGen(cond, lhs="tmp", rhs="a(cell)"))
+    cond.add(AssignGen(cond, lhs="scale", rhs="a(cell)"))
+    cond.add(AssignGen(cond, lhs="b(cell)", rhs="tmp + scale"))
+    sub.add(DirectiveGen(sub, "omp", "end", "parallel do", ""))
+    # tmp is assigned before it is used after the loop but scale is not
+    sub.add(AssignGen(sub, lhs="tmp", rhs="0.0"))
+    sub.add(AssignGen(sub, lhs="total", rhs="last + tmp + scale"))
+    races = directive.infer_clauses()
+    assert races == [
+        "'scale = a(cell)' assigns to 'scale' but not in every iteration "
+        "and 'scale' may be used after the loop, where its value is "
+        "undefined as it is private"]
+    # k is an argument so its value is used by the caller
+    assert str(directive.root).strip() == (
+        "!$omp parallel do private(cell,scale,tmp), lastprivate(k,last), "
+        "shared(a,b,map)")
+
+
+def test_reduction():
+    ''' Check that reductions are recognised '''
+    assert reduction("s", "s + a(i) * b") == ("+", "a(i) * b")
+    assert reduction("s", "a(i) - b + S") == ("+", "a(i) - b")
+    assert reduction("s", "s - a(i) * b") == ("+", "-(a(i) * b)")
+    assert reduction("s", "a(i) * s") == ("*", "a(i)")
+    assert reduction("b(1)", "max(b(1), a(i), 0.0)") == ("max", "a(i), 0.0")
+    assert reduction("flag", "flag .and. a(i) > 0") == \
+        (".and.", "a(i) > 0")
+    assert reduction("s", "s * a(i) + b") is None
+    assert reduction("s", "s - a(i) + b") is None
+    assert reduction("s", "s ** 2") is None
+    assert reduction("s", "s + s2 * 1.0e-5") == ("+", "s2 * 1.0e-5")
+    assert reduction("s", "s + a(s)") is None
+    assert reduction("s", "max(s, a) + min(s, b)") is None
+    assert reduction("s", "sum + 1") is None
+
+
+def test_infer_clauses_reduction():
+    ''' Check that reduction clauses are added for reductions into
+    scalars and that a private variable may be accumulated '''
+    _, sub = create_subroutine(declarations=DECLARATIONS)
+    sub.add(DeclGen(sub, datatype="real", entity_decls=["biggest"]))
+    directive = DirectiveGen(sub, "omp", "begin", "parallel do", "")
+    sub.add(directive)
+    loop = DoGen(sub, "cell", "1", "n")
+    sub.add(loop)
+    loop.add(AssignGen(loop, lhs="tmp", rhs="0.0"))
+    loop.add(AssignGen(loop, lhs="tmp", rhs="tmp + a(cell)"))
+    loop.add(AssignGen(loop, lhs="total", rhs="total + tmp"))
+    loop.add(AssignGen(loop, lhs="biggest", rhs="max(biggest, tmp)"))
+    loop.add(AssignGen(loop, lhs="total", rhs="b(cell) + total"))
+    assert directive.infer_clauses() == []
+    assert str(directive.root).strip() == (
+        "!$omp parallel do private(cell,tmp), reduction(+:total), "
+        "reduction(max:biggest), shared(a,b)")
+
+
+def test_infer_clauses_partial():
+    ''' Check that a reduction into an array element is made into a
+    reduction into padded per-thread partial results '''
+    _, sub = create_subroutine(declarations=DECLARATIONS)
+    directive = DirectiveGen(sub, "omp", "begin", "parallel do", "")
+    sub.add(directive)
+    loop = DoGen(sub, "cell", "1", "n")
+    sub.add(loop)
+    loop.add(AssignGen(loop, lhs="b(3)", rhs="b(3) + a(cell)"))
+    sub.add(DirectiveGen(sub, "omp", "end", "parallel do", ""))
+    assert directive.infer_clauses() == []
+    code = str(sub.root)
+    assert "USE omp_lib, ONLY: omp_get_max_threads, omp_get_thread_num" \
+        in code
+    assert "INTEGER nthreads_1" in code
+    assert "REAL, allocatable, dimension(:,:) :: b_partial_1" in code
+    expected = (
+        "      nthreads_1 = omp_get_max_threads()\n"
+        "      ALLOCATE (b_partial_1(16, 0:nthreads_1 - 1))\n"
+        "      b_partial_1(1, :) = 0\n"
+        "      !$omp parallel do private(cell,thread_1), "
+        "shared(a,b_partial_1)\n"
+        "      DO cell=1,n\n"
+        "        thread_1 = omp_get_thread_num()\n"
+        "        b_partial_1(1, thread_1) = b_partial_1(1, thread_1) + "
+        "a(cell)\n"
+        "      END DO \n"
+        "      !$omp end parallel do\n"
+        "      DO thread_1=0,nthreads_1 - 1\n"
+        "        b(3) = b(3) + b_partial_1(1, thread_1)\n"
+        "      END DO \n"
+        "      DEALLOCATE (b_partial_1)\n")
+    assert expected in code
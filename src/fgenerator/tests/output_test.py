@@ -0,0 +1,73 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+''' Tests for writing generated code only when it has changed '''
+
+import os
+from fgenerator.gen import ModuleGen, SubroutineGen
+from fgenerator.output import write_if_changed, _BLOCK_SIZE
+
+
+def test_write_if_changed(tmpdir):
+    ''' Check that a file is only rewritten when its content changes '''
+    path = str(tmpdir.join("code.f90"))
+    assert write_if_changed(path, "x = 1\n")
+    os.utime(path, (1000, 1000))
+    assert not write_if_changed(path, "x = 1\n")
+    assert os.stat(path).st_mtime == 1000
+    # same size, different content
+    assert write_if_changed(path, "x = 2\n")
+    assert open(path).read() == "x = 2\n"
+    assert write_if_changed(path, "x = 10\n")
+    assert open(path).read() == "x = 10\n"
+    # a difference in a later block of a file larger than one block
+    text = "x = 1\n" * (_BLOCK_SIZE // 3)
+    assert write_if_changed(path, text)
+    assert not write_if_changed(path, text)
+    changed = text[:-2] + "2\n"
+    assert write_if_changed(path, changed)
+    assert open(path).read() == changed
+    # no temporary files are left behind
+    assert os.listdir(str(tmpdir)) == ["code.f90"]
+
+
+def test_modulegen_write_to(tmpdir):
+    ''' Check that ModuleGen.write_to() writes the module's code and
+    reports whether the file changed '''
+    path = str(tmpdir.join("testmodule.f90"))
+    module = ModuleGen(name="testmodule")
+    assert module.write_to(path)
+    assert open(path).read() == str(module.root) + "\n"
+    assert not module.write_to(path)
+    module.add(SubroutineGen(module, name="testsub"))
+    assert module.write_to(path)
+    assert "SUBROUTINE testsub" in open(path).read()
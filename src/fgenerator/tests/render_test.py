@@ -0,0 +1,142 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+''' Tests for the single-pass Fortran renderer '''
+
+from fgenerator.gen import ModuleGen, SubroutineGen, DoGen, AssignGen, \
+    DeclGen, TypeDeclGen, UseGen, CallGen, CommentGen, DirectiveGen, \
+    AllocateGen, DeallocateGen, IfThenGen, SelectionGen, TemplateGen
+from fgenerator.render import render, wrap
+from utils import create_subroutine
+
+
+def test_render_matches_str():
+    ''' Check that the renderer produces the same code as fparser for
+    the whole tree and for a subtree '''
+    module, sub = create_subroutine(args=["a", "b"])
+    module.add(DeclGen(module, datatype="integer", entity_decls=["n"]))
+    sub.add(UseGen(sub, name="mod1", only=True, funcnames=["x", "y"]))
+    sub.add(DeclGen(sub, datatype="real", entity_decls=["a(n)"],
+                    intent="inout"))
+    sub.add(TypeDeclGen(sub, datatype="field_type", entity_decls=["b"],
+                        intent="in"))
+    sub.add(CommentGen(sub, " a comment"))
+    sub.add(DirectiveGen(sub, "omp", "begin", "parallel do", "private(i)"))
+    loop = DoGen(sub, "i", "1", "n")
+    sub.add(loop)
+    ifthen = IfThenGen(loop, "a(i) > 0.0")
+    loop.add(ifthen)
+    ifthen.add(AssignGen(ifthen, lhs="a(i)", rhs="0.0"))
+    ifthen.add(AssignGen(ifthen, lhs="p", rhs="b", pointer=True))
+    ifthen.add(CallGen(ifthen, "kern", ["a(i)", "b"]))
+    sub.add(DirectiveGen(sub, "omp", "end", "parallel do", ""))
+    sub.add(AllocateGen(sub, ["c(n)"]))
+    sub.add(DeallocateGen(sub, ["c"]))
+    select = SelectionGen(sub, expr="n")
+    sub.add(select)
+    select.addcases([(1, [CallGen(select, "one")]), (2, [])])
+    select.adddefault()
+    TemplateGen("if (n > 1) n = 1\nx = y\n").add_to(sub)
+    assert render(module.root) == str(module.root)
+    assert module.render() == str(module.root)
+    assert ifthen.render() == str(ifthen.root)
+    # rendering leaves the tree unchanged
+    assert module.render() == str(module.root)
+
+
+def test_render_line_length():
+    ''' Check that long lines are wrapped with continuations when a line
+    length is supplied '''
+    module, sub = create_subroutine()
+    args = ["argument_{0}".format(idx) for idx in range(20)]
+    sub.add(CallGen(sub, "kern", args))
+    code = module.render(line_length=60)
+    print code
+    assert max(len(line) for line in code.split("\n")) <= 60
+    call = code[code.index("CALL"):code.index("END SUBROUTINE")]
+    assert call.replace("&\n      &", "").strip() == \
+        "CALL kern({0})".format(", ".join(args))
+    assert module.render() == str(module.root)
+
+
+def test_wrap():
+    ''' Check that wrap() continues statements and directives and leaves
+    comments and short lines alone '''
+    assert wrap("  x = 1", 10) == ["  x = 1"]
+    assert wrap("  x = 12345678", 10) == ["  x = 123&", "  &45678"]
+    comment = "  ! " + "c" * 20
+    assert wrap(comment, 10) == [comment]
+    assert wrap("  !$omp parallel do private(i)", 20) == \
+        ["  !$omp parallel &", "  !$omp& do &", "  !$omp& private(i)"]
+    # a directive that cannot be broken at a blank or comma is left long
+    assert wrap("  !$omp parallel_do", 10) == ["  !$omp parallel_do"]
+
+
+def test_wrap_directive_clauses():
+    ''' Check that a directive with a long list of clauses is only
+    broken between its clauses or list items '''
+    names = ["variable_{0}".format(idx) for idx in range(12)]
+    line = "      !$omp parallel do schedule(static), private({0})".format(
+        ",".join(names))
+    lines = wrap(line, 40)
+    assert max(len(wrapped) for wrapped in lines) <= 40
+    for wrapped in lines[:-1]:
+        assert wrapped.endswith(" &")
+    for wrapped in lines[1:]:
+        assert wrapped.startswith("      !$omp& ")
+    # joining the lines at the breaks gives back the clauses
+    joined = "".join(wrapped[len("      !$omp& "):] if idx else wrapped
+                     for idx, wrapped in enumerate(
+                         [part[:-2] for part in lines[:-1]] + [lines[-1]]))
+    assert joined.replace(" ", "") == line.replace(" ", "")
+    # no name is split across lines
+    for wrapped in lines[:-1]:
+        assert wrapped[:-2].endswith(",") or \
+            line.count(wrapped[:-2].split()[-1] + " ") == 1
+
+
+def test_render_parallel():
+    ''' Check that rendering the subroutines of a module in worker
+    processes gives the same code as rendering it serially '''
+    module = ModuleGen(name="testmodule")
+    module.add(DeclGen(module, datatype="integer", entity_decls=["n"]))
+    for idx in range(10):
+        sub = SubroutineGen(module, name="sub_{0}".format(idx))
+        module.add(sub)
+        loop = DoGen(sub, "i", "1", "n")
+        sub.add(loop)
+        args = ["argument_{0}".format(arg) for arg in range(idx * 3)]
+        loop.add(CallGen(loop, "kern_{0}".format(idx), args))
+    assert module.render(jobs=3) == str(module.root)
+    assert module.render(jobs=3, line_length=50) == \
+        module.render(line_length=50)
+    assert module.render(jobs=1) == str(module.root)
@@ -0,0 +1,100 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+''' Tests for the source map produced when rendering Gen objects '''
+
+import os
+from fgenerator.gen import ModuleGen, DoGen, AssignGen
+from fgenerator.sourcemap import render, write, SourceMap, MAP_SUFFIX
+from utils import line_number, create_subroutine
+
+
+def test_render_matches_str():
+    ''' Check that the code produced alongside a source map is the
+    same as that produced by fparser '''
+    module, sub = create_subroutine(declarations=[("integer", ["i"])])
+    loop = DoGen(sub, "i", "1", "10")
+    sub.add(loop)
+    loop.add(AssignGen(loop, lhs="a(i)", rhs="0.0"))
+    code, _ = render(module)
+    assert code == str(module.root)
+
+
+def test_gen_origin():
+    ''' Check that a Gen object records where it was created '''
+    module = ModuleGen(name="testmodule")
+    filename, lineno, function = module.origin
+    assert os.path.basename(filename).startswith("sourcemap_test.py")
+    assert function == "test_gen_origin"
+    assert lineno > 0
+
+
+def test_sourcemap_lookup():
+    ''' Check that a line of generated code maps back to the Gen object
+    that produced it and that enclosing lines map to the enclosing Gen
+    objects '''
+    module, sub = create_subroutine(declarations=[("integer", ["i"])])
+    loop = DoGen(sub, "i", "1", "10")
+    sub.add(loop)
+    assign = AssignGen(loop, lhs="a(i)", rhs="0.0")
+    loop.add(assign)
+    code, source_map = render(module)
+    assign_line = line_number(module.root, "a(i) = 0.0") + 1
+    entry = source_map.lookup(assign_line)
+    assert entry.gen_type == "AssignGen"
+    assert entry.start == entry.end == assign_line
+    assert entry.origin == assign.origin
+    assert entry.origin[2] == "test_sourcemap_lookup"
+    # the END DO line belongs to the loop
+    enddo_line = line_number(module.root, "END DO") + 1
+    assert source_map.lookup(enddo_line).gen_type == "DoGen"
+    # the whole module is covered by the ModuleGen entry
+    entry = source_map.entries[0]
+    assert entry.gen_type == "ModuleGen"
+    assert entry.start == 1
+    assert entry.end == len(code.splitlines())
+    assert source_map.lookup(entry.end + 1) is None
+
+
+def test_sourcemap_write(tmpdir):
+    ''' Check that writing code also writes a sidecar source map which
+    can be read back in '''
+    module, sub = create_subroutine()
+    sub.add(AssignGen(sub, lhs="a", rhs="0.0"))
+    path = str(tmpdir.join("testmodule.f90"))
+    source_map = write(module, path)
+    with open(path) as code_file:
+        assert code_file.read() == str(module.root) + "\n"
+    assert os.path.isfile(path + MAP_SUFFIX)
+    loaded = SourceMap.load(path + MAP_SUFFIX)
+    assert ([entry.todict() for entry in loaded.entries] ==
+            [entry.todict() for entry in source_map.entries])
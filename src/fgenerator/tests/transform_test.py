@@ -0,0 +1,255 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+''' Tests for the transformations of trees of Gen objects '''
+
+import pytest
+from fgenerator.gen import SubroutineGen, DoGen, CallGen, \
+    DeclGen, AssignGen
+from fgenerator.modify import ModifiedSource
+from fgenerator.transform import inline_call
+from utils import create_subroutine
+
+KERNEL = (
+    "module kern_mod\n"
+    "contains\n"
+    "  subroutine kern(a, b, n)\n"
+    "    use constants_mod, only: r_def\n"
+    "    integer, intent(in) :: n\n"
+    "    real(kind=r_def), intent(inout) :: a(n)\n"
+    "    real(kind=r_def), intent(in) :: b\n"
+    "    real(kind=r_def) :: tmp(n)\n"
+    "    integer :: k\n"
+    "    do k = 1, n\n"
+    "      tmp(k) = b * k\n"
+    "      a(k) = a(k) + tmp(k)\n"
+    "    end do\n"
+    "  end subroutine kern\n"
+    "end module kern_mod\n")
+
+
+def test_inline_call():
+    ''' Check that a call is replaced by the body of the callee with the
+    arguments substituted and clashing locals renamed '''
+    module, sub = create_subroutine(
+        args=["field"], declarations=[("integer", ["k", "cell"])])
+    loop = DoGen(sub, "cell", "1", "10")
+    sub.add(loop)
+    call = CallGen(loop, "kern", ["field", "x + 1.0", "nlayers"])
+    loop.add(call)
+    callee = ModifiedSource(KERNEL).tree.content[0].content[1]
+    stmts = inline_call(call, callee)
+    assert len(stmts) == 2
+    code = str(module.root)
+    assert "CALL kern" not in code
+    assert "USE constants_mod, ONLY: r_def" in code
+    assert "REAL(KIND=r_def) tmp(nlayers)" in code
+    assert "INTEGER k_1" in code
+    assert "REAL(KIND=r_def) b_1" in code
+    assert "b_1 = x + 1.0\n        DO k_1 = 1, nlayers" in code
+    assert "tmp(k_1) = b_1 * k_1" in code
+    assert "field(k_1) = field(k_1) + tmp(k_1)" in code
+    assert sub.lookup("k_1").datatype == "integer"
+    assert [child.root for child in loop.children] == stmts[:1]
+    # an array section cannot be substituted for an array argument
+    call = CallGen(loop, "kern", ["field(:, cell)", "x", "nlayers"])
+    loop.add(call)
+    with pytest.raises(RuntimeError) as excinfo:
+        inline_call(call, callee)
+    assert "array argument 'a' is passed 'field(:, cell)'" in \
+        str(excinfo.value)
+
+
+def test_inline_call_subroutinegen():
+    ''' Check that a SubroutineGen can be inlined and that calls with the
+    wrong number of arguments are rejected '''
+    module, sub = create_subroutine(
+        args=["field"], declarations=[("integer", ["k", "cell"])])
+    loop = DoGen(sub, "cell", "1", "10")
+    sub.add(loop)
+    call = CallGen(loop, "kern", ["field", "x + 1.0", "nlayers"])
+    loop.add(call)
+    kern = SubroutineGen(module, name="kern", args=["a", "b", "n"])
+    kern.add(DeclGen(kern, datatype="real", entity_decls=["a"],
+                     intent="inout"))
+    kern.add(DeclGen(kern, datatype="real", entity_decls=["b"],
+                     intent="in"))
+    kern.add(DeclGen(kern, datatype="integer", entity_decls=["n"],
+                     intent="in"))
+    kern.add(AssignGen(kern, lhs="a", rhs="a * b + n"))
+    with pytest.raises(RuntimeError) as excinfo:
+        inline_call(CallGen(loop, "kern", ["x"]), kern)
+    assert "called with 1 arguments but has 3" in str(excinfo.value)
+    inline_call(call, kern)
+    assert "b_1 = x + 1.0\n        field = field * b_1 + nlayers" in \
+        str(loop.root)
+
+
+COMPONENTS = (
+    "subroutine kern(f, n, done)\n"
+    "  use field_mod, only: field_type\n"
+    "  type(field_type), intent(inout) :: f\n"
+    "  integer, intent(in) :: n\n"
+    "  logical, intent(out) :: done\n"
+    "  integer, parameter :: depth = 2\n"
+    "  logical :: n_set\n"
+    "  character(len=n) :: label\n"
+    "  type(field_type) :: f_copy\n"
+    "  f%n = n * depth\n"
+    "  n_set = f%n > 0 .and. f%data(n)%n == n\n"
+    "  label = 'n'\n"
+    "  f_copy = f\n"
+    "  call set(f_copy, n=n)\n"
+    "  done = n_set\n"
+    "end subroutine kern\n")
+
+
+def test_inline_call_components():
+    ''' Check that only the variables of the callee are substituted,
+    not components or keywords with the same names, and that local
+    variables of any type are declared in the caller '''
+    module, sub = create_subroutine(
+        args=["field"], declarations=[("integer", ["n_set", "depth"])])
+    call = CallGen(sub, "kern", ["field", "nlayers + 1", "flags(1)%done"])
+    sub.add(call)
+    callee = ModifiedSource(COMPONENTS).tree.content[0]
+    inline_call(call, callee)
+    code = str(module.root)
+    assert "USE field_mod, ONLY: field_type" in code
+    assert "INTEGER, parameter :: depth_1 = 2" in code
+    assert "LOGICAL n_set_1" in code
+    assert "CHARACTER(LEN=(nlayers + 1)) label" in code
+    assert "TYPE(field_type) f_copy" in code
+    assert "INTEGER n_1" in code
+    assert "n_1 = nlayers + 1\n      field%n = n_1 * depth_1" in code
+    assert "n_set_1 = field%n > 0 .and. field%data(n_1)%n == n_1" in code
+    assert "label = 'n'" in code
+    assert "f_copy = field" in code
+    assert "CALL set(f_copy, n=n_1)" in code
+    assert "flags(1)%done = n_set_1" in code
+    assert sub.lookup("label").datatype == "character"
+    assert sub.lookup("f_copy").datatype == "type(field_type)"
+
+
+def test_inline_call_errors():
+    ''' Check that expressions cannot be passed for arguments that are
+    written and that callees with saved local variables are rejected,
+    leaving the caller untouched '''
+    module, sub = create_subroutine(args=["field"])
+    call = CallGen(sub, "kern", ["field", "nlayers", ".true."])
+    sub.add(call)
+    original = str(module.root)
+    callee = ModifiedSource(COMPONENTS).tree.content[0]
+    with pytest.raises(RuntimeError) as excinfo:
+        inline_call(call, callee)
+    assert "Cannot inline 'kern' as its intent(out) argument 'done' is " \
+        "passed '.true.', which is not a variable" in str(excinfo.value)
+    assert str(module.root) == original
+    call = CallGen(sub, "kern", ["field", "nlayers", "done"])
+    sub.add(call)
+    original = str(module.root)
+    saved_variable = "its local variable 'count' is saved"
+    for saved, message in [
+            ("integer :: count = 0\n", saved_variable),
+            ("integer, save :: count\n", saved_variable),
+            ("integer :: count\n  save count\n", "a 'save' statement"),
+            ("integer :: count\n  data count /0/\n", "a 'data' statement")]:
+        callee = ModifiedSource(COMPONENTS.replace(
+            "  type(field_type) :: f_copy\n",
+            "  type(field_type) :: f_copy\n  " + saved)).tree.content[0]
+        with pytest.raises(RuntimeError) as excinfo:
+            inline_call(call, callee)
+        assert message in str(excinfo.value)
+        assert str(module.root) == original
+
+
+def test_inline_call_keywords():
+    ''' Check that keyword arguments are matched to the dummy arguments
+    of the same name and that optional arguments are rejected '''
+    module, sub = create_subroutine(args=["x", "y"])
+    call = CallGen(sub, "kern", ["b=y", "a = x"])
+    sub.add(call)
+    callee = ModifiedSource(
+        "subroutine kern(a, b)\n"
+        "  real, intent(in) :: a, b\n"
+        "  print *, b - a\n"
+        "end subroutine kern\n").tree.content[0]
+    inline_call(call, callee)
+    assert "PRINT *, y - x" in str(module.root)
+    for actuals, message in [
+            (["x", "a=y"], "its argument 'a' is passed more than once"),
+            (["x", "c=y"], "the keyword argument 'c' but has no argument"),
+            (["a=x"], "called with 1 arguments but has 2")]:
+        call = CallGen(sub, "kern", actuals)
+        sub.add(call)
+        with pytest.raises(RuntimeError) as excinfo:
+            inline_call(call, callee)
+        assert message in str(excinfo.value)
+    callee = ModifiedSource(
+        "subroutine kern(a, b)\n"
+        "  real, intent(in) :: a\n"
+        "  real, optional, intent(in) :: b\n"
+        "  if (present(b)) print *, b - a\n"
+        "end subroutine kern\n").tree.content[0]
+    call = CallGen(sub, "kern", ["x", "b=y"])
+    sub.add(call)
+    original = str(module.root)
+    with pytest.raises(RuntimeError) as excinfo:
+        inline_call(call, callee)
+    assert "Cannot inline 'kern' as its argument 'b' is optional" in \
+        str(excinfo.value)
+    assert str(module.root) == original
+
+
+def test_inline_call_expression_once():
+    ''' Check that an expression argument is evaluated once, before the
+    body changes the variables it refers to '''
+    module, sub = create_subroutine(args=["x"],
+                                    declarations=[("real", ["x"])])
+    call = CallGen(sub, "kern2", ["x", "x + 1.0"])
+    sub.add(call)
+    callee = ModifiedSource(
+        "subroutine kern2(a, b)\n"
+        "  real, intent(inout) :: a\n"
+        "  real, intent(in) :: b\n"
+        "  a = 0\n"
+        "  a = a + b\n"
+        "end subroutine kern2\n").tree.content[0]
+    inline_call(call, callee)
+    assert "REAL b_1\n" in str(module.root)
+    assert "b_1 = x + 1.0\n      x = 0\n      x = x + b_1\n" in \
+        str(module.root)
+    # a constant need not be evaluated first
+    call = CallGen(sub, "kern2", ["x", "2.0"])
+    sub.add(call)
+    inline_call(call, callee)
+    assert "x = x + (2.0)\n" in str(module.root)
@@ -52,3 +52,17 @@ def count_lines(root, string_name):
         if string_name in line:
             count += 1
     return count
+
+
+def create_subroutine(args=None, declarations=None):
+    '''helper routine which returns a module, named testmodule, and the
+    subroutine, named testsub, that it contains. The subroutine has the
+    supplied args and declares the variables in declarations, a list
+    of (datatype, entity_decls) pairs'''
+    from fgenerator.gen import ModuleGen, SubroutineGen, DeclGen
+    module = ModuleGen(name="testmodule")
+    sub = SubroutineGen(module, name="testsub", args=args)
+    module.add(sub)
+    for datatype, entity_decls in declarations or []:
+        sub.add(DeclGen(sub, datatype=datatype, entity_decls=entity_decls))
+    return module, sub
@@ -0,0 +1,311 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Science and Technology Facilities Council
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Author R. Ford STFC Daresbury Lab
+#
+'''This module provides transformations of trees of Gen objects. These
+restructure code that has already been generated, e.g. to inline small
+kernels at their call sites so that there is no call overhead within
+hot loops and the compiler can vectorise across what was the call.'''
+
+import re
+
+from fparser.base_classes import EndStatement
+from fparser.block_statements import Subroutine, Contains, Use
+from fparser.statements import Return, Entry, Comment, Save, Data
+from fparser.typedecl_statements import TypeDeclarationStatement, \
+    Implicit
+
+from fgenerator.base import BaseGen, copy_node
+from fgenerator.gen import ProgUnitGen, DeclGen, UseGen, TemplateGen, \
+    entity_name, _mark_names, _fill_names
+
+# An actual argument that can be substituted for a dummy argument without
+# enclosing it in parentheses (a name, possibly with components and
+# subscripts that do not themselves contain parentheses)
+_DESIGNATOR = re.compile(r"^\s*\w+(\s*%\s*\w+|\s*\([^()]*\))*\s*$")
+
+# An actual argument passed by keyword (name=value, but not name==value)
+_KEYWORD = re.compile(r"^\s*([a-z]\w*)\s*=(?![=>])(.*)$",
+                      re.IGNORECASE | re.DOTALL)
+
+
+class _CopiedDeclGen(DeclGen):
+    '''A declaration, of any type, that is an fparser declaration copied
+    from elsewhere (e.g. from a subroutine that is being inlined)'''
+    def __init__(self, parent, decl):
+        decl.parent = parent.root
+        BaseGen.__init__(self, parent, decl)
+
+
+def _scope(gen):
+    '''Returns the module or subroutine (a ProgUnitGen) that encloses
+    the Gen object gen, raising a RuntimeError if there is none'''
+    scope = gen.parent
+    while scope is not None and not isinstance(scope, ProgUnitGen):
+        scope = scope.parent
+    if scope is None:
+        raise RuntimeError(
+            "Cannot inline '{0}' as it is not within a module or "
+            "subroutine".format(str(gen.root).strip()))
+    return scope
+
+
+def _split_callee(sub):
+    '''Returns the use statements, declarations and executable statements
+    of the fparser Subroutine sub, raising a RuntimeError if it contains
+    anything that cannot be inlined'''
+    uses = []
+    decls = []
+    body = []
+    for stmt in sub.content:
+        if isinstance(stmt, EndStatement) or isinstance(stmt, Implicit):
+            continue
+        if isinstance(stmt, (Contains, Return, Entry, Save, Data)):
+            raise RuntimeError(
+                "Cannot inline subroutine '{0}' as it contains a '{1}' "
+                "statement".format(sub.name, stmt.__class__.__name__.lower()))
+        if isinstance(stmt, Use):
+            uses.append(stmt)
+        elif isinstance(stmt, TypeDeclarationStatement):
+            decls.append(stmt)
+        elif isinstance(stmt, Comment) and not body:
+            # comments amongst the declarations are dropped
+            continue
+        else:
+            body.append(stmt)
+    return uses, decls, body
+
+
+def _attribute(decl, name):
+    '''Returns the (lower-cased, blank-free) attribute of the fparser
+    declaration decl that starts with name, or None'''
+    for attr in decl.attrspec:
+        attr = attr.lower().replace(" ", "")
+        if attr.startswith(name):
+            return attr
+    return None
+
+
+def _is_variable(actual):
+    '''Returns True if the actual argument actual is a variable (which
+    may have components and subscripts) that can be assigned to'''
+    return _DESIGNATOR.match(actual) is not None and \
+        actual.strip()[0].isalpha()
+
+
+def _is_expression(actual):
+    '''Returns True if the actual argument actual is an expression that
+    refers to names (and so must be evaluated once, at the call) rather
+    than a variable or a constant'''
+    from fgenerator.gen import _TOKEN
+    return not _DESIGNATOR.match(actual) and \
+        any(match.group(0)[0].isalpha() for match in _TOKEN.finditer(actual))
+
+
+def _match_arguments(sub, dummies, actuals):
+    '''Returns a dictionary giving the actual argument passed to each of
+    the dummy arguments dummies of the fparser Subroutine sub. Actual
+    arguments of the form name=value are matched to the dummy argument
+    with that name and the others by position. Raises a RuntimeError if
+    the actual arguments do not match the dummy arguments one to one.'''
+    if len(actuals) != len(dummies):
+        raise RuntimeError(
+            "Cannot inline '{0}' as it is called with {1} arguments but "
+            "has {2}".format(sub.name, len(actuals), len(dummies)))
+    passed = {}
+    for dummy, actual in zip(dummies, actuals):
+        keyword = _KEYWORD.match(actual)
+        if keyword:
+            dummy = keyword.group(1).lower()
+            actual = keyword.group(2)
+            if dummy not in dummies:
+                raise RuntimeError(
+                    "Cannot inline '{0}' as it is called with the keyword "
+                    "argument '{1}' but has no argument of that name".format(
+                        sub.name, dummy))
+        if dummy in passed:
+            raise RuntimeError(
+                "Cannot inline '{0}' as its argument '{1}' is passed more "
+                "than once".format(sub.name, dummy))
+        passed[dummy] = actual.strip()
+    return passed
+
+
+def inline_call(call, callee):
+    '''Replaces the CallGen call by the body of the subroutine callee (a
+    SubroutineGen, an fparser Subroutine or a KernelProcedure). Actual
+    arguments, matched to the dummy arguments by keyword or else by
+    position, are substituted for the dummy arguments wherever these
+    are used as variables (but not where the same name is a component
+    or keyword). An actual argument that is an expression referring to
+    other names is first assigned to a new temporary variable, so that
+    it is evaluated once, at the call, as it would be for the call
+    itself. The declarations of the local variables of callee are
+    copied to the module or subroutine enclosing the call, the
+    variables being renamed with ProgUnitGen.new_name() if they would
+    clash with a name already declared there. Use statements of callee
+    are added to the same scope. Callees with optional arguments or
+    with local variables that are initialised (and so implicitly saved)
+    or saved cannot be inlined, nor can a call that passes an
+    expression for an intent(out) or intent(inout) argument.
+    Everything is checked before the tree is modified. Returns the list
+    of fparser nodes that replace the call.'''
+    from fgenerator.gen import AssignGen
+    sub = getattr(callee, "ast", None) or callee
+    sub = getattr(sub, "root", sub)
+    if not isinstance(sub, Subroutine):
+        raise RuntimeError(
+            "Expecting a subroutine to inline but received {0}".format(
+                type(callee)))
+    dummies = [arg.lower() for arg in sub.args]
+    passed = _match_arguments(sub, dummies, list(call.root.items))
+    uses, decls, body = _split_callee(sub)
+    scope = _scope(call)
+
+    # the value of each dummy argument in the caller (expressions that
+    # are evaluated into temporaries are replaced by these below)
+    values = {}
+    for dummy in dummies:
+        if _DESIGNATOR.match(passed[dummy]):
+            values[dummy] = passed[dummy]
+        else:
+            values[dummy] = "(" + passed[dummy] + ")"
+    local_decls = []
+    local_names = []
+    # the declarations of the temporaries holding expression arguments
+    temp_decls = []
+    for decl in decls:
+        names = [entity_name(entity) for entity in decl.entity_decls]
+        intent = _attribute(decl, "intent")
+        for name, entity in zip(names, decl.entity_decls):
+            if name in values:
+                if _attribute(decl, "optional"):
+                    raise RuntimeError(
+                        "Cannot inline '{0}' as its argument '{1}' is "
+                        "optional".format(sub.name, name))
+                dimension = "(" in entity or _attribute(decl, "dimension")
+                if dimension and values[name].endswith(")"):
+                    raise RuntimeError(
+                        "Cannot inline '{0}' as its array argument '{1}' "
+                        "is passed '{2}', which is not a whole "
+                        "array".format(sub.name, name, values[name]))
+                if intent in ("intent(out)", "intent(inout)") and \
+                   not _is_variable(passed[name]):
+                    raise RuntimeError(
+                        "Cannot inline '{0}' as its {1} argument '{2}' is "
+                        "passed '{3}', which is not a variable".format(
+                            sub.name, intent, name, passed[name]))
+                if _is_expression(passed[name]):
+                    if "*" in [item.strip() for item in decl.selector]:
+                        raise RuntimeError(
+                            "Cannot inline '{0}' as its assumed-length "
+                            "argument '{1}' is passed the expression "
+                            "'{2}'".format(sub.name, name, passed[name]))
+                    temp_decls.append((decl, name, entity))
+            elif _attribute(decl, "save") or \
+                    ("=" in entity and not _attribute(decl, "parameter")):
+                raise RuntimeError(
+                    "Cannot inline '{0}' as its local variable '{1}' is "
+                    "saved (initialised variables are implicitly "
+                    "saved)".format(sub.name, name))
+        decl_locals = [name for name in names if name not in values]
+        if len(decl_locals) != len(names) and decl_locals:
+            raise RuntimeError(
+                "Cannot inline '{0}' as it declares arguments and local "
+                "variables in the same statement".format(sub.name))
+        if decl_locals:
+            local_decls.append(decl)
+            local_names.extend(decl_locals)
+    temp_names = [name for _, name, _ in temp_decls]
+    for dummy in dummies:
+        if _is_expression(passed[dummy]) and dummy not in temp_names:
+            raise RuntimeError(
+                "Cannot inline '{0}' as its argument '{1}' is passed an "
+                "expression but is not declared".format(sub.name, dummy))
+
+    # parse everything that is to be substituted before modifying the
+    # tree, so that an error leaves it untouched
+    names = set(values) | set(local_names)
+    template = TemplateGen("\n".join(stmt.tofortran() for stmt in body),
+                           placeholders=list(names))
+
+    def mark(decl, entities):
+        ''' Returns the marked parts of the declaration decl of the
+        entities entities, without any intent attribute '''
+        attrspec = [_mark_names(attr, names) for attr in decl.attrspec
+                    if not attr.lower().startswith("intent")]
+        entity_decls = [_mark_names(entity, names, assignment=True)
+                        for entity in entities]
+        selector = tuple(_mark_names(item, names) if item else item
+                         for item in decl.selector)
+        return decl, attrspec, entity_decls, selector
+
+    marked_decls = [mark(decl, decl.entity_decls) for decl in local_decls]
+    marked_temps = [mark(decl, [entity]) for decl, _, entity in temp_decls]
+
+    reserved = scope._reserved_names()
+    for name in local_names:
+        new_name = name
+        while scope.lookup(new_name) is not None or \
+                new_name in reserved or new_name in values.values():
+            new_name = scope.new_name(name)
+        values[name] = new_name
+    for name in temp_names:
+        values[name] = scope.new_name(name)
+    for use in uses:
+        scope.add(UseGen(scope, name=use.name, only=use.isonly,
+                         funcnames=list(use.items) if use.isonly else None))
+    # the lengths and kinds in the declarations are evaluated on entry to
+    # the caller so they use the expressions rather than the temporaries
+    decl_values = dict(values)
+    for name in temp_names:
+        decl_values[name] = "(" + passed[name] + ")"
+    copies = [(marked, decl_values) for marked in marked_decls]
+    for (_, name, _), marked in zip(temp_decls, marked_temps):
+        temp_values = dict(decl_values)
+        temp_values[name] = values[name]
+        copies.append((marked, temp_values))
+    for (decl, attrspec, entity_decls, selector), fill in copies:
+        new_decl = copy_node(decl)
+        new_decl.attrspec = [_fill_names(attr, fill) for attr in attrspec]
+        new_decl.entity_decls = [_fill_names(entity, fill)
+                                 for entity in entity_decls]
+        new_decl.selector = tuple(_fill_names(item, fill) if item else item
+                                  for item in selector)
+        scope.add(_CopiedDeclGen(scope, new_decl))
+
+    stmts = [AssignGen(call.parent, lhs=values[name],
+                       rhs=passed[name]).root
+             for name in temp_names]
+    stmts.extend(template.instantiate(call.parent, values))
+    with call.edits() as edits:
+        edits.replace(call, stmts)
+    return stmts